@@ -0,0 +1,51 @@
+# A/B test analysis toolkit: the reusable parts of the analysis scripts.
+#
+#     from ab_testing import balance_report, load_dataset
+#     python -m ab_testing sample-size --p1 0.1 --p2 0.11
+#
+# Importing the package is free: the submodules (and pandas, scipy, sklearn,
+# pyarrow behind them) are only imported when one of the names below is first
+# used. Import a submodule directly (ab_testing.power_grid, ...) to get the rest
+# of its functions.
+
+import importlib
+
+_EXPORTS = {
+    "assignment": ["AssignmentCheck", "assign", "assign_stratified", "hash_ids", "verify_assignment"],
+    "balance_check": ["RANDOMIZATION_COVARIATES", "BalanceReport", "balance_report"],
+    "batch": ["BatchResult", "load_manifest", "run_batch"],
+    "bootstrap": ["BootstrapResult", "poisson_bootstrap"],
+    "compact_table": ["CompactTable", "pack_bits"],
+    "dataset_cache": ["DatasetCache", "load_dataset", "load_table"],
+    "ingest": ["EXPERIMENT_SCHEMA", "read_frame", "read_table"],
+    "power_grid": ["proportion_effectsize", "power", "sample_size", "sample_size_grid",
+                   "sample_size_table", "required_sample_size"],
+    "power_simulation": ["simulate_power", "simulated_sample_size"],
+    "profiling": ["stage", "profiled"],
+    "randomization_tree": ["fit_randomization_tree", "permutation_test"],
+    "raking": ["RakingResult", "rake", "weighted_welch"],
+    "rebalance": ["Rebalance", "rebalance_strata", "weighted_proportions", "weighted_ttest"],
+    "reports": ["ArtifactStore", "Figure", "artifact_key", "build_reports"],
+    "segment_tests": ["SegmentStats", "aggregate_segments", "pooled"],
+    "sequential_test": ["SequentialAnalyzer", "monitor_csv"],
+    "srm_monitor": ["SRMMonitor", "replay_csv"],
+    "streaming_ttest": ["TTestResult", "WelchAccumulator", "WelchResult", "accumulate_csv", "verdict",
+                        "welch_from_stats"],
+}
+_ORIGIN = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = sorted(_ORIGIN)
+
+
+def __getattr__(name):
+    if name in _ORIGIN:
+        value = getattr(importlib.import_module(f".{_ORIGIN[name]}", __name__), name)
+        globals()[name] = value
+        return value
+    if name in _EXPORTS:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_ORIGIN) | set(_EXPORTS))
@@ -0,0 +1,180 @@
+# Deterministic, hash-based assignment of users to experiment arms.
+#
+# check_randomization.py traced the Argentina/Uruguay problem to a broken
+# randomizer that sent too many users of some countries to test. This is the
+# assignment side done properly, so it can be checked with the same tools.
+#
+# assign(): every user id is mixed with a salt derived from the experiment name
+# (splitmix64 finalizer, plain uint64 arithmetic on NumPy arrays) and the 64-bit
+# hash is compared with the cumulative split thresholds. The arm of a user only
+# depends on (experiment, user id, splits): no state, no RNG, the same answer
+# in every process, on every machine, in any batch or order. Chunks are mixed
+# in place so the working set stays in cache: tens of millions of ids per
+# second on one core.
+#
+# assign_stratified(): hashing balances every stratum only in expectation. When
+# the cohort is known up front (a list of users to enroll), users are ordered
+# by hash within each stratum and the arms take consecutive runs of that order
+# in the split proportions, so each stratum gets exactly round(n * split)
+# users per arm. The order is still random (it is the hash), and reproducible.
+#
+# verify_assignment() runs the project's own checks on the output: a chi-square
+# test of the split against the plan and balance_check.balance_report for
+# every arm against control.
+
+import hashlib
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from .balance_check import RANDOMIZATION_COVARIATES, balance_report, encode_column
+from .profiling import len_first_arg, profiled
+
+AssignmentCheck = namedtuple("AssignmentCheck", ["split", "srm_pvalue", "covariates", "levels", "passed"])
+
+CHUNK_SIZE = 1 << 16
+
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+_S30, _S27, _S31 = np.uint64(30), np.uint64(27), np.uint64(31)
+
+
+def experiment_salt(experiment):
+    """64-bit salt of an experiment name (stable across processes, unlike hash())."""
+    digest = hashlib.blake2b(str(experiment).encode(), digest_size=8).digest()
+    return np.uint64(int.from_bytes(digest, "little"))
+
+
+def _id_keys(user_ids):
+    user_ids = np.asarray(user_ids)
+    if user_ids.dtype.kind in "iu":
+        return user_ids.astype(np.uint64, copy=False)
+    # strings and other ids: pandas' vectorized, fixed-key SipHash
+    return pd.util.hash_array(user_ids.astype(object))
+
+
+def hash_ids(user_ids, experiment):
+    """uint64 hash of each user id, salted with the experiment name."""
+    keys = _id_keys(user_ids)
+    salt = experiment_salt(experiment)
+    out = np.empty(len(keys), dtype=np.uint64)
+    shifted = np.empty(min(CHUNK_SIZE, len(keys)), dtype=np.uint64)
+    for start in range(0, len(keys), CHUNK_SIZE):
+        z = out[start:start + CHUNK_SIZE]
+        tmp = shifted[:len(z)]
+        np.add(keys[start:start + CHUNK_SIZE], salt, out=z)
+        for shift, mix in ((_S30, _MIX1), (_S27, _MIX2)):
+            np.right_shift(z, shift, out=tmp)
+            np.bitwise_xor(z, tmp, out=z)
+            np.multiply(z, mix, out=z)
+        np.right_shift(z, _S31, out=tmp)
+        np.bitwise_xor(z, tmp, out=z)
+    return out
+
+
+def _shares(splits):
+    splits = np.asarray(splits, dtype=np.float64)
+    if splits.ndim != 1 or len(splits) < 2 or (splits < 0).any() or splits.sum() <= 0:
+        raise ValueError(f"splits must be two or more non-negative weights, got {splits.tolist()}")
+    return splits / splits.sum()
+
+
+def split_thresholds(splits):
+    """Cumulative split boundaries on the uint64 hash range, one per arm after the first."""
+    cumulative = np.cumsum(_shares(splits))[:-1]
+    return np.array([min(int(c * 2 ** 64), 2 ** 64 - 1) for c in cumulative], dtype=np.uint64)
+
+
+def _arm_dtype(n_arms):
+    return np.int8 if n_arms < 128 else np.int16
+
+
+@profiled("assignment.assign", rows=len_first_arg)
+def assign(user_ids, experiment, splits=(0.5, 0.5)):
+    """Arm index (0 = control) of every user, from the salted hash of its id.
+
+    splits: relative size of each arm, e.g. (0.46, 0.54) or (1, 1, 1).
+    """
+    hashes = hash_ids(user_ids, experiment)
+    thresholds = split_thresholds(splits)
+    arms = np.zeros(len(hashes), dtype=_arm_dtype(len(thresholds) + 1))
+    for threshold in thresholds:
+        arms += hashes >= threshold
+    return arms
+
+
+def _stratum_codes(strata):
+    if isinstance(strata, pd.DataFrame):
+        columns = [strata[c] for c in strata.columns]
+    elif isinstance(strata, pd.Series):
+        columns = [strata]
+    else:
+        columns = [pd.Series(strata)]
+    combined = np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        codes, labels = encode_column(column)
+        combined = combined * len(labels) + codes
+    return combined
+
+
+@profiled("assignment.assign_stratified", rows=len_first_arg)
+def assign_stratified(user_ids, strata, experiment, splits=(0.5, 0.5)):
+    """Arm index of every user, exactly balanced within each stratum.
+
+    strata: a column (Series / array) or a DataFrame of columns whose level
+    combinations are the strata, e.g. data[["country"]]. Within a stratum of n
+    users, arm k gets round(n * share_k) of them (cumulative rounding), picked
+    by the salted hash order. Unlike assign(), a user's arm depends on the rest
+    of the cohort, so use it to enroll a known list of users in one go.
+    """
+    hashes = hash_ids(user_ids, experiment)
+    codes = _stratum_codes(strata)
+    # one sort on (stratum in the high bits, hash in the rest)
+    bits = np.uint64(max(int(codes.max(initial=0)).bit_length(), 1))
+    keys = (codes.astype(np.uint64) << (np.uint64(64) - bits)) | (hashes >> bits)
+    order = np.argsort(keys)
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    first = np.repeat(starts, sizes)
+    size = np.repeat(sizes, sizes)
+    # position of each user in its stratum, as a fraction of the stratum
+    position = (np.arange(len(order)) - first + 0.5) / size
+
+    cumulative = np.cumsum(_shares(splits))[:-1]
+    arms = np.empty(len(order), dtype=_arm_dtype(len(cumulative) + 1))
+    arms[order] = np.searchsorted(cumulative, position, side="right")
+    return arms
+
+
+def verify_assignment(data, splits=(0.5, 0.5), group_col="test", covariates=None,
+                      alpha=0.001, min_smd=0.1):
+    """Check an assignment with the project's own tests.
+
+    split: observed vs planned users per arm. srm_pvalue: chi-square
+    goodness-of-fit of that split (sample ratio mismatch). covariates / levels:
+    balance_report of every arm against control (column `arm`). passed: no SRM
+    at `alpha` and no imbalanced level (q < alpha and |SMD| >= min_smd).
+    """
+    if covariates is None:
+        covariates = [c for c in RANDOMIZATION_COVARIATES if c in data.columns]
+    shares = _shares(splits)
+    arms = np.asarray(data[group_col]).astype(np.intp)
+    observed = np.bincount(arms, minlength=len(shares))
+    expected = observed.sum() * shares
+    pvalue = stats.chisquare(observed, expected).pvalue
+    split = pd.DataFrame({"arm": np.arange(len(shares)), "observed": observed, "expected": expected,
+                          "share": observed / observed.sum(), "planned_share": shares})
+
+    covariate_frames, level_frames = [], []
+    for arm in range(1, len(shares)):
+        rows = (arms == 0) | (arms == arm)
+        pair = data.loc[rows, covariates].assign(**{group_col: (arms[rows] == arm).astype(np.int8)})
+        report = balance_report(pair, covariates, group_col, alpha=alpha, min_smd=min_smd)
+        covariate_frames.append(report.covariates.assign(arm=arm))
+        level_frames.append(report.levels.assign(arm=arm))
+    levels = pd.concat(level_frames, ignore_index=True)
+    passed = bool(pvalue > alpha and not levels["imbalanced"].any())
+    return AssignmentCheck(split, pvalue, pd.concat(covariate_frames, ignore_index=True), levels, passed)
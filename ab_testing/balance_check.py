@@ -0,0 +1,114 @@
+# Covariate balance report for an A/B test.
+#
+# Checking randomization means checking that every covariate has the same
+# distribution in test and control. check_randomization.py did this for `source`
+# with a groupby/unstack and then eyeballed Argentina/Uruguay. Here we do all
+# covariates in one go: each column is turned into integer codes and a single
+# np.bincount over (code * 2 + test) gives the full level x group contingency
+# table. Everything else (proportions, chi-square, SMD, FDR) is vectorized
+# arithmetic on those small count tables, so the cost is one pass over the data.
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from statsmodels.stats.multitest import multipletests
+
+from .profiling import len_first_arg, profiled
+
+# covariates of the randomization.csv schema
+RANDOMIZATION_COVARIATES = [
+    "source", "device", "browser_language", "browser", "sex", "age", "country",
+]
+
+BalanceReport = namedtuple("BalanceReport", ["levels", "covariates"])
+
+
+def encode_column(values):
+    """Integer codes and level labels for a column. Missing values get their own level."""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        labels = values.cat.categories.astype(object).to_numpy()
+    else:
+        codes, labels = pd.factorize(values, sort=True)
+        labels = np.asarray(labels, dtype=object)
+    codes = codes.astype(np.intp, copy=False)
+    if (codes < 0).any():
+        codes = np.where(codes < 0, len(labels), codes)
+        labels = np.append(labels, "<NA>")
+    return codes, labels
+
+
+def group_counts(codes, n_levels, test):
+    """(n_levels, 2) table of [control, test] counts per level, in one bincount."""
+    return np.bincount(codes * 2 + test, minlength=2 * n_levels).reshape(n_levels, 2)
+
+
+@profiled("balance_check.balance_report", rows=len_first_arg)
+def balance_report(data, covariates=None, group_col="test", alpha=0.05, min_smd=0.1):
+    """Per-level and per-covariate balance statistics between test and control.
+
+    levels: one row per (covariate, level) with counts, the level's proportion
+    within control and within test, the share of the level's users that are in
+    test, the standardized mean difference of the level indicator, a 2x2
+    chi-square test and its Benjamini-Hochberg q-value across all levels.
+    A level is `imbalanced` when its q-value is below `alpha` and |SMD| is at
+    least `min_smd` (0.1 is the usual rule of thumb; with millions of rows
+    almost any difference is significant, so the effect size matters too).
+
+    covariates: one row per covariate with the k x 2 chi-square test of
+    independence between the covariate and the assignment.
+    """
+    if covariates is None:
+        covariates = [c for c in RANDOMIZATION_COVARIATES if c in data.columns]
+    test = np.asarray(data[group_col]).astype(np.intp, copy=False)
+    group_sizes = np.bincount(test, minlength=2)[:2].astype(np.float64)
+
+    level_tables = []
+    covariate_rows = []
+    for name in covariates:
+        codes, labels = encode_column(data[name])
+        counts = group_counts(codes, len(labels), test).astype(np.float64)
+
+        props = counts / group_sizes
+        p0, p1 = props[:, 0], props[:, 1]
+        pooled = counts.sum(axis=1) / group_sizes.sum()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            smd = (p1 - p0) / np.sqrt((p1 * (1 - p1) + p0 * (1 - p0)) / 2)
+            chi2 = (p1 - p0) ** 2 / (pooled * (1 - pooled) * (1 / group_sizes).sum())
+            share_test = counts[:, 1] / counts.sum(axis=1)
+        level_tables.append(pd.DataFrame({
+            "covariate": name,
+            "level": labels,
+            "n_control": counts[:, 0].astype(np.int64),
+            "n_test": counts[:, 1].astype(np.int64),
+            "prop_control": p0,
+            "prop_test": p1,
+            "share_test": share_test,
+            "smd": np.nan_to_num(smd),
+            "chi2": np.nan_to_num(chi2),
+        }))
+
+        # k x 2 test of independence on the same table
+        observed = counts[counts.sum(axis=1) > 0]
+        expected = np.outer(observed.sum(axis=1), group_sizes) / group_sizes.sum()
+        chi2_total = ((observed - expected) ** 2 / expected).sum()
+        dof = max(len(observed) - 1, 1)
+        covariate_rows.append({
+            "covariate": name,
+            "n_levels": len(labels),
+            "chi2": chi2_total,
+            "df": dof,
+            "pvalue": stats.chi2.sf(chi2_total, dof),
+            "max_abs_smd": np.abs(np.nan_to_num(smd)).max(),
+        })
+
+    levels = pd.concat(level_tables, ignore_index=True)
+    levels["pvalue"] = stats.chi2.sf(levels["chi2"].to_numpy(), 1)
+    levels["qvalue"] = multipletests(levels["pvalue"], method="fdr_bh")[1]
+    levels["imbalanced"] = (levels["qvalue"] < alpha) & (levels["smd"].abs() >= min_smd)
+
+    covariate_summary = pd.DataFrame(covariate_rows)
+    covariate_summary["qvalue"] = multipletests(covariate_summary["pvalue"], method="fdr_bh")[1]
+    return BalanceReport(levels, covariate_summary)
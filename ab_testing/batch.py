@@ -0,0 +1,273 @@
+# Batch analysis of many experiments and metrics from one manifest.
+#
+# ab_testing_analysis.py analyzes one experiment and one metric per run. Here a
+# manifest lists any number of experiments, each with its dataset, metrics and
+# options, e.g. (JSON)
+#     [{"experiment": "new-site", "source": "randomization.csv",
+#       "metrics": ["conversion"], "correct": "country"}, ...]
+# and every experiment goes through the same stages as the scripts: load,
+# balance check, correction of the imbalanced levels of `correct`, and a t-test
+# of every metric before (Welch) and after correction (Student's, on the
+# rebalanced sample, as in correct_randomization_bias.py).
+#
+# Scheduling:
+#   - each distinct source is parsed once, into the dataset cache (see
+#     dataset_cache.py). Jobs get the path of the Feather file and memory-map
+#     it, so every worker that reads the same source shares one copy through
+#     the page cache instead of parsing or unpickling its own.
+#   - experiments run on a process pool, ordered by source so that a worker
+#     usually finds the table it needs already mapped.
+#   - every finished experiment is written as its own Parquet part, named
+#     after a hash of its manifest entry and of the dataset's content. After a
+#     crash (or Ctrl-C), running the same command again skips the parts that
+#     exist and only runs what is missing or changed.
+#   - the parts are combined into one columnar results table: one row per
+#     (experiment, metric, analysis).
+
+import functools
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from .balance_check import RANDOMIZATION_COVARIATES, balance_report
+from .dataset_cache import DatasetCache
+from .profiling import profiled, recorded_result, stage, submit_recorded
+from .rebalance import rebalance_strata, weighted_ttest
+from .streaming_ttest import WelchAccumulator
+
+Job = namedtuple("Job", ["experiment", "source", "metrics", "group_col", "covariates", "correct",
+                         "alpha", "min_smd", "seed"])
+BatchResult = namedtuple("BatchResult", ["results", "completed", "skipped", "failed"])
+
+JOB_DEFAULTS = {"metrics": ("conversion",), "group_col": "test", "covariates": None,
+                "correct": "country", "alpha": 0.05, "min_smd": 0.1, "seed": 42}
+
+RESULT_COLUMNS = ["experiment", "source", "metric", "analysis", "n_control", "n_test",
+                  "mean_control", "mean_test", "lift", "statistic", "df", "pvalue", "significant",
+                  "imbalanced", "corrected_levels", "elapsed_s"]
+
+
+def make_job(entry):
+    """Job from a manifest entry (dict); only `experiment` and `source` are required."""
+    unknown = set(entry) - set(Job._fields)
+    if unknown:
+        raise ValueError(f"unknown manifest fields for {entry.get('experiment')!r}: {sorted(unknown)}")
+    fields = dict(JOB_DEFAULTS, **entry)
+    for required in ("experiment", "source"):
+        if required not in fields:
+            raise ValueError(f"manifest entry without {required!r}: {entry}")
+    for name in ("metrics", "covariates"):
+        if isinstance(fields[name], str):
+            fields[name] = fields[name].split()
+        if fields[name] is not None:
+            fields[name] = tuple(fields[name])
+    return Job(**fields)
+
+
+def load_manifest(manifest):
+    """Jobs from a JSON file (list of entries), a CSV file (one entry per row) or a list."""
+    if isinstance(manifest, (str, os.PathLike)):
+        if os.fspath(manifest).endswith(".csv"):
+            frame = pd.read_csv(manifest, dtype=str)
+            entries = [{k: v for k, v in row.items() if pd.notna(v)} for row in frame.to_dict("records")]
+            for entry in entries:
+                for name, cast in (("alpha", float), ("min_smd", float), ("seed", int)):
+                    if name in entry:
+                        entry[name] = cast(entry[name])
+        else:
+            with open(manifest) as f:
+                entries = json.load(f)
+    else:
+        entries = manifest
+    jobs = [make_job(entry) for entry in entries]
+    names = [job.experiment for job in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("experiment names in the manifest must be unique")
+    return jobs
+
+
+def job_key(job, content_hash):
+    """Hash of the job's settings and of its dataset's content."""
+    payload = json.dumps([list(job), content_hash])
+    return hashlib.sha256(payload.encode()).hexdigest()[:20]
+
+
+# -- worker side ----------------------------------------------------------------
+
+@functools.lru_cache(maxsize=4)
+def _load(path, columns):
+    # memory-mapped: workers reading the same file share it through the page cache
+    return feather.read_table(path, columns=list(columns), memory_map=True).to_pandas(split_blocks=True)
+
+
+def _result_rows(job, metric, analysis, result, n, means):
+    return {"experiment": job.experiment, "source": job.source, "metric": metric, "analysis": analysis,
+            "n_control": int(n[0]), "n_test": int(n[1]),
+            "mean_control": float(means[0]), "mean_test": float(means[1]),
+            "lift": float(means[1] - means[0]), "statistic": result.statistic, "df": result.df,
+            "pvalue": result.pvalue, "significant": bool(result.pvalue <= job.alpha)}
+
+
+@profiled("batch.run_job")
+def run_job(job, path):
+    """All stages of one experiment; returns its result rows as a DataFrame."""
+    start = time.perf_counter()
+    covariates = job.covariates
+    if covariates is None:
+        with pa.memory_map(path) as source:
+            columns = pa.ipc.open_file(source).schema.names
+        covariates = [c for c in RANDOMIZATION_COVARIATES if c in columns]
+    needed = tuple(dict.fromkeys([job.group_col, *job.metrics, *covariates]))
+    with stage("batch.load"):
+        data = _load(path, needed)
+
+    # without covariates (e.g. a bare results table) only the raw test is run
+    strata, imbalanced = [], pd.DataFrame(columns=["covariate", "level"])
+    if covariates:
+        with stage("batch.balance", rows=len(data)):
+            levels = balance_report(data, covariates, job.group_col, job.alpha, job.min_smd).levels
+        imbalanced = levels[levels["imbalanced"]]
+        strata = sorted(imbalanced.loc[imbalanced["covariate"] == job.correct, "level"].astype(str))
+
+    multiplicity, corrected = None, []
+    if strata:
+        with stage("batch.correction", rows=len(data)):
+            rebalance = rebalance_strata(data, job.correct, strata, job.group_col, seed=job.seed)
+        # only under-represented levels get extra rows
+        corrected = sorted(rebalance.plan[job.correct].astype(str))
+        if corrected:
+            multiplicity = rebalance.multiplicity
+
+    rows = []
+    group = data[job.group_col].to_numpy()
+    for metric in job.metrics:
+        values = data[metric].to_numpy(dtype=np.float64)
+        with stage("batch.ttest", rows=len(data)):
+            acc = WelchAccumulator().update(group, values)
+            rows.append(_result_rows(job, metric, "original", acc.welch(), acc.n, acc.means()))
+            if multiplicity is not None:
+                n = multiplicity.sum(axis=1)
+                corrected_test = weighted_ttest(values, multiplicity, equal_var=True)
+                rows.append(_result_rows(job, metric, "corrected", corrected_test,
+                                         n, (multiplicity @ values) / n))
+
+    results = pd.DataFrame(rows)
+    results["imbalanced"] = ";".join(f"{r.covariate}={r.level}" for r in imbalanced.itertuples())
+    results["corrected_levels"] = ";".join(corrected)
+    results["elapsed_s"] = time.perf_counter() - start
+    return results
+
+
+def _run_part(job, path, part, cache_dir):
+    if not os.path.exists(path):
+        # removed by another process sharing the cache: convert it again
+        path = DatasetCache(cache_dir).path(job.source)
+    results = run_job(job, path)
+    tmp = f"{part}.{os.getpid()}.tmp"
+    pq.write_table(pa.Table.from_pandas(results[RESULT_COLUMNS], preserve_index=False), tmp)
+    os.replace(tmp, part)
+    return len(results)
+
+
+# -- scheduler --------------------------------------------------------------------
+
+def _progress(done, total, job, started, note, stream):
+    elapsed = time.perf_counter() - started
+    eta = elapsed / done * (total - done) if done else 0
+    print(f"[{done}/{total}] {job.experiment} {note} ({elapsed:.1f}s elapsed, ~{eta:.0f}s left)",
+          file=stream, flush=True)
+
+
+@profiled("batch.run_batch")
+def run_batch(manifest, output="batch_results.parquet", parts_dir=None, processes=None,
+              cache=None, progress=sys.stderr):
+    """Run every experiment of the manifest and write one results table to `output`.
+
+    manifest: path to a JSON/CSV manifest, or a list of entries (see make_job).
+    parts_dir (default <output>.parts) keeps one Parquet file per finished
+    experiment; experiments whose part exists are skipped, so an interrupted
+    batch resumes where it stopped. processes=1 runs in this process.
+    progress: stream for one line per finished experiment, None for silence.
+    Returns a BatchResult with the combined results DataFrame and the names of
+    the completed, skipped and failed experiments (failed: {name: error});
+    experiments whose source can't be fetched or parsed fail with that error.
+    """
+    jobs = load_manifest(manifest)
+    cache = cache or DatasetCache()
+    parts_dir = parts_dir or f"{output}.parts"
+    os.makedirs(parts_dir, exist_ok=True)
+
+    # parse each distinct source once, in this process; a source that can't be
+    # fetched or parsed fails its own experiments, not the batch. The cache is
+    # pinned until all jobs ran, so converting one source never evicts the file
+    # of another that is still to be read.
+    paths, source_errors = {}, {}
+    with cache.pin():
+        with stage("batch.prepare_sources"):
+            for source in dict.fromkeys(job.source for job in jobs):
+                try:
+                    paths[source] = cache.path(source)
+                except Exception as error:
+                    source_errors[source] = f"{type(error).__name__}: {error}"
+        failed = {job.experiment: source_errors[job.source] for job in jobs if job.source in source_errors}
+        runnable = [job for job in jobs if job.source in paths]
+        parts = {job.experiment: os.path.join(parts_dir, f"{job_key(job, os.path.basename(paths[job.source]))}.parquet")
+                 for job in runnable}
+
+        skipped = [job.experiment for job in runnable if os.path.exists(parts[job.experiment])]
+        pending = sorted((job for job in runnable if job.experiment not in skipped), key=lambda job: job.source)
+        completed, n_source_failed = [], len(failed)
+        started = time.perf_counter()
+        if progress:
+            for source, error in source_errors.items():
+                print(f"source {source} FAILED ({error})", file=progress)
+        if progress and skipped:
+            print(f"{len(skipped)} of {len(jobs)} experiments already done, resuming", file=progress)
+
+        def finished(job, error=None):
+            if error is None:
+                completed.append(job.experiment)
+            else:
+                failed[job.experiment] = f"{type(error).__name__}: {error}"
+            if progress:
+                note = "done" if error is None else f"FAILED ({failed[job.experiment]})"
+                done = len(completed) + len(failed) - n_source_failed
+                _progress(done, len(pending), job, started, note, progress)
+
+        if processes == 1 or len(pending) <= 1:
+            for job in pending:
+                try:
+                    _run_part(job, paths[job.source], parts[job.experiment], cache.cache_dir)
+                except Exception as error:
+                    finished(job, error)
+                else:
+                    finished(job)
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                futures = {submit_recorded(pool, _run_part, job, paths[job.source], parts[job.experiment],
+                                           cache.cache_dir): job
+                           for job in pending}
+                for future in as_completed(futures):
+                    try:
+                        recorded_result(future)
+                    except Exception as error:
+                        finished(futures[future], error)
+                    else:
+                        finished(futures[future])
+
+    with stage("batch.combine"):
+        done = [parts[job.experiment] for job in runnable if os.path.exists(parts[job.experiment])]
+        table = (pa.concat_tables([pq.read_table(p) for p in done]) if done
+                 else pa.Table.from_pandas(pd.DataFrame(columns=RESULT_COLUMNS), preserve_index=False))
+        pq.write_table(table, output)
+    return BatchResult(table.to_pandas(), completed, skipped, failed)
@@ -0,0 +1,150 @@
+# Poisson bootstrap confidence intervals for the conversion lift.
+#
+# The t-tests only give a p-value. To put an interval on the lift itself
+# (e.g. 4.37% -> 5.56%) we bootstrap, but resampling rows with pandas is far too
+# slow at our row counts. The Poisson bootstrap replaces "draw n rows with
+# replacement" with "give every row an independent Poisson(1) weight", which
+# needs no shuffling and can be done chunk by chunk: each chunk of rows gets a
+# (replicates x rows) weight matrix, and only the per-replicate weighted sums
+# are kept. Chunks are independent, so they run on a process pool, each with a
+# seed spawned from one SeedSequence (results don't depend on the pool size).
+#
+# Two shortcuts keep this cheap:
+#   - a row counted m times (rebalance.py multiplicities) gets a Poisson(m)
+#     weight, the sum of m independent Poisson(1) weights.
+#   - rows with the same group and value are interchangeable, and the sum of
+#     their weights is Poisson(total count). For a binary metric like
+#     conversion that collapses the whole table to 4 cells per replicate, with
+#     exactly the same bootstrap distribution.
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from .profiling import len_first_arg, profiled
+
+BootstrapResult = namedtuple("BootstrapResult", ["summary", "replicates"])
+
+# collapse identical rows when a metric has at most this many distinct values
+MAX_COLLAPSED_VALUES = 1024
+
+# Poisson(1) CDF up to the point where the remaining tail is below float precision
+_POISSON1_CDF = stats.poisson.cdf(np.arange(18), 1.0)
+
+
+def _group_multiplicity(group, multiplicity):
+    if multiplicity is not None:
+        return np.asarray(multiplicity)
+    group = np.asarray(group)
+    return np.vstack([group == 0, group == 1]).astype(np.int32)
+
+
+def _poisson_weights(rng, counts, n_replicates):
+    """(n_replicates, rows) float weights, Poisson(counts[j]) in column j."""
+    if (counts == 1).all():
+        # the common case: inverting the Poisson(1) CDF with a few comparisons
+        # is ~2x faster than rng.poisson
+        u = rng.random((n_replicates, len(counts)))
+        weights = np.zeros(u.shape, dtype=np.uint8)
+        for threshold in _POISSON1_CDF:
+            weights += u > threshold
+        return weights.astype(np.float64)
+    return rng.poisson(counts, size=(n_replicates, len(counts))).astype(np.float64)
+
+
+def _weighted_sums(seed, values, counts, n_replicates, replicate_batch):
+    """Per-replicate total weight and weighted sum for both groups.
+
+    counts is (2, rows): how many times each row counts in control / test.
+    Returns a (4, n_replicates) array: n_control, sum_control, n_test, sum_test.
+    """
+    rng = np.random.default_rng(seed)
+    out = np.empty((4, n_replicates))
+    # rows that never count in a group always get weight 0 there, skip them
+    members = [np.flatnonzero(counts[g]) for g in (0, 1)]
+    for start in range(0, n_replicates, replicate_batch):
+        stop = min(start + replicate_batch, n_replicates)
+        for g, rows in enumerate(members):
+            weights = _poisson_weights(rng, counts[g][rows], stop - start)
+            out[2 * g, start:stop] = weights.sum(axis=1)
+            out[2 * g + 1, start:stop] = weights @ values[rows]
+    return out
+
+
+def _collapse(values, counts):
+    """Merge rows with equal values: unique values and their counts per group."""
+    uniques, inverse = np.unique(values, return_inverse=True)
+    cells = np.vstack([
+        np.bincount(inverse, weights=counts[g], minlength=len(uniques)) for g in (0, 1)
+    ])
+    return uniques, cells
+
+
+def _summary(sums, point, alpha):
+    n0, s0, n1, s1 = sums
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean0, mean1 = s0 / n0, s1 / n1
+    replicates = pd.DataFrame({
+        "mean_control": mean0,
+        "mean_test": mean1,
+        "absolute_lift": mean1 - mean0,
+        "relative_lift": mean1 / mean0 - 1,
+    })
+    rows = []
+    for name, estimate in zip(replicates.columns, point):
+        column = replicates[name].to_numpy()
+        low, high = np.nanquantile(column, [alpha / 2, 1 - alpha / 2])
+        rows.append({"statistic": name, "estimate": estimate, "std_error": np.nanstd(column, ddof=1),
+                     "ci_low": low, "ci_high": high})
+    return pd.DataFrame(rows), replicates
+
+
+@profiled("bootstrap.poisson_bootstrap", rows=len_first_arg)
+def poisson_bootstrap(values, group=None, multiplicity=None, n_replicates=10_000,
+                      alpha=0.05, seed=0, processes=None, chunk_rows=50_000,
+                      replicate_batch=100, collapse="auto"):
+    """Percentile CIs for control/test means and the absolute and relative lift.
+
+    Pass either `group` (0 = control, 1 = test), or a (2, n) `multiplicity`
+    from rebalance.rebalance_strata to bootstrap the rebalanced data without
+    expanding it.
+
+    collapse: "auto" merges rows with equal values when the metric has at most
+    MAX_COLLAPSED_VALUES distinct values (exact, and O(1) per replicate for a
+    binary metric); True / False force it on / off. Without collapsing, rows are
+    processed in chunks of `chunk_rows` on a process pool (processes=1 runs in
+    this process), `replicate_batch` replicates at a time, so memory per worker
+    is about chunk_rows * replicate_batch * 8 bytes.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    counts = _group_multiplicity(group, multiplicity)
+
+    totals = counts.sum(axis=1).astype(np.float64)
+    point_means = (counts @ values) / totals
+    point = [point_means[0], point_means[1], point_means[1] - point_means[0],
+             point_means[1] / point_means[0] - 1]
+
+    if collapse == "auto":
+        collapse = len(np.unique(values)) <= MAX_COLLAPSED_VALUES
+    if collapse:
+        uniques, cells = _collapse(values, counts)
+        sums = _weighted_sums(np.random.SeedSequence(seed), uniques, cells,
+                              n_replicates, max(replicate_batch, 1000))
+        return BootstrapResult(*_summary(sums, point, alpha))
+
+    starts = list(range(0, len(values), chunk_rows))
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    tasks = [(s, values[i:i + chunk_rows], counts[:, i:i + chunk_rows], n_replicates,
+              replicate_batch) for s, i in zip(seeds, starts)]
+    sums = np.zeros((4, n_replicates))
+    if processes == 1:
+        for task in tasks:
+            sums += _weighted_sums(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for partial in pool.map(_weighted_sums, *zip(*tasks)):
+                sums += partial
+    return BootstrapResult(*_summary(sums, point, alpha))
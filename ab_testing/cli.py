@@ -0,0 +1,406 @@
+# Command line entry point: python -m ab_testing <command> ...
+#
+#     python -m ab_testing analyze results.csv --bootstrap 10000
+#     python -m ab_testing check-balance randomization.csv --tree --permutations 200
+#     python -m ab_testing correct-bias randomization.csv --strata Argentina Uruguay
+#     python -m ab_testing correct-bias randomization.csv --rake --interaction country device
+#     python -m ab_testing srm assignments.csv --expected-share 0.5
+#     python -m ab_testing assign users.csv --experiment new-site --strata country --output arms.csv
+#     python -m ab_testing report exp1.csv exp2.csv --output-dir reports --pdf
+#     python -m ab_testing batch manifest.json --output results.parquet --processes 8
+#     python -m ab_testing sample-size --p1 0.1 --p2 0.11
+#
+# Only argparse and profiling (standard library only) are imported up front.
+# Each command imports what it needs when it runs, so `sample-size` never loads
+# pandas, scipy, pyarrow, sklearn or matplotlib and starts in about a tenth of a
+# second; the benchmarks check it against a budget (see
+# benchmarks/run_benchmarks.py, stage "cli_sample_size").
+#
+# --profile [PATH] records the stages of the command like AB_TESTING_PROFILE does
+# (see profiling.py).
+
+import argparse
+import sys
+
+from . import profiling
+
+
+def _print_frame(title, frame):
+    print(f"\n{title}")
+    print(frame.to_string() if len(frame) else "(none)")
+
+
+def _bootstrap_summary(values, n_replicates, **kwargs):
+    from .bootstrap import poisson_bootstrap
+
+    result = poisson_bootstrap(values, n_replicates=n_replicates, seed=0, **kwargs)
+    _print_frame(f"Poisson bootstrap, {n_replicates:,} replicates", result.summary)
+
+
+def _pyplot():
+    # figures are only ever written to files, no display needed
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def _save_figure(plt, path):
+    plt.savefig(path, dpi=150, bbox_inches="tight")
+    plt.close()
+    print(f"\nfigure written to {path}")
+
+
+def cmd_analyze(args):
+    from .streaming_ttest import accumulate_batches, accumulate_csv, verdict
+
+    columns = [args.group_col, args.metric_col]
+    if args.no_cache:
+        acc = accumulate_csv(args.source, args.group_col, args.metric_col, chunksize=args.chunksize)
+    else:
+        from .dataset_cache import load_table
+        table = load_table(args.source, columns=columns)
+        acc = accumulate_batches(table.to_batches(), args.group_col, args.metric_col)
+
+    means = acc.means()
+    result = acc.welch()
+    print(f"{args.metric_col} mean: control {means[0]:.6f}, test {means[1]:.6f} "
+          f"(n = {int(acc.n[0]):,} / {int(acc.n[1]):,})")
+    print(f"Welch t-statistic: {result.statistic:.4f}, df: {result.df:.1f}, p-value: {result.pvalue:.4g}")
+    print(verdict(result, args.alpha))
+    if args.bootstrap:
+        _bootstrap_summary(table.column(args.metric_col).to_numpy(), args.bootstrap,
+                           group=table.column(args.group_col).to_numpy(), alpha=args.alpha)
+    return 0
+
+
+def cmd_check_balance(args):
+    from .balance_check import balance_report
+    from .dataset_cache import load_dataset
+
+    # only the columns the checks use are read from the cached table
+    data = load_dataset(args.source, columns=[args.group_col, *args.covariates] if args.covariates else None)
+    report = balance_report(data, args.covariates, args.group_col, args.alpha, args.min_smd)
+    _print_frame("Covariates (chi-square test of independence with the assignment)",
+                 report.covariates)
+    _print_frame(f"Imbalanced levels (q < {args.alpha}, |SMD| >= {args.min_smd})",
+                 report.levels[report.levels["imbalanced"]])
+
+    if args.tree or args.plot:
+        from .randomization_tree import fit_randomization_tree
+        check = fit_randomization_tree(data, args.covariates, args.group_col,
+                                       max_rows=args.max_rows, seed=args.seed)
+        _print_frame("Decision tree splits separating test from control", check.splits)
+        if args.plot:
+            from sklearn.tree import plot_tree
+
+            with profiling.stage("cli.plot_tree"):
+                plt = _pyplot()
+                plt.figure(figsize=(20, 20))
+                plot_tree(check.tree, feature_names=check.feature_names,
+                          class_names=["Control", "Test"], filled=True, proportion=True,
+                          rounded=True, max_depth=3)
+                _save_figure(plt, args.plot)
+
+    if args.permutations:
+        from .randomization_tree import permutation_test
+        calibration = permutation_test(data, args.permutations, args.covariates, args.group_col,
+                                       max_rows=args.max_rows, seed=args.seed,
+                                       processes=args.processes)
+        _print_frame(f"Permutation test, {args.permutations} permutations", calibration.summary)
+        _print_frame("Splitting features", calibration.features)
+
+    return 1 if args.strict and report.levels["imbalanced"].any() else 0
+
+
+def cmd_correct_bias(args):
+    from .dataset_cache import load_dataset
+    from .rebalance import rebalance_strata, weighted_proportions, weighted_ttest
+
+    columns = None
+    if args.rake is None or args.rake:
+        interactions = [c for pair in args.interaction or () for c in pair]
+        columns = list(dict.fromkeys([args.group_col, args.metric_col, args.column,
+                                      *(args.rake or ()), *interactions]))
+    data = load_dataset(args.source, columns=columns)
+    rebalance = rebalance_strata(data, args.column, args.strata, args.group_col,
+                                 target_group=args.target_group, donor_group=args.donor_group,
+                                 seed=args.seed)
+    _print_frame("Oversampling plan", rebalance.plan)
+
+    props = weighted_proportions(data[args.column], rebalance.multiplicity)
+    _print_frame(f"{args.column} proportions after balancing",
+                 props[args.strata] if args.strata else props)
+
+    t_stat, p_val = weighted_ttest(data[args.metric_col], rebalance.multiplicity,
+                                   equal_var=args.equal_var)[:2]
+    print(f"\nT-statistic: {t_stat:.4f}, P-value: {p_val:.4g}")
+    if args.bootstrap:
+        _bootstrap_summary(data[args.metric_col], args.bootstrap,
+                           multiplicity=rebalance.multiplicity, alpha=args.alpha)
+    if args.rake is not None:
+        from .raking import rake, weighted_welch
+
+        raked = rake(data, args.rake or None, args.interaction or (), args.group_col,
+                     target_group=args.target_group, max_weight=args.max_weight)
+        margins = raked.margins
+        worst = (margins["before"] - margins["target"]).abs().nlargest(10).index
+        _print_frame("Most unbalanced margins, before and after raking", margins.loc[worst])
+        print(f"\nRaking: {raked.iterations} iterations, converged={raked.converged}, "
+              f"max margin error {raked.max_error:.2g}, effective control size {raked.effective_n:,.0f}")
+        result = weighted_welch(data[args.metric_col], data[args.group_col], raked.weights)
+        print(f"Raked T-statistic: {result.statistic:.4f}, P-value: {result.pvalue:.4g}")
+    return 0
+
+
+def cmd_srm(args):
+    import time
+
+    from .srm_monitor import SRMMonitor, replay_csv
+
+    monitor = SRMMonitor(args.covariates, args.expected_share, args.alpha, args.tau,
+                         group_col=args.group_col)
+    start = time.perf_counter()
+    for events, new in replay_csv(args.source, monitor, block_size=args.block_size):
+        for covariate, level in new:
+            print(f"SRM alert after {events:,} events: {covariate} {level}".rstrip())
+    elapsed = time.perf_counter() - start
+
+    status = monitor.status()
+    overall = status.overall
+    print(f"\n{status.events:,} events in {elapsed:.2f}s ({status.events / elapsed / 1e6:.2f}M/s), "
+          f"test share {overall['test_share']:.4f}")
+    _print_frame("Flagged strata", status.strata[status.strata["flagged"]])
+    return 1 if args.strict and len(status.alerts) else 0
+
+
+def cmd_assign(args):
+    from .assignment import assign, assign_stratified, verify_assignment
+    from .dataset_cache import load_dataset
+
+    data = load_dataset(args.source)
+    if args.strata:
+        arms = assign_stratified(data[args.user_col].to_numpy(), data[args.strata], args.experiment,
+                                 args.splits)
+    else:
+        arms = assign(data[args.user_col].to_numpy(), args.experiment, args.splits)
+    data = data.assign(**{args.group_col: arms})
+    if args.output:
+        with profiling.stage("cli.write_assignments", rows=len(data)):
+            data[[args.user_col, args.group_col]].to_csv(args.output, index=False)
+        print(f"{len(data):,} assignments written to {args.output}")
+    if not args.verify:
+        return 0
+
+    check = verify_assignment(data, args.splits, args.group_col, args.covariates, args.alpha)
+    _print_frame(f"Split (SRM p-value {check.srm_pvalue:.4g})", check.split)
+    _print_frame(f"Imbalanced levels (q < {args.alpha})", check.levels[check.levels["imbalanced"]])
+    print(f"\nassignment check {'passed' if check.passed else 'FAILED'}")
+    return 0 if check.passed else 1
+
+
+def cmd_report(args):
+    from .reports import ArtifactStore, build_reports
+
+    store = ArtifactStore()
+    reports = build_reports(args.sources, args.output_dir, store, column=args.column, alpha=args.alpha,
+                            simulate=args.simulate, pdf=args.pdf, processes=args.processes)
+    for name, artifacts in reports.items():
+        rebuilt = [a.name for a in artifacts if not a.cached]
+        print(f"{name}: {len(artifacts) - len(rebuilt)} cached, rebuilt {', '.join(rebuilt) or 'nothing'}")
+    print(f"\n{store.hits} artifacts reused, {store.misses} built, summaries in {args.output_dir}/")
+    return 0
+
+
+def cmd_batch(args):
+    from .batch import run_batch
+
+    result = run_batch(args.manifest, args.output, args.parts_dir, args.processes,
+                       progress=None if args.quiet else sys.stderr)
+    print(f"{len(result.completed)} experiments run, {len(result.skipped)} already done, "
+          f"{len(result.failed)} failed; {len(result.results):,} result rows in {args.output}")
+    for experiment, error in result.failed.items():
+        print(f"  {experiment}: {error}")
+    return 1 if result.failed else 0
+
+
+def cmd_sample_size(args):
+    from .power_grid import proportion_effectsize, required_sample_size, sample_size
+
+    if len(args.p2) == 1 and not (args.plot or args.simulate):
+        nobs = required_sample_size(args.p1, args.p2[0], args.power, args.alpha, args.ratio,
+                                    args.alternative)
+        if nobs != nobs:
+            print(f"p1 -> p2 goes the other way than --alternative {args.alternative}, "
+                  f"no sample size can detect it", file=sys.stderr)
+            return 1
+        if nobs == float("inf"):
+            print("p1 == p2: there is no effect to detect, at any sample size", file=sys.stderr)
+            return 1
+        print(f"The required sample size is ~{round(nobs):,} in control "
+              f"and ~{round(nobs * args.ratio):,} in test")
+        return 0
+
+    import numpy as np
+
+    p2 = np.asarray(args.p2, dtype=np.float64)
+    nobs = sample_size(proportion_effectsize(args.p1, p2), args.power, args.alpha, args.ratio,
+                       args.alternative)
+    print(f"{'p2':>8} {'control':>12} {'test':>12}")
+    for rate, n in zip(p2, nobs):
+        if not np.isfinite(n):
+            # nan: effect against --alternative, inf: no effect
+            label = "-" if np.isnan(n) else "inf"
+            print(f"{rate:8.4f} {label:>12} {label:>12}")
+        else:
+            print(f"{rate:8.4f} {round(n):12,} {round(n * args.ratio):12,}")
+    if args.simulate:
+        from .power_simulation import simulated_sample_size
+
+        alternative = {"larger": "smaller", "smaller": "larger"}.get(args.alternative, args.alternative)
+        simulated = simulated_sample_size(args.p1, p2, args.power, args.alpha, args.ratio, alternative,
+                                          seed=args.seed, processes=args.processes)
+        _print_frame("Simulated Welch t-test", simulated)
+    if args.plot:
+        plt = _pyplot()
+        plt.plot(nobs, p2, label="Normal approximation")
+        if args.simulate:
+            plt.plot(simulated["nobs_control"], p2, "o--", label="Simulated Welch t-test")
+            plt.legend()
+        plt.title("Sample size vs Minimum Effect size")
+        plt.xlabel("Sample Size")
+        plt.ylabel("Minimum Test Conversion rate")
+        _save_figure(plt, args.plot)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m ab_testing",
+                                     description="A/B test analysis, randomization checks and planning.")
+    parser.add_argument("--profile", nargs="?", const=profiling.DEFAULT_OUTPUT, metavar="PATH",
+                        help=f"record stage timings and write a trace (default {profiling.DEFAULT_OUTPUT})")
+    commands = parser.add_subparsers(dest="command", required=True, metavar="command")
+
+    def data_command(name, func, help):
+        sub = commands.add_parser(name, help=help, description=help)
+        sub.add_argument("source", help="CSV path or URL (cached locally, see dataset_cache.py)")
+        sub.add_argument("--group-col", default="test")
+        sub.add_argument("--alpha", type=float, default=0.05)
+        sub.set_defaults(func=func)
+        return sub
+
+    sub = data_command("analyze", cmd_analyze, "Welch t-test of the metric between test and control.")
+    sub.add_argument("--metric-col", default="conversion")
+    sub.add_argument("--bootstrap", type=int, default=0, metavar="N",
+                     help="also bootstrap confidence intervals on the lift with N replicates")
+    sub.add_argument("--no-cache", action="store_true",
+                     help="stream the CSV in chunks instead of going through the local cache")
+    sub.add_argument("--chunksize", type=int, default=1_000_000)
+
+    sub = data_command("check-balance", cmd_check_balance,
+                       "Covariate balance between test and control, optionally with the tree check.")
+    sub.add_argument("--covariates", nargs="+", help="default: every randomization covariate present")
+    sub.add_argument("--min-smd", type=float, default=0.1)
+    sub.add_argument("--tree", action="store_true", help="fit the test-vs-control decision tree")
+    sub.add_argument("--plot", metavar="PNG", help="save the tree plot (implies --tree)")
+    sub.add_argument("--permutations", type=int, default=0, metavar="N",
+                     help="calibrate the tree with N label permutations")
+    sub.add_argument("--max-rows", type=int, help="fit on a stratified subsample of this size")
+    sub.add_argument("--processes", type=int)
+    sub.add_argument("--seed", type=int, default=0)
+    sub.add_argument("--strict", action="store_true", help="exit with status 1 if any level is imbalanced")
+
+    sub = data_command("correct-bias", cmd_correct_bias,
+                       "Oversample strata to the target group's proportions and re-test.")
+    sub.add_argument("--metric-col", default="conversion")
+    sub.add_argument("--column", default="country")
+    sub.add_argument("--strata", nargs="+", help="levels to rebalance (default: all)")
+    sub.add_argument("--target-group", type=int, default=1)
+    sub.add_argument("--donor-group", type=int, help="group to draw extra rows from (default: the target group)")
+    sub.add_argument("--seed", type=int, default=42)
+    sub.add_argument("--equal-var", action="store_true", help="Student instead of Welch t-test")
+    sub.add_argument("--bootstrap", type=int, default=0, metavar="N")
+    sub.add_argument("--rake", nargs="*", metavar="COVARIATE",
+                     help="also rake control weights to the target group's margins of these covariates "
+                          "(default: all randomization covariates) and run a weighted Welch test")
+    sub.add_argument("--interaction", nargs=2, action="append", metavar="COL",
+                     help="rake the crossing of two covariates too (repeatable)")
+    sub.add_argument("--max-weight", type=float, help="cap on the raking weights")
+
+    sub = data_command("srm", cmd_srm,
+                       "Replay an assignment log through the online sample-ratio-mismatch monitor.")
+    sub.set_defaults(alpha=0.001)
+    sub.add_argument("--covariates", nargs="+", help="default: every randomization covariate")
+    sub.add_argument("--expected-share", type=float, help="planned share of users in test")
+    sub.add_argument("--tau", type=float, default=0.05)
+    sub.add_argument("--block-size", type=int, default=1 << 22, help="bytes of CSV per batch")
+    sub.add_argument("--strict", action="store_true", help="exit with status 1 if anything is flagged")
+
+    sub = data_command("assign", cmd_assign,
+                       "Assign users to arms from a salted hash of their id (see assignment.py).")
+    sub.set_defaults(alpha=0.001)
+    sub.add_argument("--experiment", required=True, help="experiment name, salts the hash")
+    sub.add_argument("--splits", type=float, nargs="+", default=[0.5, 0.5],
+                     help="relative arm sizes, control first")
+    sub.add_argument("--user-col", default="user_id")
+    sub.add_argument("--strata", nargs="+", help="balance exactly within these columns' levels")
+    sub.add_argument("--output", metavar="CSV", help="write user id and arm")
+    sub.add_argument("--verify", action="store_true",
+                     help="run the SRM and balance checks on the result (exit status 1 if they fail)")
+    sub.add_argument("--covariates", nargs="+", help="default: every randomization covariate present")
+
+    sub = commands.add_parser("report", help="Summaries of one or many experiments, from cached artifacts.",
+                              description="Summaries of one or many experiments. Figures, tables and test "
+                                          "results are cached by a hash of their inputs (see reports.py), "
+                                          "so only what changed is rebuilt.")
+    sub.add_argument("sources", nargs="+", help="CSV paths or URLs, one per experiment")
+    sub.add_argument("--output-dir", default="reports")
+    sub.add_argument("--column", default="country", help="covariate whose imbalanced levels are corrected")
+    sub.add_argument("--alpha", type=float, default=0.05)
+    sub.add_argument("--simulate", action="store_true", help="add the simulated sample sizes to the chart")
+    sub.add_argument("--pdf", action="store_true", help="also write summary.pdf")
+    sub.add_argument("--processes", type=int, help="figure rendering workers")
+    sub.set_defaults(func=cmd_report)
+
+    sub = commands.add_parser("batch", help="Analyze every experiment and metric of a manifest.",
+                              description="Load, balance check, correction and Welch tests for every "
+                                          "experiment of a JSON or CSV manifest, on a process pool "
+                                          "(see batch.py). Re-running resumes an interrupted batch.")
+    sub.add_argument("manifest", help="JSON list of {experiment, source, metrics, ...} or CSV with those columns")
+    sub.add_argument("--output", default="batch_results.parquet")
+    sub.add_argument("--parts-dir", help="finished experiments, for resuming (default <output>.parts)")
+    sub.add_argument("--processes", type=int)
+    sub.add_argument("--quiet", action="store_true", help="no per-experiment progress lines")
+    sub.set_defaults(func=cmd_batch)
+
+    sub = commands.add_parser("sample-size", help="Required sample size to detect p1 -> p2.",
+                              description="Required sample size to detect p1 -> p2.")
+    sub.add_argument("--p1", type=float, required=True, help="baseline (control) conversion rate")
+    sub.add_argument("--p2", type=float, nargs="+", required=True,
+                     help="minimum test conversion rate(s) worth detecting")
+    sub.add_argument("--power", type=float, default=0.8)
+    sub.add_argument("--alpha", type=float, default=0.05)
+    sub.add_argument("--ratio", type=float, default=1.0, help="test group size / control group size")
+    sub.add_argument("--alternative", default="two-sided", choices=["two-sided", "larger", "smaller"],
+                     help="about p1 - p2, as in statsmodels: 'smaller' for an increase in test")
+    sub.add_argument("--plot", metavar="PNG", help="save sample size vs p2")
+    sub.add_argument("--simulate", action="store_true",
+                     help="also find the size by simulating the Welch t-test (see power_simulation.py)")
+    sub.add_argument("--seed", type=int, default=0)
+    sub.add_argument("--processes", type=int)
+    sub.set_defaults(func=cmd_sample_size)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "analyze" and args.bootstrap and args.no_cache:
+        parser.error("--bootstrap needs the cached table, drop --no-cache")
+    if args.profile:
+        profiling.enable(args.profile)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
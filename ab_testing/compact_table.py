@@ -0,0 +1,256 @@
+# Compact, bit-packed experiment table.
+#
+# `test` and `conversion` are 0/1 columns, but pandas keeps them as int64: 16
+# bytes per user for two bits of information, plus 8 more for an int64 user_id.
+# CompactTable stores
+#   - every 0/1 column as a packed bit array (uint64 words, 1 bit per user),
+#   - user_id as the narrowest unsigned type that holds it, or as nothing at all
+#     when the ids are a contiguous range (start + 0, 1, 2, ...),
+#   - covariates as uint8/uint16 codes plus their labels,
+# so test + conversion for a billion users take 250 MB instead of 16 GB.
+#
+# The binary metric makes the aggregations counts: with T the test bits, C the
+# conversion bits and M an optional row mask (e.g. "not Argentina/Uruguay"),
+#     n_test = popcount(T & M)       conversions_test = popcount(T & C & M)
+#     n_all  = popcount(M)           conversions_all  = popcount(C & M)
+# and control is the difference. For 0/1 values the sum of squares is the sum,
+# so that is everything Welch's test needs (streaming_ttest.welch_from_stats).
+# Words are AND-ed and counted chunk by chunk in cache-sized buffers, so these
+# aggregations run at memory bandwidth. Per-level statistics (segment tests,
+# balance checks) unpack one chunk of bits at a time next to the level codes.
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from .balance_check import RANDOMIZATION_COVARIATES, encode_column
+from .profiling import profiled
+from .segment_tests import SegmentStats
+from .streaming_ttest import welch_from_stats
+
+CHUNK_WORDS = 1 << 14  # 128 KB of uint64 words per operand, 1M rows
+CHUNK_ROWS = CHUNK_WORDS * 64
+
+IdRange = namedtuple("IdRange", ["start", "stop"])
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(words, out):
+        return int(np.bitwise_count(words, out=out).sum(dtype=np.int64))
+else:
+    # NumPy < 2.0: per-byte lookup table
+    _POPCOUNT8 = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+    def _popcount(words, out):
+        return int(_POPCOUNT8[words.view(np.uint8)].sum(dtype=np.int64))
+
+
+def pack_bits(values):
+    """Pack a 0/1 (or bool) array into uint64 words, row i at bit i % 64 of word i // 64."""
+    values = np.asarray(values)
+    packed = np.packbits(values.astype(bool, copy=False), bitorder="little")
+    padded = np.zeros(-(-len(packed) // 8) * 8, dtype=np.uint8)
+    padded[:len(packed)] = packed
+    return padded.view(np.uint64)
+
+
+def unpack_bits(words, start, stop):
+    """Rows [start, stop) of a packed column as a uint8 0/1 array (start a multiple of 64)."""
+    chunk = words[start // 64:-(-stop // 64)].view(np.uint8)
+    return np.unpackbits(chunk, count=stop - start, bitorder="little")
+
+
+def _narrow_codes(codes, n_levels):
+    return codes.astype(np.uint8 if n_levels <= 1 << 8 else np.uint16 if n_levels <= 1 << 16
+                        else np.uint32, copy=False)
+
+
+class _BitBuilder:
+    """Append 0/1 batches of any length; full 64-row words are packed as they come."""
+
+    def __init__(self):
+        self.words = []
+        self.pending = np.empty(0, dtype=bool)
+
+    def append(self, values):
+        values = np.concatenate([self.pending, np.asarray(values).astype(bool, copy=False)])
+        full = len(values) // 64 * 64
+        if full:
+            self.words.append(pack_bits(values[:full]))
+        self.pending = values[full:]
+
+    def finish(self):
+        if len(self.pending):
+            self.words.append(pack_bits(self.pending))
+        return np.concatenate(self.words) if self.words else np.empty(0, dtype=np.uint64)
+
+
+class CompactTable:
+    """Experiment table with bit-packed 0/1 columns, narrow user ids and small-int covariates.
+
+    bits: {column: packed uint64 words}. user_id: narrow unsigned array, an
+    IdRange, or None. codes / labels: {covariate: level codes} and
+    {covariate: level labels}.
+    """
+
+    def __init__(self, n, bits, user_id=None, codes=None, labels=None):
+        self.n = n
+        self.bits = bits
+        self.user_id = user_id
+        self.codes = codes or {}
+        self.labels = labels or {}
+
+    # -- building --------------------------------------------------------------
+
+    @classmethod
+    @profiled("compact_table.from_frame", rows=lambda cls, data, *a, **k: len(data))
+    def from_frame(cls, data, binary=("test", "conversion"), id_col="user_id", covariates=None):
+        """Build from a DataFrame. covariates default to the randomization ones present."""
+        return cls.from_batches([data], binary, id_col, covariates)
+
+    @classmethod
+    @profiled("compact_table.from_batches")
+    def from_batches(cls, batches, binary=("test", "conversion"), id_col="user_id", covariates=None):
+        """Build from an iterable of DataFrames or pyarrow RecordBatches, one batch at a time.
+
+        Only the compact form is kept, so the full int64 table never has to fit
+        in memory (e.g. DatasetCache.table(...).to_batches() or a CSV reader).
+        """
+        builders = {c: _BitBuilder() for c in binary}
+        id_chunks, id_start, id_next, contiguous = [], None, None, True
+        level_index, code_chunks = {}, {}
+        n = 0
+        for batch in batches:
+            if not isinstance(batch, pd.DataFrame):
+                batch = batch.to_pandas()
+            if covariates is None:
+                covariates = [c for c in RANDOMIZATION_COVARIATES if c in batch.columns]
+            for column, builder in builders.items():
+                builder.append(batch[column].to_numpy())
+            if id_col is not None and len(batch):
+                ids = batch[id_col].to_numpy()
+                if ids.dtype.kind not in "iu" or ids.min() < 0:
+                    raise ValueError(f"{id_col} must hold non-negative integers, pass id_col=None to drop it")
+                if contiguous:
+                    contiguous = (id_next is None or ids[0] == id_next) and bool((np.diff(ids) == 1).all())
+                    id_start = int(ids[0]) if id_start is None else id_start
+                    id_next = int(ids[-1]) + 1
+                id_chunks.append(ids.astype(np.min_scalar_type(ids.max()), copy=False))
+            for covariate in covariates:
+                codes, labels = encode_column(batch[covariate])
+                index = level_index.setdefault(covariate, {})
+                lookup = np.fromiter((index.setdefault(label, len(index)) for label in labels),
+                                     dtype=np.intp, count=len(labels))
+                # narrow from the start: concatenate() widens to the last dtype needed
+                code_chunks.setdefault(covariate, []).append(_narrow_codes(lookup[codes], len(index)))
+            n += len(batch)
+
+        bits = {c: builder.finish() for c, builder in builders.items()}
+        user_id = None
+        if id_chunks and contiguous:
+            user_id = IdRange(id_start, id_next)
+        elif id_chunks:
+            max_id = max(int(chunk.max()) for chunk in id_chunks)
+            user_id = np.concatenate(id_chunks).astype(np.min_scalar_type(max_id))
+        codes = {c: _narrow_codes(np.concatenate(chunks), len(level_index[c]))
+                 for c, chunks in code_chunks.items()}
+        labels = {c: np.array(list(level_index[c]), dtype=object) for c in code_chunks}
+        return cls(n, bits, user_id, codes, labels)
+
+    # -- storage -----------------------------------------------------------------
+
+    def memory_usage(self):
+        """Bytes per column."""
+        usage = {c: words.nbytes for c, words in self.bits.items()}
+        if self.user_id is not None:
+            usage["user_id"] = 0 if isinstance(self.user_id, IdRange) else self.user_id.nbytes
+        usage.update({c: codes.nbytes for c, codes in self.codes.items()})
+        return usage
+
+    @property
+    def nbytes(self):
+        return sum(self.memory_usage().values())
+
+    def user_ids(self):
+        if isinstance(self.user_id, IdRange):
+            return np.arange(self.user_id.start, self.user_id.stop)
+        return self.user_id
+
+    def column(self, name):
+        """One column in its usual form: 0/1 int8, user ids, or a Categorical."""
+        if name in self.bits:
+            return unpack_bits(self.bits[name], 0, self.n).view(np.int8)
+        if name == "user_id":
+            return self.user_ids()
+        return pd.Categorical.from_codes(self.codes[name].astype(np.int32), self.labels[name])
+
+    def to_frame(self, columns=None):
+        """DataFrame with 0/1 columns as int8 and covariates as categoricals."""
+        if columns is None:
+            columns = (["user_id"] if self.user_id is not None else []) + list(self.codes) + list(self.bits)
+        return pd.DataFrame({c: self.column(c) for c in columns})
+
+    # -- aggregations --------------------------------------------------------------
+
+    def level_mask(self, covariate, levels, exclude=False):
+        """Packed mask of the rows whose `covariate` is in `levels` (or not, with exclude)."""
+        wanted = np.isin(self.labels[covariate], list(levels)) != exclude
+        mask = _BitBuilder()
+        codes = self.codes[covariate]
+        for start in range(0, self.n, CHUNK_ROWS):
+            mask.append(wanted[codes[start:start + CHUNK_ROWS]])
+        return mask.finish()
+
+    def popcount(self, *columns, mask=None):
+        """Number of rows where every named bit column (and `mask`, if given) is 1."""
+        operands = [self.bits[c] for c in columns] + ([mask] if mask is not None else [])
+        if not operands:
+            return self.n
+        n_words = len(operands[0])
+        tmp = np.empty(min(CHUNK_WORDS, n_words), dtype=np.uint64)
+        counts = np.empty(len(tmp), dtype=np.uint8)
+        total = 0
+        for start in range(0, n_words, CHUNK_WORDS):
+            stop = min(start + CHUNK_WORDS, n_words)
+            words = tmp[:stop - start]
+            np.copyto(words, operands[0][start:stop])
+            for other in operands[1:]:
+                np.bitwise_and(words, other[start:stop], out=words)
+            total += _popcount(words, counts[:stop - start])
+        return total
+
+    @profiled("compact_table.group_stats")
+    def group_stats(self, metric="conversion", group="test", mask=None):
+        """(n, total, total_sq) of a 0/1 metric for [control, test], from four popcounts."""
+        n_all = self.popcount(mask=mask)
+        n_test = self.popcount(group, mask=mask)
+        total_all = self.popcount(metric, mask=mask)
+        total_test = self.popcount(group, metric, mask=mask)
+        n = np.array([n_all - n_test, n_test], dtype=np.float64)
+        total = np.array([total_all - total_test, total_test], dtype=np.float64)
+        return n, total, total
+
+    def conversion_rates(self, metric="conversion", group="test", mask=None):
+        n, total, _ = self.group_stats(metric, group, mask)
+        return total / n
+
+    def welch(self, metric="conversion", group="test", mask=None):
+        """Welch's t-test of the 0/1 metric between test and control (WelchResult)."""
+        return welch_from_stats(*self.group_stats(metric, group, mask))
+
+    @profiled("compact_table.segment_stats")
+    def segment_stats(self, covariate, metric="conversion", group="test"):
+        """segment_tests.SegmentStats per level of `covariate` (works with segment_tests.pooled)."""
+        codes = self.codes[covariate]
+        n_levels = len(self.labels[covariate])
+        cells = np.zeros(4 * n_levels, dtype=np.int64)
+        for start in range(0, self.n, CHUNK_ROWS):
+            stop = min(start + CHUNK_ROWS, self.n)
+            key = codes[start:stop].astype(np.intp) * 4
+            key += unpack_bits(self.bits[group], start, stop) * 2
+            key += unpack_bits(self.bits[metric], start, stop)
+            cells += np.bincount(key, minlength=4 * n_levels)
+        cells = cells.reshape(n_levels, 2, 2).astype(np.float64)  # level, group, metric
+        total = cells[:, :, 1]
+        return SegmentStats(pd.DataFrame({covariate: self.labels[covariate]}),
+                            cells.sum(axis=2), total, total.copy())
@@ -0,0 +1,264 @@
+# Local columnar cache for the experiment datasets.
+#
+# The scripts used to pd.read_csv a Google Drive URL on every run. Here the CSV
+# is fetched once, parsed once with typed columns (ingest.py: declared schema,
+# strings become categoricals, byte ranges parsed in parallel) and written as
+# an uncompressed Feather (Arrow IPC) file named after the SHA-256 of the raw
+# CSV bytes. Later runs memory-map that file, so the columns are a zero-copy
+# view of the page cache instead of a fresh download + parse.
+#
+# Invalidation:
+#   - local files are re-hashed only when their size or mtime change
+#   - URLs are trusted for `max_age` seconds, then revalidated with a conditional
+#     GET (ETag / Last-Modified). If the server returns new bytes with the same
+#     hash we keep the existing cache file.
+#   - every index entry records the FORMAT_VERSION of its Feather file; files
+#     written by an older version (other column types) are rebuilt on next use.
+# Eviction: least-recently-used cache files are removed once the cache is over
+# `max_bytes` in total.
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import urllib.request
+from urllib.error import HTTPError
+
+import pyarrow.feather as feather
+
+from .ingest import read_table
+from .profiling import profiled, stage
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ab_testing")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2 GB
+DEFAULT_MAX_AGE = 24 * 3600  # revalidate URLs once a day
+
+# bump whenever csv_to_feather writes different column types
+# (2: ingest.EXPERIMENT_SCHEMA, narrowed dictionaries)
+FORMAT_VERSION = 2
+
+_INDEX_FILE = "index.json"
+_CHUNK = 1 << 20
+
+
+def _is_url(source):
+    return source.startswith(("http://", "https://", "file://"))
+
+
+def _normalize(source):
+    source = os.fspath(source)
+    return source if _is_url(source) else os.path.abspath(source)
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_CHUNK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@profiled("dataset_cache.csv_to_feather")
+def csv_to_feather(csv_path, feather_path):
+    """Parse a CSV with typed columns and write it as an uncompressed Feather file."""
+    table = read_table(csv_path)
+    # uncompressed so the file can be memory-mapped without decoding
+    feather.write_feather(table, feather_path, compression="uncompressed")
+
+
+class DatasetCache:
+    """Content-addressed, size-bounded cache of CSV datasets stored as Feather files."""
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.cache_dir = cache_dir or os.environ.get("AB_TESTING_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._pinned = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    # -- public API --------------------------------------------------------
+
+    def table(self, source, columns=None):
+        """Return the dataset as a memory-mapped pyarrow Table (zero-copy)."""
+        with stage("dataset_cache.table") as s:
+            path = self.path(source)
+            table = feather.read_table(path, columns=columns, memory_map=True)
+            s.rows = table.num_rows
+        return table
+
+    def load(self, source, columns=None):
+        """Return the dataset as a pandas DataFrame backed by the cached file."""
+        table = self.table(source, columns)
+        with stage("dataset_cache.to_pandas", rows=table.num_rows):
+            # split_blocks avoids consolidating columns into 2D blocks, which would copy
+            return table.to_pandas(split_blocks=True)
+
+    def path(self, source):
+        """Make sure `source` is cached and return the path of its Feather file."""
+        source = _normalize(source)
+        index = self._read_index()
+        meta = index["sources"].get(source)
+        if meta is None or not self._is_fresh(source, meta, index):
+            meta = self._refresh(source, meta, index)
+        index["sources"][source] = meta
+        index["entries"][meta["hash"]]["last_used"] = time.time()
+        if self._pinned is not None:
+            self._pinned.add(meta["hash"])
+        self._evict(index, keep=meta["hash"])
+        self._write_index(index)
+        return self._feather_path(meta["hash"])
+
+    @contextlib.contextmanager
+    def pin(self):
+        """Within the block, no file returned by path() is evicted by this cache.
+
+        For work that resolves several sources up front and reads them later
+        (batch.py): the cache may go over max_bytes meanwhile, eviction catches
+        up on the first path() call after the block.
+        """
+        self._pinned = set()
+        try:
+            yield self
+        finally:
+            self._pinned = None
+
+    def invalidate(self, source):
+        """Forget `source`; its cache file is dropped if no other source shares it."""
+        index = self._read_index()
+        meta = index["sources"].pop(_normalize(source), None)
+        if meta is not None and not any(
+            m["hash"] == meta["hash"] for m in index["sources"].values()
+        ):
+            self._drop_entry(index, meta["hash"])
+        self._write_index(index)
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    # -- internals ---------------------------------------------------------
+
+    def _feather_path(self, content_hash):
+        return os.path.join(self.cache_dir, content_hash + ".feather")
+
+    def _is_current(self, index, content_hash):
+        entry = index["entries"].get(content_hash)
+        return (entry is not None and entry.get("format") == FORMAT_VERSION
+                and os.path.exists(self._feather_path(content_hash)))
+
+    def _is_fresh(self, source, meta, index):
+        if not self._is_current(index, meta["hash"]):
+            return False
+        if _is_url(source):
+            return time.time() - meta["checked_at"] < self.max_age
+        try:
+            st = os.stat(source)
+        except FileNotFoundError:
+            # source went away, the cached copy is all we have
+            return True
+        return st.st_size == meta["size"] and st.st_mtime_ns == meta["mtime_ns"]
+
+    def _refresh(self, source, meta, index):
+        with tempfile.TemporaryDirectory(dir=self.cache_dir) as tmp:
+            if _is_url(source):
+                # an outdated file needs the bytes again, so no conditional GET
+                cached = meta if meta and self._is_current(index, meta["hash"]) else None
+                new_meta = self._download(source, cached, os.path.join(tmp, "data.csv"))
+                if new_meta is None:
+                    # 304 Not Modified: keep the cached file, just restart the clock
+                    return dict(meta, checked_at=time.time())
+                csv_path = os.path.join(tmp, "data.csv")
+            else:
+                st = os.stat(source)
+                new_meta = {
+                    "hash": _hash_file(source),
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                }
+                csv_path = source
+
+            content_hash = new_meta["hash"]
+            target = self._feather_path(content_hash)
+            if not self._is_current(index, content_hash):
+                tmp_target = os.path.join(tmp, "data.feather")
+                csv_to_feather(csv_path, tmp_target)
+                os.replace(tmp_target, target)
+                index["entries"][content_hash] = {
+                    "bytes": os.path.getsize(target),
+                    "last_used": time.time(),
+                    "format": FORMAT_VERSION,
+                }
+        new_meta["checked_at"] = time.time()
+        return new_meta
+
+    @profiled("dataset_cache.download")
+    def _download(self, url, meta, dest):
+        """Fetch `url` into `dest` while hashing it. Returns None on 304 Not Modified."""
+        request = urllib.request.Request(url)
+        if meta is not None:
+            if meta.get("etag"):
+                request.add_header("If-None-Match", meta["etag"])
+            if meta.get("last_modified"):
+                request.add_header("If-Modified-Since", meta["last_modified"])
+        digest = hashlib.sha256()
+        try:
+            with urllib.request.urlopen(request) as response, open(dest, "wb") as out:
+                for block in iter(lambda: response.read(_CHUNK), b""):
+                    digest.update(block)
+                    out.write(block)
+                headers = response.headers
+        except HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+        return {
+            "hash": digest.hexdigest(),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+        }
+
+    def _evict(self, index, keep):
+        entries = index["entries"]
+        total = sum(e["bytes"] for e in entries.values())
+        for content_hash in sorted(entries, key=lambda h: entries[h]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if content_hash == keep or content_hash in (self._pinned or ()):
+                continue
+            total -= entries[content_hash]["bytes"]
+            self._drop_entry(index, content_hash)
+
+    def _drop_entry(self, index, content_hash):
+        index["entries"].pop(content_hash, None)
+        for source in [s for s, m in index["sources"].items() if m["hash"] == content_hash]:
+            del index["sources"][source]
+        try:
+            os.remove(self._feather_path(content_hash))
+        except FileNotFoundError:
+            pass
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, _INDEX_FILE)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"sources": {}, "entries": {}}
+
+    def _write_index(self, index):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, os.path.join(self.cache_dir, _INDEX_FILE))
+
+
+def load_dataset(source, columns=None, **kwargs):
+    """Load a CSV path or URL through the default DatasetCache as a DataFrame."""
+    return DatasetCache(**kwargs).load(source, columns=columns)
+
+
+def load_table(source, columns=None, **kwargs):
+    """Load a CSV path or URL through the default DatasetCache as a pyarrow Table."""
+    return DatasetCache(**kwargs).table(source, columns=columns)
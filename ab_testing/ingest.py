@@ -0,0 +1,155 @@
+# Typed, projected and parallel CSV ingestion.
+#
+# pd.read_csv infers every column's type from its text, parses all columns
+# whether the caller needs them or not, keeps strings as Python objects and runs
+# on one core. For the experiment tables the types are known up front, so
+# EXPERIMENT_SCHEMA declares them:
+#   - covariates (source, device, country, ...) as dictionary-encoded strings,
+#     i.e. pandas categoricals with int8 codes and each label stored once,
+#   - the test / conversion flags as int8 0/1 (not bool, so arithmetic on them
+#     keeps working), age as int16, user_id as int64.
+# Other columns are inferred, with strings dictionary-encoded as well.
+#
+# read_table() converts only `columns`; the others are skipped by the tokenizer
+# and never materialized. Large files are cut into byte ranges of about
+# `chunk_bytes` at line ends and parsed by a process pool, one range per task,
+# each with the header's column names and the same column types (so every chunk
+# agrees on the schema). The chunks come back as Arrow tables and are
+# concatenated without copying; their dictionaries are unified and narrowed, so
+# the result is one typed table, ready for Feather (dataset_cache.py) or pandas.
+#
+# Cutting at line ends assumes no quoted field spans several lines, which holds
+# for the experiment tables.
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+from .profiling import stage
+
+# the CSV reader only builds int32 dictionary indices, narrowed after the merge
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+EXPERIMENT_SCHEMA = {
+    "user_id": pa.int64(),
+    "source": CATEGORY,
+    "device": CATEGORY,
+    "browser_language": CATEGORY,
+    "browser": CATEGORY,
+    "sex": CATEGORY,
+    "age": pa.int16(),
+    "country": CATEGORY,
+    "test": pa.int8(),
+    "conversion": pa.int8(),
+}
+
+DEFAULT_CHUNK_BYTES = 64 << 20
+_SAMPLE_BYTES = 1 << 20
+
+
+def read_header(path):
+    """Column names of a CSV file."""
+    with open(path, "rb") as f:
+        header = f.readline()
+    return pacsv.read_csv(pa.BufferReader(header)).column_names
+
+
+def byte_ranges(path, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """(start, stop) offsets of the data rows of `path`, cut at line ends about every chunk_bytes."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        f.readline()
+        starts = [f.tell()]
+        while starts[-1] + chunk_bytes < size:
+            f.seek(starts[-1] + chunk_bytes)
+            f.readline()  # finish the line the cut fell in
+            if f.tell() >= size:
+                break
+            starts.append(f.tell())
+    return [(start, stop) for start, stop in zip(starts, starts[1:] + [size]) if stop > start]
+
+
+def _read_range(path, start, stop, names, convert_options, use_threads=False):
+    read_options = pacsv.ReadOptions(column_names=names, use_threads=use_threads)
+    # a zero-copy slice of the mapped file, not a private copy of the range
+    with pa.memory_map(path) as source:
+        source.seek(start)
+        data = source.read_buffer(stop - start)
+        return pacsv.read_csv(pa.BufferReader(data), read_options=read_options,
+                              convert_options=convert_options)
+
+
+def _column_types(path, names, columns, schema, first_range):
+    """Declared types, plus CATEGORY for the string columns of a sample of the first rows."""
+    types = {c: t for c, t in schema.items() if c in columns}
+    undeclared = [c for c in columns if c not in types]
+    if undeclared and first_range is not None:
+        start, stop = first_range
+        with open(path, "rb") as f:
+            f.seek(start)
+            sample = f.read(min(stop - start, _SAMPLE_BYTES))
+        sample = sample[:sample.rfind(b"\n") + 1] or sample
+        inferred = pacsv.read_csv(pa.BufferReader(sample),
+                                  read_options=pacsv.ReadOptions(column_names=names),
+                                  convert_options=pacsv.ConvertOptions(include_columns=undeclared))
+        for field in inferred.schema:
+            if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+                types[field.name] = CATEGORY
+    return types
+
+
+def _narrow_dictionaries(table):
+    table = table.unify_dictionaries()
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            column = table.column(i)
+            levels = len(column.chunk(0).dictionary) if column.num_chunks else 0
+            index = pa.int8() if levels < 1 << 7 else pa.int16() if levels < 1 << 15 else pa.int32()
+            table = table.set_column(i, field.name, column.cast(pa.dictionary(index, field.type.value_type)))
+    return table
+
+
+def read_table(path, columns=None, schema=None, processes=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Parse a local CSV file into a typed pyarrow Table.
+
+    columns: the columns to keep (default all), in that order. schema:
+    {column: pyarrow type} for declared columns (default EXPERIMENT_SCHEMA).
+    processes: worker processes for the byte ranges (default one per CPU);
+    files of a single range, or processes=1, are parsed in this process with
+    the reader's own threads.
+    """
+    schema = EXPERIMENT_SCHEMA if schema is None else schema
+    names = read_header(path)
+    columns = list(names if columns is None else columns)
+    missing = [c for c in columns if c not in names]
+    if missing:
+        raise ValueError(f"{path} has no columns {missing}")
+
+    ranges = byte_ranges(path, chunk_bytes)
+    types = _column_types(path, names, columns, schema, ranges[0] if ranges else None)
+    convert_options = pacsv.ConvertOptions(column_types=types, include_columns=columns)
+    processes = processes or os.cpu_count() or 1
+    with stage("ingest.read_table") as s:
+        if not ranges:
+            tables = [pacsv.read_csv(path, convert_options=convert_options)]
+        elif processes == 1 or len(ranges) == 1:
+            tables = [_read_range(path, start, stop, names, convert_options, use_threads=True)
+                      for start, stop in ranges]
+        else:
+            with ProcessPoolExecutor(max_workers=min(processes, len(ranges))) as pool:
+                futures = [pool.submit(_read_range, path, start, stop, names, convert_options)
+                           for start, stop in ranges]
+                tables = [future.result() for future in futures]
+        # chunks may infer different numeric types for undeclared columns (int64 vs double)
+        table = _narrow_dictionaries(pa.concat_tables(tables, promote_options="permissive"))
+        s.rows = table.num_rows
+    return table
+
+
+def read_frame(path, columns=None, schema=None, processes=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """read_table() as a pandas DataFrame (covariates as categoricals)."""
+    table = read_table(path, columns, schema, processes, chunk_bytes)
+    with stage("ingest.to_pandas", rows=table.num_rows):
+        return table.to_pandas(split_blocks=True)
@@ -0,0 +1,185 @@
+# Vectorized sample size / power for comparing two proportions.
+#
+# sample_size_calculation.py called statsmodels' NormalIndPower().solve_power in
+# a Python loop, which runs a numerical root finder per point. For the normal
+# approximation that is not needed: with Cohen's h effect size
+#     h = 2 * arcsin(sqrt(p2)) - 2 * arcsin(sqrt(p1))
+# the required effective sample size is ((z_{1-alpha/2} + z_{power}) / h)^2.
+# That ignores the (tiny) probability of rejecting in the wrong tail, which
+# solve_power does include, so we finish with a few vectorized Newton steps on
+# the exact power function. Everything broadcasts, so a grid over
+# baseline x MDE x power x alpha x allocation ratio is a handful of array ops.
+#
+# `python -m ab_testing sample-size` should answer in a blink, so this module
+# only imports numpy up front. The array functions use scipy.special (the same
+# normal cdf/quantile as scipy.stats.norm for a fraction of the import time),
+# imported on first use, and single memoized queries go through the standard
+# library's NormalDist and never touch scipy at all.
+
+import math
+from functools import lru_cache
+from statistics import NormalDist
+
+import numpy as np
+
+from .profiling import profiled
+
+GRID_AXES = ["baseline", "mde", "power", "alpha", "ratio"]
+
+
+def proportion_effectsize(p1, p2):
+    """Cohen's h, same as statsmodels.stats.api.proportion_effectsize (vectorized)."""
+    return 2 * np.arcsin(np.sqrt(p1)) - 2 * np.arcsin(np.sqrt(p2))
+
+
+def _tail_alpha(alpha, alternative):
+    if alternative == "two-sided":
+        return alpha / 2
+    if alternative in ("larger", "smaller"):
+        return alpha
+    raise ValueError(f"alternative must be 'two-sided', 'larger' or 'smaller', got {alternative!r}")
+
+
+def power(effect_size, nobs1, alpha=0.05, ratio=1, alternative="two-sided"):
+    """Power of the two-sample z-test, as NormalIndPower().power (vectorized).
+
+    nobs1 is the size of the first group, the second has nobs1 * ratio users.
+    """
+    from scipy.special import ndtr, ndtri
+
+    d = np.asarray(effect_size, dtype=np.float64)
+    nobs = 1 / (1 / np.asarray(nobs1, dtype=np.float64) + 1 / (np.asarray(nobs1) * ratio))
+    crit = -ndtri(_tail_alpha(np.asarray(alpha, dtype=np.float64), alternative))
+    shift = d * np.sqrt(nobs)
+    if alternative == "two-sided":
+        return ndtr(shift - crit) + ndtr(-crit - shift)
+    if alternative == "larger":
+        return ndtr(shift - crit)
+    return ndtr(-crit - shift)
+
+
+def sample_size(effect_size, power=0.8, alpha=0.05, ratio=1, alternative="two-sided",
+                newton_steps=3):
+    """Size of the first group, as NormalIndPower().solve_power(effect_size, power=, alpha=, ratio=).
+
+    All arguments broadcast against each other. One-sided alternatives give nan
+    where the effect points the other way, as solve_power does.
+    """
+    from scipy.special import ndtr, ndtri
+
+    d = np.abs(np.asarray(effect_size, dtype=np.float64))
+    if alternative == "smaller":
+        d = -np.asarray(effect_size, dtype=np.float64)
+    elif alternative == "larger":
+        d = np.asarray(effect_size, dtype=np.float64)
+    target = np.asarray(power, dtype=np.float64)
+    ratio = np.asarray(ratio, dtype=np.float64)
+    crit = -ndtri(_tail_alpha(np.asarray(alpha, dtype=np.float64), alternative))
+    inflate = 1 + 1 / ratio  # nobs1 = effective nobs * (1 + 1 / ratio)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # closed form, single tail
+        nobs = ((crit + ndtri(target)) / d) ** 2
+        if alternative == "two-sided":
+            # Newton on the exact two-tailed power in terms of s = sqrt(effective nobs)
+            s = np.sqrt(nobs)
+            for _ in range(newton_steps):
+                upper = crit - d * s
+                lower = -crit - d * s
+                value = ndtr(-upper) + ndtr(lower) - target
+                slope = d * (_pdf(upper) - _pdf(lower))
+                s = s - value / slope
+            nobs = s ** 2
+        else:
+            nobs = np.where(d < 0, np.nan, nobs)
+        # no effect: no sample is large enough (Newton would give 0 * inf = nan)
+        nobs = np.where(d == 0, np.inf, nobs)
+    return nobs * inflate
+
+
+def _pdf(x):
+    return np.exp(-0.5 * x * x) / math.sqrt(2 * math.pi)
+
+
+def _scalar_sample_size(d, power, alpha, ratio, alternative, newton_steps=3):
+    # sample_size for one point with the standard library only, same steps
+    normal = NormalDist()
+    crit = -normal.inv_cdf(_tail_alpha(alpha, alternative))
+    if alternative == "two-sided":
+        d = abs(d)
+    elif alternative == "smaller":
+        d = -d
+    if d < 0:
+        return math.nan  # effect in the direction the one-sided test does not look at
+    if d == 0:
+        return math.inf
+    s = abs(crit + normal.inv_cdf(power)) / abs(d)
+    if alternative == "two-sided":
+        for _ in range(newton_steps):
+            upper = crit - d * s
+            lower = -crit - d * s
+            value = normal.cdf(-upper) + normal.cdf(lower) - power
+            slope = d * (normal.pdf(upper) - normal.pdf(lower))
+            s = s - value / slope
+    return s * s * (1 + 1 / ratio)
+
+
+@profiled("power_grid.sample_size_grid")
+def sample_size_grid(baseline, mde, power=0.8, alpha=0.05, ratio=1, relative=False,
+                     alternative="two-sided"):
+    """Required size of the control group over the full grid of inputs.
+
+    Each argument is a scalar or 1-D array; the result has one axis per argument
+    in GRID_AXES order (baseline, mde, power, alpha, ratio). The test group
+    rate is baseline + mde, or baseline * (1 + mde) when relative=True. The test
+    group needs ratio times as many users. As in statsmodels, a one-sided
+    alternative is about baseline - test ("smaller" for an increase); cells
+    with the effect the other way are nan.
+    """
+    axes = [np.atleast_1d(np.asarray(a, dtype=np.float64)) for a in (baseline, mde, power, alpha, ratio)]
+    shaped = [a.reshape([-1 if i == j else 1 for j in range(len(axes))]) for i, a in enumerate(axes)]
+    p1, lift, pw, a, r = shaped
+    p2 = p1 * (1 + lift) if relative else p1 + lift
+    return sample_size(proportion_effectsize(p1, p2), power=pw, alpha=a, ratio=r,
+                       alternative=alternative)
+
+
+def sample_size_table(baseline, mde, power=0.8, alpha=0.05, ratio=1, relative=False,
+                      alternative="two-sided"):
+    """sample_size_grid as a long DataFrame, one row per cell."""
+    import pandas as pd
+
+    values = [np.atleast_1d(np.asarray(a, dtype=np.float64)) for a in (baseline, mde, power, alpha, ratio)]
+    grid = sample_size_grid(*values, relative=relative, alternative=alternative)
+    index = pd.MultiIndex.from_product(values, names=GRID_AXES)
+    table = index.to_frame(index=False)
+    table["nobs_control"] = grid.ravel()
+    table["nobs_test"] = table["nobs_control"] * table["ratio"]
+    return table
+
+
+@lru_cache(maxsize=4096)
+def _cached_sample_size(p1, p2, power, alpha, ratio, alternative):
+    d = 2 * math.asin(math.sqrt(p1)) - 2 * math.asin(math.sqrt(p2))
+    return _scalar_sample_size(d, power, alpha, ratio, alternative)
+
+
+def required_sample_size(p1, p2, power=0.8, alpha=0.05, ratio=1, alternative="two-sided"):
+    """Memoized single query: control group size to detect p1 -> p2."""
+    return _cached_sample_size(float(p1), float(p2), float(power), float(alpha),
+                               float(ratio), alternative)
+
+
+@lru_cache(maxsize=64)
+def _cached_grid(baseline, mde, power, alpha, ratio, relative, alternative):
+    grid = sample_size_grid(baseline, mde, power, alpha, ratio, relative, alternative)
+    grid.setflags(write=False)
+    return grid
+
+
+def cached_sample_size_grid(baseline, mde, power=0.8, alpha=0.05, ratio=1, relative=False,
+                            alternative="two-sided"):
+    """sample_size_grid memoized on its inputs; the returned array is read-only."""
+    key = [tuple(np.atleast_1d(np.asarray(a, dtype=np.float64)).tolist())
+           for a in (baseline, mde, power, alpha, ratio)]
+    return _cached_grid(*key, relative, alternative)
@@ -0,0 +1,153 @@
+# Monte Carlo power of the Welch test, for comparing two conversion rates.
+#
+# power_grid.py (like NormalIndPower) uses the normal approximation of a z-test
+# with equal group sizes in mind. That is off at low baselines (a 1% rate is far
+# from normal at a few thousand users), with unequal splits like the 46/54 one
+# in check_randomization.py, and it is not the test we run anyway: the analysis
+# uses Welch's t-test. Here we simulate the experiment instead.
+#
+# A 0/1 metric is summarized by n and the number of conversions per group (the
+# sum of squares is the sum), so one simulated experiment is two binomial draws,
+# and thousands of them are two (points, simulations) arrays fed to
+# streaming_ttest.welch_arrays: the exact statistic we compute on real data.
+# Simulations run in chunks, each with its own seed spawned from one
+# SeedSequence, on a process pool (results do not depend on the pool size).
+# They run in rounds, and a point stops once the Wilson interval of its
+# estimated power is within `tolerance`, so cheap points (power near 0 or 1)
+# stop early and the budget goes where the estimate is noisy.
+
+import math
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+from scipy import special, stats
+
+from .power_grid import power as analytic_power, proportion_effectsize, sample_size
+from .profiling import profiled
+from .streaming_ttest import welch_arrays
+
+
+def rejections(seed, rates, nobs, n_simulations, alpha=0.05, alternative="two-sided"):
+    """Number of rejections out of n_simulations experiments, at every point.
+
+    rates, nobs: (points, 2) arrays of [control, test] conversion rates and
+    group sizes. alternative is about the test group: "larger" rejects when its
+    rate is significantly higher, "smaller" when it is lower.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (len(rates), n_simulations, 2)
+    n = np.broadcast_to(nobs[:, None, :], shape)
+    conversions = rng.binomial(n, np.broadcast_to(rates[:, None, :], shape))
+    statistic, pvalue, df, _, _ = welch_arrays(n, conversions, conversions)
+    if alternative == "larger":
+        pvalue = stats.t.sf(statistic, df)
+    elif alternative == "smaller":
+        pvalue = stats.t.cdf(statistic, df)
+    elif alternative != "two-sided":
+        raise ValueError(f"alternative must be 'two-sided', 'larger' or 'smaller', got {alternative!r}")
+    # same rule as streaming_ttest.verdict; undefined tests (no conversions at all) don't reject
+    return (pvalue <= alpha).sum(axis=1)
+
+
+def wilson_interval(successes, trials, confidence=0.95):
+    """Wilson score interval for a binomial proportion (vectorized)."""
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    successes = np.asarray(successes, dtype=np.float64)
+    trials = np.asarray(trials, dtype=np.float64)
+    estimate = successes / trials
+    center = (estimate + z * z / (2 * trials)) / (1 + z * z / trials)
+    half = z * np.sqrt(estimate * (1 - estimate) / trials + z * z / (4 * trials * trials)) / (1 + z * z / trials)
+    return center - half, center + half
+
+
+@profiled("power_simulation.simulate_power")
+def simulate_power(p1, p2, nobs1, ratio=1, alpha=0.05, alternative="two-sided",
+                   tolerance=0.005, max_simulations=100_000, round_size=5000,
+                   chunk_size=1000, confidence=0.95, seed=0, processes=None):
+    """Simulated power of Welch's t-test, p1 (control) vs p2 (test).
+
+    p1, p2, nobs1 (control size) and ratio (test size / control size) broadcast
+    against each other; there is one row per point in the returned DataFrame.
+    Each point gets `round_size` more simulations per round until the
+    `confidence` Wilson interval of its power is at most `tolerance` wide on each
+    side, or it reached `max_simulations`. Rounds are split in chunks of
+    `chunk_size` simulations run on a process pool (processes=1 runs in this
+    process). `analytic_power` is power_grid's normal approximation.
+    """
+    p1, p2, nobs1, ratio = (a.ravel() for a in np.broadcast_arrays(
+        *(np.asarray(a, dtype=np.float64) for a in (p1, p2, nobs1, ratio))))
+    rates = np.stack([p1, p2], axis=-1)
+    nobs = np.stack([np.ceil(nobs1), np.ceil(nobs1 * ratio)], axis=-1).astype(np.int64)
+
+    rejected = np.zeros(len(rates), dtype=np.int64)
+    simulated = np.zeros(len(rates), dtype=np.int64)
+    active = np.arange(len(rates))
+    seeds = np.random.SeedSequence(seed)
+    chunks = [chunk_size] * (round_size // chunk_size)
+    if round_size % chunk_size:
+        chunks.append(round_size % chunk_size)
+    pool = ProcessPoolExecutor(max_workers=processes) if processes != 1 else None
+    try:
+        while active.size:
+            tasks = [(s, rates[active], nobs[active], size, alpha, alternative)
+                     for s, size in zip(seeds.spawn(len(chunks)), chunks)]
+            results = pool.map(rejections, *zip(*tasks)) if pool else (rejections(*t) for t in tasks)
+            for counts in results:
+                rejected[active] += counts
+            simulated[active] += round_size
+            low, high = wilson_interval(rejected[active], simulated[active], confidence)
+            estimate = rejected[active] / simulated[active]
+            precise = np.maximum(high - estimate, estimate - low) <= tolerance
+            active = active[~precise & (simulated[active] < max_simulations)]
+    finally:
+        if pool:
+            pool.shutdown()
+
+    low, high = wilson_interval(rejected, simulated, confidence)
+    analytic_alternative = {"larger": "smaller", "smaller": "larger"}.get(alternative, alternative)
+    return pd.DataFrame({
+        "p1": p1, "p2": p2, "nobs_control": nobs[:, 0], "nobs_test": nobs[:, 1],
+        "power": rejected / simulated, "ci_low": low, "ci_high": high,
+        "simulations": simulated,
+        # proportion_effectsize is p1 vs p2, so statsmodels' "larger" is our "smaller"
+        "analytic_power": analytic_power(proportion_effectsize(p1, p2), nobs[:, 0], alpha,
+                                         nobs[:, 1] / nobs[:, 0], analytic_alternative),
+    })
+
+
+def simulated_sample_size(p1, p2, power=0.8, alpha=0.05, ratio=1, alternative="two-sided",
+                          span=(0.7, 1.4), n_sizes=8, **kwargs):
+    """Control group size at which the simulated Welch test reaches `power`.
+
+    For every p2, power is simulated at n_sizes control sizes spanning `span`
+    times the normal-approximation answer, all in one simulate_power call. Under
+    the normal approximation probit(power) is linear in sqrt(n), so a weighted
+    least-squares line through the simulated points is solved for the target.
+    kwargs go to simulate_power. Returns one row per p2 with the simulated and
+    the analytic size.
+    """
+    p2 = np.atleast_1d(np.asarray(p2, dtype=np.float64))
+    analytic_alternative = {"larger": "smaller", "smaller": "larger"}.get(alternative, alternative)
+    analytic = np.broadcast_to(sample_size(proportion_effectsize(p1, p2), power, alpha, ratio,
+                                           analytic_alternative), p2.shape)
+    factors = np.geomspace(span[0], span[1], n_sizes)
+    sizes = analytic[:, None] * factors
+    grid = simulate_power(p1, p2[:, None], sizes, ratio, alpha, alternative, **kwargs)
+
+    simulated_power = grid["power"].to_numpy().reshape(sizes.shape)
+    trials = grid["simulations"].to_numpy().reshape(sizes.shape)
+    clipped = np.clip(simulated_power, 0.5 / trials, 1 - 0.5 / trials)
+    probit = special.ndtri(clipped)
+    # inverse variance of the probit estimate, from the delta method
+    weight = trials * np.exp(-probit ** 2) / (2 * math.pi) / (clipped * (1 - clipped))
+    root = np.sqrt(grid["nobs_control"].to_numpy().reshape(sizes.shape))
+    nobs = np.empty(len(p2))
+    for i in range(len(p2)):
+        slope, intercept = np.polyfit(root[i], probit[i], 1, w=np.sqrt(weight[i]))
+        nobs[i] = ((special.ndtri(power) - intercept) / slope) ** 2
+    return pd.DataFrame({"p1": np.broadcast_to(p1, p2.shape), "p2": p2,
+                         "nobs_control": nobs, "nobs_test": nobs * ratio,
+                         "analytic_nobs_control": analytic,
+                         "simulations": trials.sum(axis=1)})
@@ -0,0 +1,317 @@
+# Stage-level instrumentation for the analysis scripts.
+#
+# When a run is slow we want to know where the time goes: the CSV download, the
+# feature encoding, the tree fit, the plot... Each of those is wrapped in a named
+# stage that records wall time, CPU time, peak RSS and row count.
+#
+# Off by default. Turn it on with
+#     AB_TESTING_PROFILE=profile.json python check_randomization.py
+# (AB_TESTING_PROFILE=1 writes ab_testing_profile.json) or call enable(path).
+# At exit the stages are written in Chrome trace-event format, which loads in
+# chrome://tracing, Perfetto (ui.perfetto.dev) or speedscope, and a summary
+# table is printed to stderr.
+#
+# When profiling is off, stage() returns a shared no-op object and @profiled
+# functions cost one flag check, so the hooks can stay in the code.
+#
+# Process pools: stages run in a worker are recorded in the worker. Submit the
+# task with submit_recorded() / map_recorded() instead of pool.submit() /
+# pool.map() and the worker sends its records back with the result, merged into
+# this process's trace (one trace "process" per worker pid). The stages of
+# tasks submitted to a pool directly are lost.
+
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+ENV_VAR = "AB_TESTING_PROFILE"
+DEFAULT_OUTPUT = "ab_testing_profile.json"
+
+_state = {"enabled": False, "output": None, "records": [], "active": set(), "sampler": None,
+          "atexit": False}
+_lock = threading.Lock()
+
+
+def _after_fork():
+    # a forked worker starts with a fresh lock (the sampler may have held it
+    # during the fork) and no sampler thread, stages or records of its own
+    global _lock
+    _lock = threading.Lock()
+    _state.update(records=[], active=set(), sampler=None)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def rss_bytes():
+    """Current resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        # ru_maxrss is KB on Linux, bytes on macOS; only the lifetime peak is known
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class PeakRSS:
+    """Sample the process RSS in a background thread while the block runs."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+    def __enter__(self):
+        self.start = self.peak = rss_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+
+class _Sampler(threading.Thread):
+    """One background thread updating the peak RSS of every open stage."""
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            rss = rss_bytes()
+            with _lock:
+                for open_stage in _state["active"]:
+                    open_stage.peak = max(open_stage.peak, rss)
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+
+class _Stage:
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self.start = self.peak = rss_bytes()
+        with _lock:
+            _state["active"].add(self)
+        self.ts = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.ts
+        cpu = time.process_time() - self.cpu
+        end = rss_bytes()
+        with _lock:
+            _state["active"].discard(self)
+            _state["records"].append({
+                "stage": self.name,
+                "start_s": self.ts,
+                "wall_s": wall,
+                "cpu_s": cpu,
+                "peak_rss_mb": max(self.peak, end) / 2 ** 20,
+                "delta_rss_mb": (max(self.peak, end) - self.start) / 2 ** 20,
+                "rows": self.rows,
+                "pid": os.getpid(),
+                "thread": threading.get_ident(),
+                "error": exc_type.__name__ if exc_type else None,
+            })
+        return False
+
+
+class _NullStage:
+    """Stand-in for _Stage when profiling is off. Attribute writes are dropped."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def enabled():
+    return _state["enabled"]
+
+
+def enable(output=DEFAULT_OUTPUT, interval=0.005):
+    """Start recording stages; the trace is written to `output` at exit (None: don't write)."""
+    if not _state["enabled"]:
+        _state["records"] = []
+    _state.update(enabled=True, output=output)
+    _start_sampler(interval)
+    if not _state["atexit"]:
+        atexit.register(_at_exit)
+        _state["atexit"] = True
+
+
+def _start_sampler(interval=0.005):
+    if _state["sampler"] is None:
+        _state["sampler"] = _Sampler(interval)
+        _state["sampler"].start()
+
+
+def disable():
+    """Stop recording (and the RSS sampler); recorded stages are kept."""
+    _state["enabled"] = False
+    sampler, _state["sampler"] = _state["sampler"], None
+    if sampler is not None:
+        sampler.stop()
+
+
+def stage(name, rows=None):
+    """Context manager timing a named stage. Set `.rows` on it to record a row count."""
+    if not _state["enabled"]:
+        return _NULL_STAGE
+    return _Stage(name, rows)
+
+
+def profiled(name=None, rows=None):
+    """Decorator recording every call of a function as a stage.
+
+    rows: optional callable taking the function's arguments and returning the
+    row count to record, e.g. rows=lambda data, *args, **kwargs: len(data).
+    """
+    def decorate(func):
+        stage_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state["enabled"]:
+                return func(*args, **kwargs)
+            with _Stage(stage_name, rows(*args, **kwargs) if rows else None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _call_recorded(enabled, func, args, kwargs):
+    # worker side of submit_recorded: the result and the stages of this call
+    if not enabled:
+        return func(*args, **kwargs), []
+    # record here, the parent writes the trace
+    _state["enabled"] = True
+    _start_sampler()
+    with _lock:
+        start = len(_state["records"])
+    value = func(*args, **kwargs)
+    with _lock:
+        return value, _state["records"][start:]
+
+
+def merge(stage_records):
+    """Add stages recorded elsewhere (e.g. in a worker process) to this trace."""
+    with _lock:
+        _state["records"].extend(stage_records)
+
+
+def submit_recorded(pool, func, *args, **kwargs):
+    """pool.submit(func, ...) that also brings back the stages recorded in the worker.
+
+    Get the result with recorded_result(future), which merges those stages into
+    this process's records.
+    """
+    return pool.submit(_call_recorded, _state["enabled"], func, args, kwargs)
+
+
+def recorded_result(future):
+    """Result of a submit_recorded() future; its stages join this process's records."""
+    value, stage_records = future.result()
+    merge(stage_records)
+    return value
+
+
+def map_recorded(pool, func, *iterables):
+    """pool.map(func, ...) that merges the stages recorded in the workers, in order."""
+    enabled = _state["enabled"]
+    for value, stage_records in pool.map(functools.partial(_call_mapped, enabled, func), *iterables):
+        merge(stage_records)
+        yield value
+
+
+def _call_mapped(enabled, func, *args):
+    return _call_recorded(enabled, func, args, {})
+
+
+def len_first_arg(data, *args, **kwargs):
+    """rows= helper for functions whose first argument is the data table."""
+    return len(data)
+
+
+def records():
+    """Recorded stages as a list of dicts, in completion order."""
+    with _lock:
+        return list(_state["records"])
+
+
+def trace_events(stage_records=None):
+    """Stages in Chrome trace-event format (complete "X" events, microseconds)."""
+    stage_records = records() if stage_records is None else stage_records
+    origin = min((r["start_s"] for r in stage_records), default=0.0)
+    pid = os.getpid()
+    events = []
+    for r in stage_records:
+        args = {k: r[k] for k in ("cpu_s", "peak_rss_mb", "delta_rss_mb", "rows", "error")
+                if r[k] is not None}
+        events.append({
+            "name": r["stage"], "ph": "X", "pid": r.get("pid", pid), "tid": r["thread"],
+            "ts": (r["start_s"] - origin) * 1e6, "dur": r["wall_s"] * 1e6, "args": args,
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_trace(path):
+    with open(path, "w") as f:
+        json.dump(trace_events(), f)
+
+
+def summary():
+    """Plain-text table of the recorded stages."""
+    lines = [f"{'stage':<40} {'wall s':>9} {'cpu s':>9} {'peak MB':>9} {'rows':>12}"]
+    for r in sorted(records(), key=lambda r: r["start_s"]):
+        rows = f"{r['rows']:,}" if r["rows"] is not None else ""
+        lines.append(f"{r['stage']:<40} {r['wall_s']:9.3f} {r['cpu_s']:9.3f} "
+                     f"{r['peak_rss_mb']:9.1f} {rows:>12}")
+    return "\n".join(lines)
+
+
+def _at_exit():
+    if not _state["records"]:
+        return
+    print(summary(), file=sys.stderr)
+    if _state["output"]:
+        write_trace(_state["output"])
+        print(f"profile written to {_state['output']}", file=sys.stderr)
+
+
+def enable_from_env():
+    value = os.environ.get(ENV_VAR, "")
+    if value and value != "0":
+        enable(DEFAULT_OUTPUT if value == "1" else value)
+
+
+enable_from_env()
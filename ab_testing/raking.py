@@ -0,0 +1,182 @@
+# Raking (iterative proportional fitting) of control weights to the test margins.
+#
+# correct_randomization_bias.py fixes the country marginal for Argentina and
+# Uruguay by oversampling rows, which leaves every other covariate, and the
+# interactions with country, as unbalanced as they were. Raking reweights the
+# control group so that its weighted distribution of every listed covariate
+# (and of crossed covariates like country x device) matches the test group:
+# for each margin in turn, every control row of level k is multiplied by
+#     target share of k / current weighted share of k
+# and the cycle repeats until all margins agree within `tol`.
+#
+# Each update only depends on the levels of the row, so every row of a cell of
+# the crossing of all raked margins keeps the same weight throughout. We rake
+# the table of observed cells (one bincount of the combined code, counts as
+# weights) with np.bincount updates and expand the weights at the end: the
+# iterations cost O(cells), not O(rows), and ten million rows are raked in
+# under a second, most of it the one-off encoding.
+#
+# weighted_welch() then compares test with the reweighted control from
+# per-group weighted sums (no row duplication), using the linearized variance
+# of a weighted mean and Kish's effective sample size, so uneven weights widen
+# the test instead of being counted as extra users.
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from .balance_check import RANDOMIZATION_COVARIATES, encode_column, group_counts
+from .profiling import len_first_arg, profiled
+from .streaming_ttest import WelchResult
+
+# weights: one per row (test rows 1, control rows raked). margins: target and
+# control shares per (margin, level) before and after. effective_n: Kish size
+# of the weighted control group.
+RakingResult = namedtuple("RakingResult", ["weights", "margins", "iterations", "converged",
+                                           "max_error", "effective_n"])
+
+# dense bincount over the crossing of the margins up to this many cells, np.unique above
+MAX_DENSE_CELLS = 1 << 24
+
+
+def _margin_name(margin):
+    return " x ".join(margin) if isinstance(margin, tuple) else margin
+
+
+def _margin_codes(data, margin):
+    """Codes and labels of a covariate, or of the crossing of a tuple of covariates."""
+    if not isinstance(margin, tuple):
+        return encode_column(data[margin])
+    encoded = [encode_column(data[c]) for c in margin]
+    codes = np.zeros(len(data), dtype=np.intp)
+    for column_codes, labels in encoded:
+        codes = codes * len(labels) + column_codes
+    crossing = pd.MultiIndex.from_product([labels for _, labels in encoded])
+    return codes, np.array([" x ".join(map(str, levels)) for levels in crossing], dtype=object)
+
+
+@profiled("raking.rake", rows=len_first_arg)
+def rake(data, covariates=None, interactions=(), group_col="test", target_group=1,
+         max_iter=1000, tol=1e-8, max_weight=None):
+    """Control weights whose margins match the test group's on every covariate.
+
+    covariates: columns to balance (default: the randomization covariates
+    present). interactions: tuples of columns whose crossing is balanced too,
+    e.g. [("country", "device")]. Weights of the non-target group sum to its
+    size (mean weight 1). max_weight caps every weight (trimmed raking); the
+    margins then match only as far as the cap allows.
+    Raises ValueError when a level of the target group has no rows to weight.
+    """
+    if covariates is None:
+        covariates = [c for c in RANDOMIZATION_COVARIATES if c in data.columns]
+    margins = list(covariates) + [tuple(m) for m in interactions]
+    is_target = (np.asarray(data[group_col]) == target_group).astype(np.intp)
+    other_rows = np.flatnonzero(is_target == 0)
+    n_other = len(other_rows)
+    n_target = len(is_target) - n_other
+
+    # per margin: codes of every row and the target group's level counts
+    codes, labels, targets = [], [], []
+    for margin in margins:
+        margin_codes, margin_labels = _margin_codes(data, margin)
+        counts = group_counts(margin_codes, len(margin_labels), is_target)
+        missing = (counts[:, 1] > 0) & (counts[:, 0] == 0)
+        if missing.any():
+            raise ValueError(f"no rows to weight for {_margin_name(margin)} = "
+                             f"{list(margin_labels[missing])} in group {1 - target_group}")
+        codes.append(margin_codes)
+        labels.append(margin_labels)
+        targets.append(counts[:, 1] / n_target * n_other)
+
+    # observed cells of the crossing of all margins, among the weighted rows
+    dims = [len(l) for l in labels]
+    n_cells = float(np.prod(np.asarray(dims, dtype=np.float64)))
+    if n_cells < 2 ** 62:
+        combined = (np.ravel_multi_index(codes, dims) if margins else np.zeros(len(is_target), np.intp))[other_rows]
+        if n_cells <= MAX_DENSE_CELLS:
+            cell_size = np.bincount(combined, minlength=int(n_cells))
+            cells = np.flatnonzero(cell_size)
+            lookup = np.zeros(len(cell_size), dtype=np.intp)
+            lookup[cells] = np.arange(len(cells))
+            inverse, cell_size = lookup[combined], cell_size[cells]
+        else:
+            cells, inverse, cell_size = np.unique(combined, return_inverse=True, return_counts=True)
+        cell_codes = list(np.unravel_index(cells, dims)) if margins else []
+    else:
+        stacked = np.stack([c[other_rows] for c in codes], axis=1)
+        cells, inverse, cell_size = np.unique(stacked, axis=0, return_inverse=True, return_counts=True)
+        cell_codes = list(cells.T)
+    inverse = inverse.ravel()
+    cell_size = cell_size.astype(np.float64)
+
+    # rake the cell table: weight per row of each cell, cell totals = weight * size
+    weight = np.ones(len(cell_size))
+    max_error, iteration, converged = np.inf, 0, not margins
+    for iteration in range(1, max_iter + 1):
+        for cell_levels, target in zip(cell_codes, targets):
+            current = np.bincount(cell_levels, weights=weight * cell_size, minlength=len(target))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                factor = np.where(current > 0, target / current, 1.0)
+            weight *= factor[cell_levels]
+        if max_weight is not None:
+            np.minimum(weight, max_weight, out=weight)
+        max_error = max(
+            np.abs(np.bincount(cell_levels, weights=weight * cell_size, minlength=len(target)) - target).max()
+            for cell_levels, target in zip(cell_codes, targets)) / n_other if margins else 0.0
+        if max_error < tol:
+            converged = True
+            break
+
+    weights = np.ones(len(is_target))
+    weights[other_rows] = weight[inverse]
+    total = (weight * cell_size).sum()
+    effective_n = total * total / (weight * weight * cell_size).sum() if n_other else 0.0
+
+    frames = []
+    for cell_levels, target, margin_labels, margin in zip(cell_codes, targets, labels, margins):
+        frames.append(pd.DataFrame({
+            "margin": _margin_name(margin),
+            "level": margin_labels,
+            "target": target / n_other,
+            "before": np.bincount(cell_levels, weights=cell_size, minlength=len(margin_labels)) / n_other,
+            "after": np.bincount(cell_levels, weights=weight * cell_size, minlength=len(margin_labels)) / n_other,
+        }))
+    margins_table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    return RakingResult(weights, margins_table, iteration, converged, float(max_error), float(effective_n))
+
+
+def welch_from_weighted_stats(sum_w, sum_wx, sum_wxx, sum_w2, sum_w2x, sum_w2xx):
+    """Welch's t-test of [control, test] weighted means from per-group weighted sums.
+
+    The variance of each weighted mean is the linearized (sandwich) one,
+    sum w^2 (x - mean)^2 / (sum w)^2, scaled by n_eff / (n_eff - 1) with Kish's
+    n_eff = (sum w)^2 / sum w^2, and n_eff - 1 enters the Welch-Satterthwaite
+    degrees of freedom. With unit weights this is exactly Welch's test.
+    """
+    sum_w, sum_wx, sum_wxx, sum_w2, sum_w2x, sum_w2xx = (
+        np.asarray(a, dtype=np.float64) for a in (sum_w, sum_wx, sum_wxx, sum_w2, sum_w2x, sum_w2xx))
+    mean = sum_wx / sum_w
+    n_eff = sum_w * sum_w / sum_w2
+    spread = np.maximum(sum_w2xx - 2 * mean * sum_w2x + mean * mean * sum_w2, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var_mean = spread / (sum_w * sum_w) * n_eff / (n_eff - 1)
+        se2 = var_mean.sum()
+        statistic = (mean[1] - mean[0]) / np.sqrt(se2)
+        df = se2 * se2 / (var_mean * var_mean / (n_eff - 1)).sum()
+    pvalue = 2 * stats.t.sf(np.abs(statistic), df)
+    return WelchResult(float(statistic), float(pvalue), float(df), float(mean[1]), float(mean[0]))
+
+
+@profiled("raking.weighted_welch", rows=len_first_arg)
+def weighted_welch(values, group, weights):
+    """Welch's t-test of test vs control with per-row weights (e.g. RakingResult.weights)."""
+    x = np.asarray(values, dtype=np.float64)
+    g = np.asarray(group).astype(np.intp, copy=False)
+    w = np.asarray(weights, dtype=np.float64)
+    wx = w * x
+    w2 = w * w
+    w2x = w2 * x
+    sums = [np.bincount(g, weights=a, minlength=2)[:2] for a in (w, wx, wx * x, w2, w2x, w2x * x)]
+    return welch_from_weighted_stats(*sums)
@@ -0,0 +1,292 @@
+# Decision-tree randomization check on a sparse one-hot encoding.
+#
+# check_randomization.py used pd.get_dummies, which materializes a dense
+# rows x levels matrix (and sklearn then copies it to float32). With
+# high-cardinality columns like country or browser that is most of the memory.
+# Every row has exactly one active level per categorical column though, so the
+# one-hot matrix has len(covariates) non-zeros per row no matter how many levels
+# there are. We build it directly as a sparse matrix from integer codes and fit
+# the same DecisionTreeClassifier on it.
+#
+# For very large tables the tree can also be fit on a stratified subsample
+# (same test/control ratio as the full data). See detection_bound for how small
+# an imbalance a given subsample size can still pick up.
+#
+# Reading the tree plot tells us *where* test and control differ, but not whether
+# that separation is more than noise. permutation_test refits the same tree on
+# randomly permuted labels (i.e. under a truly random assignment) many times and
+# compares the observed AUC, total impurity decrease and per-feature impurity
+# decrease to that null distribution. The sparse matrix is put in shared memory
+# once and every worker process maps it instead of receiving a pickled copy.
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
+from sklearn.metrics import roc_auc_score
+from sklearn.tree import DecisionTreeClassifier
+
+from .balance_check import RANDOMIZATION_COVARIATES, encode_column
+from .profiling import len_first_arg, profiled, stage
+
+TreeCheck = namedtuple("TreeCheck", ["tree", "feature_names", "splits", "rows"])
+PermutationResult = namedtuple("PermutationResult", ["summary", "features", "null"])
+
+
+@profiled("randomization_tree.sparse_one_hot", rows=len_first_arg)
+def sparse_one_hot(data, covariates):
+    """CSC one-hot matrix with get_dummies-style names ("country_Argentina").
+
+    Numeric columns (e.g. age) are kept as a single numeric feature, like
+    get_dummies does.
+    """
+    n = len(data)
+    indices = []
+    values = []
+    names = []
+    offset = 0
+    for name in covariates:
+        column = data[name]
+        if pd.api.types.is_numeric_dtype(column.dtype) and not isinstance(
+            column.dtype, pd.CategoricalDtype
+        ):
+            indices.append(np.full(n, offset, dtype=np.int32))
+            values.append(column.to_numpy(dtype=np.float32))
+            names.append(name)
+            offset += 1
+        else:
+            codes, labels = encode_column(column)
+            indices.append(codes.astype(np.int32) + offset)
+            values.append(np.ones(n, dtype=np.float32))
+            names.extend(f"{name}_{label}" for label in labels)
+            offset += len(labels)
+
+    # row-major layout: row i owns entries [i * k, (i + 1) * k)
+    k = len(covariates)
+    matrix = sparse.csr_matrix(
+        (np.column_stack(values).ravel(), np.column_stack(indices).ravel(),
+         np.arange(0, n * k + 1, k, dtype=np.int64)),
+        shape=(n, offset),
+    )
+    # sklearn's tree fits on CSC, convert once here rather than inside fit
+    return matrix.tocsc(), names
+
+
+def stratified_sample(labels, max_rows, seed=0):
+    """Row indices of a subsample of at most max_rows keeping the label ratio."""
+    labels = np.asarray(labels)
+    if max_rows is None or max_rows >= len(labels):
+        return np.arange(len(labels))
+    rng = np.random.default_rng(seed)
+    fraction = max_rows / len(labels)
+    picked = []
+    for label in np.unique(labels):
+        rows = np.flatnonzero(labels == label)
+        picked.append(rng.choice(rows, size=int(round(len(rows) * fraction)), replace=False))
+    return np.sort(np.concatenate(picked))
+
+
+def detection_bound(n_control, n_test, prevalence, alpha=0.05, power=0.8):
+    """Smallest difference in a level's prevalence between groups that a sample
+    of this size detects with the given power (two-sided z-test on proportions).
+
+    E.g. with 100k rows per group, a level present in 5% of users is detected
+    when its control/test prevalence differ by about 0.27 percentage points;
+    Argentina (5% vs 17%) or Uruguay (0.2% vs 1.7%) are far above that.
+    Note the tree's min_impurity_decrease also sets a floor on the effect size
+    it will split on, which does not shrink with more rows.
+    """
+    z = stats.norm.ppf(1 - alpha / 2) + stats.norm.ppf(power)
+    p = np.asarray(prevalence, dtype=np.float64)
+    return z * np.sqrt(p * (1 - p) * (1 / n_control + 1 / n_test))
+
+
+def separating_splits(tree, feature_names):
+    """Split nodes of a fitted tree with the level used and the test share on each side.
+
+    For a one-hot feature the right child is "level present" (value > 0.5).
+    Rows are sorted by weighted impurity decrease, largest first.
+    """
+    t = tree.tree_
+    total_weight = t.weighted_n_node_samples[0]
+    value = t.value[:, 0, :]
+    share_test = value[:, 1] / value.sum(axis=1)
+    depth = np.zeros(t.node_count, dtype=np.int64)
+    rows = []
+    for node in range(t.node_count):
+        left, right = t.children_left[node], t.children_right[node]
+        if left == -1:
+            continue
+        depth[left] = depth[right] = depth[node] + 1
+        decrease = (
+            t.weighted_n_node_samples[node] * t.impurity[node]
+            - t.weighted_n_node_samples[left] * t.impurity[left]
+            - t.weighted_n_node_samples[right] * t.impurity[right]
+        ) / total_weight
+        rows.append({
+            "feature": feature_names[t.feature[node]],
+            "threshold": t.threshold[node],
+            "depth": depth[node],
+            "impurity_decrease": decrease,
+            "share_test_below": share_test[left],
+            "share_test_above": share_test[right],
+        })
+    columns = ["feature", "threshold", "depth", "impurity_decrease",
+               "share_test_below", "share_test_above"]
+    return (pd.DataFrame(rows, columns=columns)
+            .sort_values("impurity_decrease", ascending=False, ignore_index=True))
+
+
+def _prepare(data, covariates, group_col, max_rows, seed):
+    if covariates is None:
+        covariates = [c for c in RANDOMIZATION_COVARIATES if c in data.columns]
+    labels = np.asarray(data[group_col])
+    rows = stratified_sample(labels, max_rows, seed)
+    if len(rows) < len(labels):
+        data = data.iloc[rows]
+        labels = labels[rows]
+    features, names = sparse_one_hot(data, covariates)
+    return features, labels, names, rows
+
+
+def _tree_params(min_impurity_decrease, seed, tree_kwargs):
+    return dict(class_weight="balanced", min_impurity_decrease=min_impurity_decrease,
+                random_state=seed, **tree_kwargs)
+
+
+def fit_randomization_tree(data, covariates=None, group_col="test", max_rows=None,
+                           seed=0, min_impurity_decrease=0.001, **tree_kwargs):
+    """Fit a test-vs-control tree on the sparse one-hot covariates.
+
+    Same model as check_randomization.py (balanced class weights,
+    min_impurity_decrease=0.001). If max_rows is set, the tree is fit on a
+    stratified subsample of that size.
+    """
+    features, labels, names, rows = _prepare(data, covariates, group_col, max_rows, seed)
+    tree = DecisionTreeClassifier(**_tree_params(min_impurity_decrease, seed, tree_kwargs))
+    with stage("randomization_tree.fit", rows=features.shape[0]):
+        tree.fit(features, labels)
+    return TreeCheck(tree, names, separating_splits(tree, names), rows)
+
+
+def tree_statistics(tree, features, labels):
+    """In-sample AUC, total impurity decrease and per-feature impurity decrease."""
+    importances = tree.tree_.compute_feature_importances(normalize=False)
+    if tree.tree_.node_count == 1:
+        # no split: every row gets the same score
+        return 0.5, 0.0, importances
+    auc = roc_auc_score(labels, tree.predict_proba(features)[:, 1])
+    return auc, importances.sum(), importances
+
+
+# -- permutation test workers -------------------------------------------------
+
+_worker = {}
+
+
+def _to_shared(array, blocks):
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+    blocks.append(block)
+    return block.name, array.shape, array.dtype.str
+
+
+def _from_shared(spec):
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def _init_worker(specs, shape, params):
+    blocks, (data, indices, indptr, labels) = zip(*(_from_shared(spec) for spec in specs))
+    features = sparse.csc_matrix((data, indices, indptr), shape=shape, copy=False)
+    features.has_sorted_indices = True
+    _worker.update(blocks=blocks, features=features, labels=labels, params=params)
+
+
+def _permutation_chunk(seed, count):
+    rng = np.random.default_rng(seed)
+    features, labels = _worker["features"], _worker["labels"]
+    aucs = np.empty(count)
+    decreases = np.empty(count)
+    importances = np.empty((count, features.shape[1]))
+    for i in range(count):
+        permuted = rng.permutation(labels)
+        tree = DecisionTreeClassifier(**_worker["params"]).fit(features, permuted)
+        aucs[i], decreases[i], importances[i] = tree_statistics(tree, features, permuted)
+    return aucs, decreases, importances
+
+
+def _pvalue(null, observed):
+    # (1 + #{null >= observed}) / (1 + B), never exactly 0
+    return (1 + (null >= observed - 1e-12).sum(axis=0)) / (1 + len(null))
+
+
+@profiled("randomization_tree.permutation_test", rows=len_first_arg)
+def permutation_test(data, n_permutations=1000, covariates=None, group_col="test",
+                     max_rows=None, seed=0, processes=None, chunk_size=10,
+                     min_impurity_decrease=0.001, **tree_kwargs):
+    """Randomization inference for the tree-based randomization check.
+
+    The tree is refit on `n_permutations` random permutations of the test label.
+    Permutations are split in chunks of `chunk_size`, each with its own seed
+    spawned from `seed`, so results do not depend on the number of processes.
+
+    summary: observed AUC and total impurity decrease with their p-values.
+    features: every feature the observed tree splits on, its impurity decrease,
+    a per-feature p-value and a family-wise p-value (compared to the max
+    impurity decrease over all features in each permutation, which controls the
+    chance of any false flag).
+    null: the permutation distributions (auc, impurity_decrease, importances).
+    """
+    features, labels, names, _ = _prepare(data, covariates, group_col, max_rows, seed)
+    params = _tree_params(min_impurity_decrease, seed, tree_kwargs)
+    tree = DecisionTreeClassifier(**params).fit(features, labels)
+    auc, decrease, importances = tree_statistics(tree, features, labels)
+
+    counts = [chunk_size] * (n_permutations // chunk_size)
+    if n_permutations % chunk_size:
+        counts.append(n_permutations % chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(counts))
+
+    blocks = []
+    try:
+        specs = [_to_shared(a, blocks) for a in
+                 (features.data, features.indices, features.indptr, labels)]
+        init_args = (specs, features.shape, params)
+        if processes == 1:
+            _init_worker(*init_args)
+            chunks = [_permutation_chunk(s, c) for s, c in zip(seeds, counts)]
+            _worker.clear()
+        else:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                                     initargs=init_args) as pool:
+                chunks = list(pool.map(_permutation_chunk, seeds, counts))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    null_auc = np.concatenate([c[0] for c in chunks])
+    null_decrease = np.concatenate([c[1] for c in chunks])
+    null_importances = np.concatenate([c[2] for c in chunks])
+
+    summary = pd.DataFrame({
+        "statistic": ["auc", "impurity_decrease"],
+        "observed": [auc, decrease],
+        "null_mean": [null_auc.mean(), null_decrease.mean()],
+        "pvalue": [_pvalue(null_auc, auc), _pvalue(null_decrease, decrease)],
+    })
+    used = np.flatnonzero(importances > 0)
+    features_table = pd.DataFrame({
+        "feature": [names[i] for i in used],
+        "impurity_decrease": importances[used],
+        "pvalue": _pvalue(null_importances[:, used], importances[used]),
+        "pvalue_fwer": _pvalue(null_importances.max(axis=1)[:, None], importances[used]),
+    }).sort_values("impurity_decrease", ascending=False, ignore_index=True)
+    null = {"auc": null_auc, "impurity_decrease": null_decrease,
+            "importances": null_importances}
+    return PermutationResult(summary, features_table, null)
@@ -0,0 +1,105 @@
+# Index-based oversampling to correct a randomization imbalance.
+#
+# correct_randomization_bias.py copied the under-represented rows with
+# DataFrame.sample(replace=True) and pd.concat-ed them onto the control group,
+# so every oversampled user existed twice in memory. Here the oversampling is
+# only described, never materialized: `extra_rows` holds the positions (in the
+# original frame) of the rows drawn into control, and `multiplicity` says how
+# many times each original row counts in control (row 0) and in test (row 1).
+# Proportions and the t-test are weighted by those counts, which gives the same
+# numbers as running them on the concatenated frame.
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from .balance_check import encode_column
+from .profiling import len_first_arg, profiled
+from .streaming_ttest import ttest_from_stats
+
+Rebalance = namedtuple("Rebalance", ["extra_rows", "multiplicity", "plan"])
+
+
+@profiled("rebalance.rebalance_strata", rows=len_first_arg)
+def rebalance_strata(data, column="country", strata=None, group_col="test",
+                     target_group=1, donor_group=None, seed=None):
+    """Oversample strata of `column` in the non-target group up to the target group's share.
+
+    For every stratum, the number of extra rows is
+    int(share in target group * original size of the other group) - current count,
+    like correct_randomization_bias.py. Extra rows are drawn with replacement
+    from the stratum's rows in `donor_group` (by default the target group, i.e.
+    the test group as in the script) and counted as members of the other group.
+    donor_group must be 0 or 1.
+
+    strata: levels to rebalance. By default every level that is
+    under-represented in the non-target group.
+    seed: anything np.random.default_rng accepts, for reproducible draws.
+    """
+    group = np.asarray(data[group_col]).astype(np.intp, copy=False)
+    codes, labels = encode_column(data[column])
+    other_group = 1 - target_group
+    donor_group = target_group if donor_group is None else donor_group
+    if donor_group not in (0, 1):
+        raise ValueError(f"donor_group must be 0 or 1, got {donor_group!r}")
+    counts = np.bincount(codes * 2 + group, minlength=2 * len(labels)).reshape(-1, 2)
+    group_sizes = counts.sum(axis=0)
+    target_props = counts[:, target_group] / group_sizes[target_group]
+
+    desired = (target_props * group_sizes[other_group]).astype(np.int64)
+    extra = np.maximum(desired - counts[:, other_group], 0)
+    if strata is not None:
+        keep = np.isin(labels, list(strata))
+        missing = set(strata) - set(labels[keep])
+        if missing:
+            raise KeyError(f"levels not found in {column!r}: {sorted(missing)}")
+        extra = np.where(keep, extra, 0)
+
+    rng = np.random.default_rng(seed)
+    donors = group == donor_group
+    drawn = []
+    for level in np.flatnonzero(extra):
+        pool = np.flatnonzero(donors & (codes == level))
+        if len(pool) == 0:
+            raise ValueError(f"no rows of {labels[level]!r} in group {donor_group} to sample from")
+        drawn.append(pool[rng.integers(0, len(pool), size=extra[level])])
+    extra_rows = np.concatenate(drawn) if drawn else np.empty(0, dtype=np.intp)
+
+    multiplicity = np.zeros((2, len(group)), dtype=np.int32)
+    multiplicity[0] = group == 0
+    multiplicity[1] = group == 1
+    multiplicity[other_group] += np.bincount(extra_rows, minlength=len(group)).astype(np.int32)
+
+    plan = pd.DataFrame({
+        column: labels,
+        "target_prop": target_props,
+        "current": counts[:, other_group],
+        "desired": desired,
+        "extra": extra,
+    })
+    plan = plan[plan["extra"] > 0].reset_index(drop=True)
+    return Rebalance(extra_rows, multiplicity, plan)
+
+
+@profiled("rebalance.weighted_proportions", rows=len_first_arg)
+def weighted_proportions(values, multiplicity):
+    """Share of each level within control and test, counting rows `multiplicity` times.
+
+    Same layout as groupby(['test', column]).size().unstack() normalized by row.
+    """
+    codes, labels = encode_column(pd.Series(values))
+    table = np.vstack([
+        np.bincount(codes, weights=multiplicity[g], minlength=len(labels)) for g in (0, 1)
+    ])
+    props = table / table.sum(axis=1, keepdims=True)
+    return pd.DataFrame(props, index=pd.Index([0, 1], name="test"),
+                        columns=pd.Index(labels, name=getattr(values, "name", None)))
+
+
+@profiled("rebalance.weighted_ttest", rows=len_first_arg)
+def weighted_ttest(values, multiplicity, equal_var=False):
+    """t-test of test vs control on `values` with rows counted `multiplicity` times."""
+    x = np.asarray(values, dtype=np.float64)
+    m = multiplicity.astype(np.float64)
+    return ttest_from_stats(m.sum(axis=1), m @ x, m @ (x * x), equal_var=equal_var)
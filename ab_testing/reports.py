@@ -0,0 +1,405 @@
+# Content-addressed cache of report artifacts: figures, tables, test results.
+#
+# The scripts re-render randomization_tree.png (a 20x20 plot_tree) and the
+# sample size chart on every run, and the summary report was rewritten by hand.
+# Here every artifact is keyed by the SHA-256 of what it is made of:
+#   - the function that builds it (module, name and source code, so editing a
+#     renderer invalidates its figures; bump ARTIFACT_VERSION when a helper it
+#     calls changes the output),
+#   - its inputs: DataFrames and arrays are hashed by value, datasets from
+#     dataset_cache by the hash of their CSV bytes (free, already known),
+#   - its parameters.
+# An artifact whose key is already in the store is not rebuilt: tables
+# (Parquet) and results (JSON) are read back, figures are copied.
+#
+# Missing figures are rendered on a process pool with the headless Agg
+# backend. Workers get DatasetRefs, not DataFrames: they memory-map the cached
+# Feather file instead of unpickling a copy of the table.
+#
+# build_reports() assembles the summary of one or many experiments (markdown,
+# optionally PDF) from those cached pieces, so refreshing a dashboard only
+# redoes the experiments, and the parts of them, whose inputs changed.
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .dataset_cache import DEFAULT_CACHE_DIR, DatasetCache
+from .profiling import map_recorded, stage
+
+ARTIFACT_VERSION = 1
+
+Artifact = namedtuple("Artifact", ["name", "key", "path", "cached"])
+Figure = namedtuple("Figure", ["name", "render", "inputs", "params"])
+DatasetRef = namedtuple("DatasetRef", ["path", "key"])
+
+
+# -- keys ---------------------------------------------------------------------
+
+def _update(digest, value):
+    """Feed a canonical encoding of `value` into `digest`."""
+    if isinstance(value, DatasetRef):
+        digest.update(b"D" + value.key.encode())
+    elif value is None or isinstance(value, (bool, int, float, str, np.generic)):
+        digest.update(f"S{type(value).__name__}:{value!r};".encode())
+    elif isinstance(value, bytes):
+        digest.update(b"B%d:" % len(value) + value)
+    elif isinstance(value, np.ndarray):
+        if value.dtype == object:
+            value = pd.util.hash_array(value.ravel())
+        digest.update(f"A{value.dtype.str}{value.shape};".encode())
+        digest.update(np.ascontiguousarray(value).data)
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        frame = value.to_frame() if isinstance(value, pd.Series) else value
+        digest.update(f"F{list(frame.columns)!r}{[str(t) for t in frame.dtypes]};".encode())
+        digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().data)
+    elif isinstance(value, dict):
+        digest.update(b"M%d:" % len(value))
+        for k in sorted(value, key=repr):
+            _update(digest, k)
+            _update(digest, value[k])
+    elif isinstance(value, (list, tuple)):
+        digest.update(b"L%d:" % len(value))
+        for item in value:
+            _update(digest, item)
+    elif callable(value):
+        try:
+            source = inspect.getsource(value)
+        except (OSError, TypeError):
+            source = ""
+        digest.update(f"C{value.__module__}.{value.__qualname__}:{source}".encode())
+    else:
+        raise TypeError(f"cannot key a report input of type {type(value).__name__}")
+
+
+def artifact_key(func, *inputs, **params):
+    """Hex SHA-256 of (func, inputs, params): equal keys mean equal artifacts."""
+    digest = hashlib.sha256(b"ab_testing.reports v%d;" % ARTIFACT_VERSION)
+    _update(digest, func)
+    _update(digest, inputs)
+    _update(digest, params)
+    return digest.hexdigest()
+
+
+def _resolve(value):
+    if isinstance(value, DatasetRef):
+        import pyarrow.feather as feather
+        return feather.read_table(value.path, memory_map=True).to_pandas(split_blocks=True)
+    return value
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+# -- rendering ----------------------------------------------------------------
+
+def _render(render, path, inputs, params):
+    """Worker side: render one figure with the headless backend, atomically."""
+    import matplotlib
+    matplotlib.use("Agg")
+    root, ext = os.path.splitext(path)
+    tmp = f"{root}.{os.getpid()}.tmp{ext}"
+    with stage(f"reports.render.{render.__name__}"):
+        render(tmp, *(_resolve(v) for v in inputs), **params)
+    os.replace(tmp, path)
+    return path
+
+
+def render_randomization_tree(path, data, covariates=None, group_col="test", max_depth=3,
+                              figsize=(20, 20), dpi=100, seed=0):
+    """Fit the test-vs-control tree and save plot_tree of its first levels."""
+    import matplotlib.pyplot as plt
+    from sklearn.tree import plot_tree
+
+    from .randomization_tree import fit_randomization_tree
+
+    check = fit_randomization_tree(data, covariates, group_col, seed=seed)
+    plt.figure(figsize=figsize)
+    plot_tree(check.tree, feature_names=check.feature_names, class_names=["Control", "Test"],
+              filled=True, proportion=True, rounded=True, max_depth=max_depth)
+    plt.savefig(path, dpi=dpi, bbox_inches="tight")
+    plt.close()
+
+
+def render_sample_size_curve(path, p1, p2, power=0.8, alpha=0.05, simulated=None, dpi=300):
+    """Sample size vs minimum test conversion rate; `simulated` adds the simulated sizes."""
+    import matplotlib.pyplot as plt
+
+    from .power_grid import proportion_effectsize, sample_size
+
+    p2 = np.asarray(p2, dtype=np.float64)
+    plt.plot(sample_size(proportion_effectsize(p1, p2), power=power, alpha=alpha), p2,
+             label="Normal approximation")
+    if simulated is not None:
+        plt.plot(simulated, p2, "o--", label="Simulated Welch t-test")
+        plt.legend()
+    plt.title("Sample size vs Minimum Effect size")
+    plt.xlabel("Sample Size")
+    plt.ylabel("Minimum Test Conversion rate")
+    plt.savefig(path, dpi=dpi, bbox_inches="tight")
+    plt.close()
+
+
+def render_summary_pdf(path, text, images):
+    """One page of summary text, then one page per figure."""
+    import textwrap
+
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    # images get their own pages, drop their markdown links from the text
+    lines = [line for line in text.splitlines() if not line.startswith("![")]
+    text = "\n".join(textwrap.fill(line, 100) if line else "" for line in lines)
+    with PdfPages(path) as pdf:
+        fig = plt.figure(figsize=(8.27, 11.69))
+        fig.text(0.06, 0.96, text, va="top", family="monospace", fontsize=7)
+        pdf.savefig(fig)
+        plt.close(fig)
+        for image in images:
+            fig = plt.figure(figsize=(8.27, 11.69))
+            ax = fig.add_axes([0.03, 0.03, 0.94, 0.94])
+            ax.imshow(plt.imread(image))
+            ax.axis("off")
+            pdf.savefig(fig)
+            plt.close(fig)
+
+
+# -- store --------------------------------------------------------------------
+
+class ArtifactStore:
+    """Content-addressed store of report artifacts (next to the dataset cache by default)."""
+
+    def __init__(self, cache_dir=None):
+        cache_dir = cache_dir or os.environ.get("AB_TESTING_CACHE_DIR", DEFAULT_CACHE_DIR)
+        self.cache_dir = cache_dir
+        self.root = os.path.join(cache_dir, "artifacts")
+        os.makedirs(self.root, exist_ok=True)
+        self.hits = self.misses = 0
+
+    def path(self, key, suffix):
+        return os.path.join(self.root, key + suffix)
+
+    def dataset(self, source):
+        """DatasetRef of a CSV path or URL, keyed by the hash of its bytes (no re-hashing)."""
+        path = DatasetCache(cache_dir=self.cache_dir).path(source)
+        return DatasetRef(path, os.path.splitext(os.path.basename(path))[0])
+
+    def _lookup(self, path):
+        found = os.path.exists(path)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def _write(self, path, write):
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=os.path.splitext(path)[1])
+        os.close(fd)
+        write(tmp)
+        os.replace(tmp, path)
+
+    def table(self, func, *inputs, **params):
+        """func(*inputs, **params) -> DataFrame, computed once per key (stored as Parquet)."""
+        path = self.path(artifact_key(func, *inputs, **params), ".parquet")
+        if self._lookup(path):
+            return pd.read_parquet(path)
+        with stage(f"reports.table.{func.__name__}"):
+            frame = func(*(_resolve(v) for v in inputs), **params)
+        self._write(path, frame.to_parquet)
+        return frame
+
+    def result(self, func, *inputs, **params):
+        """func(*inputs, **params) -> dict or namedtuple, computed once per key (stored as JSON)."""
+        path = self.path(artifact_key(func, *inputs, **params), ".json")
+        if self._lookup(path):
+            with open(path) as f:
+                return json.load(f)
+        with stage(f"reports.result.{func.__name__}"):
+            value = func(*(_resolve(v) for v in inputs), **params)
+        value = dict(value._asdict() if hasattr(value, "_asdict") else value)
+
+        def write(tmp):
+            with open(tmp, "w") as f:
+                json.dump(value, f, default=_json_default)
+        self._write(path, write)
+        # round-trip, so hits and misses return the same types
+        return json.loads(json.dumps(value, default=_json_default))
+
+    def figures(self, figures, output_dir=None, processes=None):
+        """Render the Figures whose key is not in the store, in parallel.
+
+        Returns one Artifact per Figure; with output_dir, each is also copied
+        to output_dir/<name>. processes=1 renders in this process.
+        """
+        artifacts, missing = [], []
+        for figure in figures:
+            key = artifact_key(figure.render, *figure.inputs, **figure.params)
+            path = self.path(key, os.path.splitext(figure.name)[1])
+            cached = self._lookup(path)
+            artifacts.append(Artifact(figure.name, key, path, cached))
+            if not cached and path not in {m[1] for m in missing}:
+                missing.append((figure.render, path, tuple(figure.inputs), dict(figure.params)))
+
+        with stage("reports.render", rows=len(missing)):
+            if len(missing) > 1 and processes != 1:
+                with ProcessPoolExecutor(max_workers=processes) as pool:
+                    list(map_recorded(pool, _render, *zip(*missing)))
+            else:
+                for task in missing:
+                    _render(*task)
+
+        if output_dir is not None:
+            for artifact in artifacts:
+                export(artifact, os.path.join(output_dir, artifact.name))
+        return artifacts
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+
+def export(artifact, dest):
+    """Copy a cached artifact to `dest`, unless dest already has the same bytes."""
+    if os.path.exists(dest) and os.path.getsize(dest) == os.path.getsize(artifact.path):
+        with open(dest, "rb") as a, open(artifact.path, "rb") as b:
+            if a.read() == b.read():
+                return dest
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    shutil.copyfile(artifact.path, dest)
+    return dest
+
+
+# -- experiment summaries -------------------------------------------------------
+
+def welch_test(data, group_col="test", metric_col="conversion"):
+    from .streaming_ttest import WelchAccumulator
+
+    acc = WelchAccumulator().update(data[group_col].to_numpy(), data[metric_col].to_numpy())
+    result = acc.welch()._asdict()
+    result.update(n_control=int(acc.n[0]), n_test=int(acc.n[1]))
+    return result
+
+
+def imbalanced_levels(data, covariates=None, group_col="test", alpha=0.05, min_smd=0.1):
+    from .balance_check import balance_report
+
+    levels = balance_report(data, covariates, group_col, alpha, min_smd).levels
+    return levels[levels["imbalanced"]].reset_index(drop=True)
+
+
+def corrected_test(data, column, strata, group_col="test", metric_col="conversion", seed=42):
+    from .rebalance import rebalance_strata, weighted_ttest
+
+    rebalance = rebalance_strata(data, column, strata, group_col, seed=seed)
+    result = weighted_ttest(data[metric_col], rebalance.multiplicity, equal_var=True)._asdict()
+    result.update(extra_rows=len(rebalance.extra_rows), plan=rebalance.plan.to_dict("records"))
+    return result
+
+
+def _simulated_sizes(p1, p2, power, alpha, seed):
+    from .power_simulation import simulated_sample_size
+
+    return simulated_sample_size(p1, p2, power=power, alpha=alpha, seed=seed)
+
+
+def summary_markdown(name, pieces, alpha=0.05):
+    """Markdown summary of one experiment from its cached pieces (see build_reports)."""
+    original, imbalanced, corrected = pieces["original"], pieces["imbalanced"], pieces["corrected"]
+    lines = [f"# A/B Test Summary: {name}", "",
+             f"{original['n_control']:,} users in control and {original['n_test']:,} in test. "
+             f"Conversion: {original['mean_control']:.2%} in control, {original['mean_test']:.2%} in test "
+             f"(Welch t = {original['statistic']:.2f}, p = {original['pvalue']:.3g}).", "",
+             "## Randomization check", ""]
+    if len(imbalanced):
+        lines.append(f"Imbalanced covariate levels (q < {alpha}, |SMD| >= 0.1):")
+        lines.append("")
+        for row in imbalanced.itertuples():
+            lines.append(f"- {row.covariate} {row.level}: {row.prop_test:.1%} in test vs "
+                         f"{row.prop_control:.1%} in control")
+    else:
+        lines.append("No covariate level is imbalanced between test and control.")
+    lines += ["", f"![Randomization tree]({pieces['figures']['tree']})", ""]
+
+    final = original
+    if corrected is not None:
+        final = corrected
+        strata = ", ".join(str(p[pieces["column"]]) for p in corrected["plan"])
+        lines += ["## Correction", "",
+                  f"{strata} oversampled in control to match the test group "
+                  f"({corrected['extra_rows']:,} extra rows). "
+                  f"After correction: t = {corrected['statistic']:.2f}, p = {corrected['pvalue']:.3g}.", ""]
+
+    lines += ["## Power analysis", "", f"![Sample size]({pieces['figures']['sample_size']})", "",
+              "## Conclusion", ""]
+    if final["pvalue"] > alpha:
+        lines.append("There is no statistically significant difference in conversion rates "
+                     "between the test and control groups.")
+    else:
+        direction = "higher" if final["statistic"] > 0 else "lower"
+        lines.append(f"Conversion is significantly {direction} in test (p = {final['pvalue']:.3g}).")
+    return "\n".join(lines) + "\n"
+
+
+def build_reports(sources, output_dir="reports", store=None, column="country", alpha=0.05,
+                  lifts=np.arange(0.05, 0.55, 0.05), power=0.8, simulate=False, pdf=False,
+                  processes=None, seed=0):
+    """Summaries of many experiments, rebuilding only artifacts whose inputs changed.
+
+    sources: {name: CSV path or URL} (or a list of paths, named after the file).
+    Each experiment gets output_dir/<name>/summary.md (and summary.pdf) with its
+    figures. Tables and test results are computed in this process; all missing
+    figures of all experiments are rendered together on one process pool.
+    Returns {name: list of Artifacts}.
+    """
+    store = store or ArtifactStore()
+    if not isinstance(sources, dict):
+        sources = {os.path.splitext(os.path.basename(s))[0]: s for s in sources}
+
+    pieces, figures = {}, []
+    for name, source in sources.items():
+        data = store.dataset(source)
+        original = store.result(welch_test, data)
+        imbalanced = store.table(imbalanced_levels, data, alpha=alpha)
+        strata = sorted(imbalanced.loc[imbalanced["covariate"] == column, "level"].astype(str))
+        corrected = store.result(corrected_test, data, column, strata) if strata else None
+        p1 = round(original["mean_control"], 4)
+        p2 = np.round(p1 * (1 + np.asarray(lifts)), 6)
+        simulated = None
+        if simulate:
+            simulated = store.table(_simulated_sizes, p1, p2, power, alpha, seed)["nobs_control"].to_numpy()
+        figures += [
+            Figure(os.path.join(name, "randomization_tree.png"), render_randomization_tree, (data,), {}),
+            Figure(os.path.join(name, "sample_size.png"), render_sample_size_curve, (p1, p2),
+                   {"power": power, "alpha": alpha, "simulated": simulated}),
+        ]
+        pieces[name] = {"original": original, "imbalanced": imbalanced, "corrected": corrected,
+                        "column": column,
+                        "figures": {"tree": "randomization_tree.png", "sample_size": "sample_size.png"}}
+
+    artifacts = store.figures(figures, output_dir, processes)
+    by_name = {name: [a for a in artifacts if a.name.startswith(name + os.sep)] for name in sources}
+
+    summaries = []
+    for name in sources:
+        text = summary_markdown(name, pieces[name], alpha)
+        with open(os.path.join(output_dir, name, "summary.md"), "w") as f:
+            f.write(text)
+        if pdf:
+            summaries.append(Figure(os.path.join(name, "summary.pdf"), render_summary_pdf,
+                                    (text, [a.path for a in by_name[name]]), {}))
+    for artifact in store.figures(summaries, output_dir, processes):
+        by_name[artifact.name.split(os.sep)[0]].append(artifact)
+    return by_name
@@ -0,0 +1,143 @@
+# Per-segment Welch t-tests from one grouped aggregation.
+#
+# check_randomization.py compared "Full" with "Removed_Argentina_Uruguay" by
+# building boolean masks on the whole frame for every slice, so each slice was a
+# full rescan. Welch's test only needs n, sum and sum-of-squares per group
+# (see streaming_ttest.py), and those add up: the stats of a segment are the
+# sum of the stats of its cells, and "everything except this segment" is the
+# overall stats minus the segment's. So we aggregate once, down to the finest
+# crossing of all the covariates involved, and derive every segment (and every
+# leave-one-level-out slice) from that small cell table.
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from statsmodels.stats.multitest import multipletests
+
+from .balance_check import RANDOMIZATION_COVARIATES, encode_column
+from .profiling import len_first_arg, profiled
+from .streaming_ttest import welch_arrays
+
+# levels: DataFrame with one column per covariate of the segment.
+# n, total, total_sq: (n_segments, 2) arrays for [control, test].
+SegmentStats = namedtuple("SegmentStats", ["levels", "n", "total", "total_sq"])
+
+# dense bincount over the full crossing up to this many cells, np.unique above
+MAX_DENSE_CELLS = 1 << 24
+
+
+def _cell_stats(codes, dims, group, values):
+    """Stats per observed cell of the crossing of all covariates, in one pass."""
+    if len(dims):
+        combined = np.ravel_multi_index(codes, dims)
+    else:
+        combined = np.zeros(len(group), dtype=np.intp)
+    n_cells = int(np.prod(dims)) if len(dims) else 1
+    if n_cells <= MAX_DENSE_CELLS:
+        cells, inverse = None, combined
+    else:
+        cells, inverse = np.unique(combined, return_inverse=True)
+        n_cells = len(cells)
+    key = inverse * 2 + group
+    size = 2 * n_cells
+    n = np.bincount(key, minlength=size).reshape(-1, 2)
+    total = np.bincount(key, weights=values, minlength=size).reshape(-1, 2)
+    total_sq = np.bincount(key, weights=values * values, minlength=size).reshape(-1, 2)
+    observed = n.sum(axis=1) > 0
+    cell_ids = np.flatnonzero(observed) if cells is None else cells[observed]
+    return cell_ids, n[observed], total[observed], total_sq[observed]
+
+
+@profiled("segment_tests.aggregate_segments", rows=len_first_arg)
+def aggregate_segments(data, segments, group_col="test", metric_col="conversion"):
+    """SegmentStats for every segment definition, from a single pass over the rows.
+
+    segments: list of covariate tuples, e.g. [("country",), ("country", "device", "source")].
+    The result maps each tuple to its SegmentStats; the empty tuple () holds
+    the overall stats.
+    """
+    segments = [tuple(s) for s in segments]
+    covariates = list(dict.fromkeys(c for s in segments for c in s))
+    encoded = [encode_column(data[c]) for c in covariates]
+    dims = tuple(len(labels) for _, labels in encoded)
+    group = np.asarray(data[group_col]).astype(np.intp, copy=False)
+    values = np.asarray(data[metric_col], dtype=np.float64)
+
+    cell_ids, n, total, total_sq = _cell_stats(
+        tuple(codes for codes, _ in encoded), dims, group, values
+    )
+    cell_codes = np.unravel_index(cell_ids, dims) if dims else ()
+
+    result = {(): SegmentStats(pd.DataFrame(index=[0]), n.sum(axis=0, keepdims=True),
+                               total.sum(axis=0, keepdims=True),
+                               total_sq.sum(axis=0, keepdims=True))}
+    for segment in segments:
+        positions = [covariates.index(c) for c in segment]
+        seg_dims = tuple(dims[p] for p in positions)
+        seg_code = np.ravel_multi_index(tuple(cell_codes[p] for p in positions), seg_dims)
+        seg_ids, inverse = np.unique(seg_code, return_inverse=True)
+        stacked = [
+            np.column_stack([np.bincount(inverse, weights=a[:, g], minlength=len(seg_ids))
+                             for g in (0, 1)])
+            for a in (n, total, total_sq)
+        ]
+        level_codes = np.unravel_index(seg_ids, seg_dims)
+        levels = pd.DataFrame({
+            c: encoded[p][1][level_codes[i]] for i, (c, p) in enumerate(zip(segment, positions))
+        })
+        result[segment] = SegmentStats(levels, *stacked)
+    return result
+
+
+def pooled(stats, mask=None):
+    """(n, total, total_sq) of the union of the selected segments (all if mask is None)."""
+    if mask is None:
+        mask = slice(None)
+    return tuple(a[mask].sum(axis=0) for a in (stats.n, stats.total, stats.total_sq))
+
+
+@profiled("segment_tests.segment_tests", rows=len_first_arg)
+def segment_tests(data, segments=None, group_col="test", metric_col="conversion",
+                  leave_one_out=True, alpha=0.05, method="fdr_bh"):
+    """Welch's t-test of test vs control within every segment level.
+
+    segments: covariate tuples to segment by, by default each covariate of the
+    randomization schema on its own. With leave_one_out=True every level also
+    gets a "without" row: the test on all users except that level.
+    p-values are corrected across all rows with statsmodels' multipletests
+    (Benjamini-Hochberg by default).
+    """
+    if segments is None:
+        segments = [(c,) for c in RANDOMIZATION_COVARIATES if c in data.columns]
+    aggregated = aggregate_segments(data, segments, group_col, metric_col)
+    overall = aggregated[()]
+
+    frames = []
+    for segment in segments:
+        stats = aggregated[tuple(segment)]
+        level_names = stats.levels.astype(str).agg(" | ".join, axis=1)
+        slices = [("only", stats.n, stats.total, stats.total_sq)]
+        if leave_one_out:
+            slices.append(("without", overall.n - stats.n, overall.total - stats.total,
+                           overall.total_sq - stats.total_sq))
+        for kind, n, total, total_sq in slices:
+            statistic, pvalue, df, mean_control, mean_test = welch_arrays(n, total, total_sq)
+            frames.append(pd.DataFrame({
+                "segment": " x ".join(segment),
+                "level": level_names,
+                "slice": kind,
+                "n_control": n[:, 0].astype(np.int64),
+                "n_test": n[:, 1].astype(np.int64),
+                "mean_control": mean_control,
+                "mean_test": mean_test,
+                "t_statistic": statistic,
+                "df": df,
+                "p_value": pvalue,
+            }))
+    table = pd.concat(frames, ignore_index=True)
+    testable = table["p_value"].notna().to_numpy()
+    table["q_value"] = np.nan
+    table.loc[testable, "q_value"] = multipletests(table.loc[testable, "p_value"], method=method)[1]
+    table["significant"] = table["q_value"] < alpha
+    return table
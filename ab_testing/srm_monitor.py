@@ -0,0 +1,246 @@
+# Online sample-ratio-mismatch (SRM) and stratum-imbalance monitor.
+#
+# The Argentina/Uruguay bug was found after the fact, by fitting a tree on the
+# finished dataset. It would have shown up in the assignment log within the
+# first minutes: in those countries ~73% and ~89% of users went to test against
+# ~54% elsewhere. This monitor reads assignment events (test plus covariates)
+# as they come and keeps, per covariate, a small (levels, 2) array of
+# [control, test] counters. An event costs one counter increment per covariate,
+# a batch one np.bincount, and memory depends only on the number of strata
+# (covariates with more than `max_levels` levels pool the rest in "<other>").
+#
+# Each check is O(number of strata) arithmetic on those counters:
+#   - overall SRM: chi-square of the test/control split against the planned
+#     `expected_share` (if given).
+#   - per stratum: the same chi-square within the stratum. Without a planned
+#     share, the stratum's test share is compared with the share in the rest
+#     of the traffic instead (a 2x2 test of independence), so an unplanned
+#     global skew does not flag every stratum. Strata already flagged are left
+#     out of "the rest", so one badly skewed country does not drag every other
+#     country of the same covariate into the alerts.
+# Since we check again and again while events arrive, alerts use always-valid
+# mSPRT p-values (see sequential_test.py) with a Bonferroni correction over the
+# strata, which keeps the chance of any false alert below `alpha` however often
+# we look. The classical chi-square p-values are reported next to them.
+
+import math
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from scipy import stats
+
+from .balance_check import RANDOMIZATION_COVARIATES, encode_column
+from .profiling import profiled
+from .sequential_test import log_msprt_statistic
+
+SRMStatus = namedtuple("SRMStatus", ["events", "overall", "strata", "alerts"])
+
+OTHER_LEVEL = "<other>"
+MISSING_LEVEL = "<NA>"
+
+
+class SRMMonitor:
+    """Running test/control counters per stratum with sequential SRM checks.
+
+    covariates: columns to stratify on (default: the randomization.csv ones).
+    expected_share: planned share of users in test; None skips the overall check.
+    alpha: family-wise error rate of the alerts over all strata and all looks.
+    tau: scale of the share differences we want to detect fast (mSPRT mixture).
+    min_events: strata with fewer events are not tested yet.
+    """
+
+    def __init__(self, covariates=None, expected_share=None, alpha=0.001, tau=0.05,
+                 min_events=100, max_levels=1024, group_col="test"):
+        self.covariates = list(RANDOMIZATION_COVARIATES if covariates is None else covariates)
+        self.expected_share = expected_share
+        self.alpha = alpha
+        self.tau = tau
+        self.min_events = min_events
+        self.max_levels = max_levels
+        self.group_col = group_col
+        self.total = np.zeros(2, dtype=np.int64)
+        self.levels = {c: {} for c in self.covariates}
+        self.counts = {c: np.zeros((16, 2), dtype=np.int64) for c in self.covariates}
+        # running minimum of the always-valid p-values, per stratum and overall
+        self.pvalues = {c: np.ones(16) for c in self.covariates}
+        self.flagged = {c: np.zeros(16, dtype=bool) for c in self.covariates}
+        self.overall_pvalue = 1.0
+        self.alerts = {}
+        self.started = time.perf_counter()
+
+    def _index(self, covariate, label):
+        levels = self.levels[covariate]
+        index = levels.get(label)
+        if index is None:
+            if len(levels) >= self.max_levels - 1 and label != OTHER_LEVEL:
+                return self._index(covariate, OTHER_LEVEL)
+            index = levels[label] = len(levels)
+            if index == len(self.counts[covariate]):
+                self.counts[covariate] = np.vstack([self.counts[covariate],
+                                                    np.zeros_like(self.counts[covariate])])
+                self.pvalues[covariate] = np.append(self.pvalues[covariate],
+                                                    np.ones(len(self.pvalues[covariate])))
+                self.flagged[covariate] = np.append(self.flagged[covariate],
+                                                    np.zeros(len(self.flagged[covariate]), dtype=bool))
+        return index
+
+    def observe(self, test, **covariates):
+        """Count one assignment event, e.g. observe(1, country="Argentina", ...)."""
+        test = int(test)
+        self.total[test] += 1
+        for covariate in self.covariates:
+            label = covariates.get(covariate)
+            index = self._index(covariate, MISSING_LEVEL if label is None else label)
+            self.counts[covariate][index, test] += 1
+
+    def update(self, batch):
+        """Count a batch of events (DataFrame or pyarrow RecordBatch/Table) and check."""
+        test = _to_numpy(batch[self.group_col] if isinstance(batch, pd.DataFrame)
+                         else batch.column(self.group_col)).astype(np.intp, copy=False)
+        self.total += np.bincount(test, minlength=2)[:2]
+        for covariate in self.covariates:
+            codes, labels = _encode(batch[covariate] if isinstance(batch, pd.DataFrame)
+                                    else batch.column(covariate))
+            lookup = np.fromiter((self._index(covariate, label) for label in labels),
+                                 dtype=np.intp, count=len(labels))
+            rows = lookup[codes] if len(lookup) else codes
+            n_levels = len(self.counts[covariate])
+            self.counts[covariate] += np.bincount(rows * 2 + test, minlength=2 * n_levels).reshape(n_levels, 2)
+        return self.check()
+
+    def _stratum_tests(self, covariate):
+        n_levels = len(self.levels[covariate])
+        counts = self.counts[covariate][:n_levels].astype(np.float64)
+        n = counts.sum(axis=1)
+        flagged = self.flagged[covariate][:n_levels]
+        reference = self.total - counts[flagged].sum(axis=0)
+        rest = reference - np.where(flagged[:, None], 0, counts)
+        n_rest = rest.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            share = counts[:, 1] / n
+            share_rest = rest[:, 1] / n_rest
+            if self.expected_share is not None:
+                theta = share - self.expected_share
+                variance = self.expected_share * (1 - self.expected_share) / n
+                testable = n >= self.min_events
+            else:
+                pooled = reference[1] / max(reference.sum(), 1)
+                theta = share - share_rest
+                variance = pooled * (1 - pooled) * (1 / n + 1 / n_rest)
+                testable = (n >= self.min_events) & (n_rest >= self.min_events)
+            chi2 = theta * theta / variance
+            log_lr = log_msprt_statistic(theta, variance, self.tau)
+        testable &= variance > 0
+        return counts, share, share_rest, theta, chi2, np.where(testable, np.exp(-log_lr), 1.0), testable
+
+    def check(self):
+        """Update the always-valid p-values and alerts from the counters; returns the new alerts."""
+        events = int(self.total.sum())
+        n_tests = sum(len(levels) for levels in self.levels.values()) + (self.expected_share is not None)
+        threshold = self.alpha / max(n_tests, 1)
+        new = []
+        if self.expected_share is not None and events >= self.min_events:
+            theta = self.total[1] / events - self.expected_share
+            variance = self.expected_share * (1 - self.expected_share) / events
+            self.overall_pvalue = min(self.overall_pvalue,
+                                      math.exp(-float(log_msprt_statistic(theta, variance, self.tau))))
+            if self.overall_pvalue <= threshold and ("overall", "") not in self.alerts:
+                new.append(("overall", ""))
+        for covariate in self.covariates:
+            n_levels = len(self.levels[covariate])
+            labels = list(self.levels[covariate])
+            flagged = self.flagged[covariate][:n_levels]
+            # step-down: flag the strongest stratum, then re-test the others
+            # against a reference without it
+            while True:
+                tests = self._stratum_tests(covariate)
+                pvalue = np.minimum(self.pvalues[covariate][:n_levels], tests[5])
+                candidates = np.flatnonzero((pvalue <= threshold) & ~flagged)
+                if not len(candidates):
+                    break
+                strongest = candidates[np.argmax(tests[4][candidates])]
+                flagged[strongest] = True
+                new.append((covariate, labels[strongest]))
+            self.pvalues[covariate][:n_levels] = pvalue
+        for key in new:
+            self.alerts[key] = (events, time.perf_counter() - self.started)
+        return new
+
+    def status(self):
+        """SRMStatus with the overall split, a per-stratum table and the alerts so far."""
+        events = int(self.total.sum())
+        overall = {"n_control": int(self.total[0]), "n_test": int(self.total[1]),
+                   "test_share": self.total[1] / events if events else math.nan,
+                   "expected_share": self.expected_share,
+                   "chi2": math.nan, "pvalue": math.nan, "always_valid_pvalue": self.overall_pvalue}
+        if self.expected_share is not None and events:
+            expected = events * np.array([1 - self.expected_share, self.expected_share])
+            overall["chi2"], overall["pvalue"] = stats.chisquare(self.total, expected)
+
+        frames = []
+        for covariate in self.covariates:
+            counts, share, share_rest, difference, chi2, _, testable = self._stratum_tests(covariate)
+            n_levels = len(counts)
+            frames.append(pd.DataFrame({
+                "covariate": covariate, "level": list(self.levels[covariate]),
+                "n_control": counts[:, 0].astype(np.int64), "n_test": counts[:, 1].astype(np.int64),
+                "test_share": share, "test_share_rest": share_rest, "difference": difference,
+                "chi2": np.where(testable, chi2, np.nan),
+                "pvalue": np.where(testable, stats.chi2.sf(chi2, 1), np.nan),
+                "always_valid_pvalue": self.pvalues[covariate][:n_levels],
+            }))
+        strata = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if len(strata):
+            strata["flagged"] = np.concatenate([self.flagged[c][:len(self.levels[c])] for c in self.covariates])
+        alerts = pd.DataFrame([(c, l, e, s) for (c, l), (e, s) in self.alerts.items()],
+                              columns=["covariate", "level", "events_seen", "seconds"])
+        return SRMStatus(events, overall, strata, alerts)
+
+
+def _to_numpy(column):
+    if isinstance(column, (pa.Array, pa.ChunkedArray)):
+        return column.to_numpy()
+    return np.asarray(column)
+
+
+def _encode(column):
+    """Integer codes and labels of a pandas or pyarrow column; nulls get MISSING_LEVEL."""
+    if not isinstance(column, (pa.Array, pa.ChunkedArray)):
+        return encode_column(column)
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if not pa.types.is_dictionary(column.type):
+        column = pc.dictionary_encode(column)
+    labels = column.dictionary.to_pylist()
+    indices = column.indices
+    if indices.null_count:
+        indices = pc.fill_null(indices, len(labels))
+        labels.append(MISSING_LEVEL)
+    return indices.to_numpy().astype(np.intp, copy=False), labels
+
+
+@profiled("srm_monitor.replay_csv")
+def replay_csv(path, monitor=None, block_size=1 << 22, **kwargs):
+    """Feed an assignment CSV through an SRMMonitor, block by block.
+
+    Generator of (events so far, new alerts) after each block of about
+    `block_size` bytes. Only the monitored columns are parsed; strings are
+    dictionary-encoded by the CSV reader, so each block costs one bincount per
+    covariate on small integer codes.
+    """
+    monitor = monitor or SRMMonitor(**kwargs)
+    columns = [monitor.group_col] + monitor.covariates
+    reader = pacsv.open_csv(
+        path,
+        read_options=pacsv.ReadOptions(block_size=block_size),
+        convert_options=pacsv.ConvertOptions(include_columns=columns, auto_dict_encode=True,
+                                             auto_dict_max_cardinality=monitor.max_levels),
+    )
+    for batch in reader:
+        new = monitor.update(batch)
+        yield int(monitor.total.sum()), new
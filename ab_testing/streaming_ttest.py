@@ -0,0 +1,168 @@
+# Streaming Welch's t-test built on per-group sufficient statistics.
+#
+# stats.ttest_ind needs both samples in memory. Welch's test only ever looks at
+# n, mean and variance of each group though, and those can be rebuilt from
+# n, sum and sum-of-squares. So we read the results table chunk by chunk,
+# keep three numbers per group and throw the rows away.
+# For a binary metric like conversion, sum and sum-of-squares are both just
+# the number of converted users, so the accumulators are exact counts.
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import stats
+
+from .profiling import profiled, recorded_result, submit_recorded
+
+WelchResult = namedtuple(
+    "WelchResult", ["statistic", "pvalue", "df", "mean_test", "mean_control"]
+)
+# same fields, for the pooled-variance Student's t-test
+TTestResult = namedtuple("TTestResult", WelchResult._fields)
+
+
+class WelchAccumulator:
+    """Mergeable n / sum / sum-of-squares for control (index 0) and test (index 1)."""
+
+    def __init__(self):
+        self.n = np.zeros(2, dtype=np.int64)
+        self.total = np.zeros(2, dtype=np.float64)
+        self.total_sq = np.zeros(2, dtype=np.float64)
+
+    def update(self, test, metric):
+        """Add one chunk of rows. `test` holds 0/1 group labels, `metric` the values."""
+        group = np.asarray(test).astype(np.intp, copy=False)
+        values = np.asarray(metric, dtype=np.float64)
+        self.n += np.bincount(group, minlength=2)[:2]
+        self.total += np.bincount(group, weights=values, minlength=2)[:2]
+        self.total_sq += np.bincount(group, weights=values * values, minlength=2)[:2]
+        return self
+
+    def merge(self, other):
+        """Fold another accumulator (e.g. from another file or worker) into this one."""
+        self.n += other.n
+        self.total += other.total
+        self.total_sq += other.total_sq
+        return self
+
+    def __add__(self, other):
+        return WelchAccumulator().merge(self).merge(other)
+
+    def means(self):
+        """Mean of the metric per group, as [control, test]."""
+        return self.total / self.n
+
+    def variances(self):
+        """Unbiased (ddof=1) variance per group, as [control, test]."""
+        return welch_variances(self.n, self.total, self.total_sq)
+
+    def welch(self):
+        """Welch's t-test of test vs control, same as ttest_ind(test, control, equal_var=False)."""
+        return welch_from_stats(self.n, self.total, self.total_sq)
+
+
+def welch_variances(n, total, total_sq):
+    # clip tiny negative values coming from floating-point cancellation
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.maximum(total_sq - total * total / n, 0.0) / (n - 1)
+
+
+def welch_arrays(n, total, total_sq):
+    """Vectorized Welch's t-test: inputs are (..., 2) arrays of [control, test] stats.
+
+    Returns (statistic, pvalue, df, mean_control, mean_test) arrays of shape (...).
+    """
+    n = np.asarray(n, dtype=np.float64)
+    total = np.asarray(total, dtype=np.float64)
+    var = welch_variances(n, total, np.asarray(total_sq, dtype=np.float64))
+    # segments with an empty arm give nan, without warnings
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / n
+        se2 = var / n
+        se2_total = se2[..., 0] + se2[..., 1]
+        statistic = (mean[..., 1] - mean[..., 0]) / np.sqrt(se2_total)
+        df = se2_total ** 2 / (se2[..., 0] ** 2 / (n[..., 0] - 1) + se2[..., 1] ** 2 / (n[..., 1] - 1))
+    pvalue = 2 * stats.t.sf(np.abs(statistic), df)
+    return statistic, pvalue, df, mean[..., 0], mean[..., 1]
+
+
+def welch_from_stats(n, total, total_sq):
+    """Welch's t-test from [control, test] arrays of n, sum and sum-of-squares."""
+    statistic, pvalue, df, mean_control, mean_test = welch_arrays(n, total, total_sq)
+    return WelchResult(float(statistic), float(pvalue), float(df), float(mean_test), float(mean_control))
+
+
+def ttest_from_stats(n, total, total_sq, equal_var=False):
+    """Two-sample t-test from sufficient statistics.
+
+    equal_var=False is Welch's test (welch_from_stats, a WelchResult),
+    equal_var=True the pooled Student's t-test (a TTestResult), matching
+    stats.ttest_ind(test, control, equal_var=...).
+    """
+    if not equal_var:
+        return welch_from_stats(n, total, total_sq)
+    n = np.asarray(n, dtype=np.float64)
+    total = np.asarray(total, dtype=np.float64)
+    mean = total / n
+    var = welch_variances(n, total, np.asarray(total_sq, dtype=np.float64))
+    df = n.sum() - 2
+    pooled = ((n - 1) * var).sum() / df
+    with np.errstate(divide="ignore", invalid="ignore"):
+        statistic = (mean[1] - mean[0]) / np.sqrt(pooled * (1 / n).sum())
+    pvalue = 2 * stats.t.sf(np.abs(statistic), df)
+    return TTestResult(float(statistic), float(pvalue), float(df), float(mean[1]), float(mean[0]))
+
+
+def verdict(result, alpha=0.05):
+    """Same decision rule as ab_testing_analysis.py."""
+    if result.pvalue > alpha:
+        return "Non-significant results"
+    elif result.statistic > 0:
+        return "Statistically better results"
+    else:
+        return "Statistically worse results"
+
+
+@profiled("streaming_ttest.accumulate_csv")
+def accumulate_csv(source, group_col="test", metric_col="conversion", chunksize=1_000_000):
+    """Stream a results CSV (path or URL) into a WelchAccumulator, one chunk at a time.
+
+    Only the two needed columns are parsed, so memory stays at one chunk no matter
+    how many rows the file has.
+    """
+    import pandas as pd
+
+    acc = WelchAccumulator()
+    reader = pd.read_csv(
+        source,
+        usecols=[group_col, metric_col],
+        dtype={group_col: np.int8, metric_col: np.float64},
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        acc.update(chunk[group_col].to_numpy(), chunk[metric_col].to_numpy())
+    return acc
+
+
+@profiled("streaming_ttest.accumulate_batches")
+def accumulate_batches(batches, group_col="test", metric_col="conversion"):
+    """Accumulate an iterable of pyarrow RecordBatches (e.g. Table.to_batches())."""
+    acc = WelchAccumulator()
+    for batch in batches:
+        acc.update(
+            batch.column(group_col).to_numpy(zero_copy_only=False),
+            batch.column(metric_col).to_numpy(zero_copy_only=False),
+        )
+    return acc
+
+
+@profiled("streaming_ttest.accumulate_csv_files")
+def accumulate_csv_files(sources, processes=None, **kwargs):
+    """Accumulate several CSV files in parallel and merge the partial results."""
+    total = WelchAccumulator()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [submit_recorded(pool, accumulate_csv, source, **kwargs) for source in sources]
+        for future in futures:
+            total.merge(recorded_result(future))
+    return total
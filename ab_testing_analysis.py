@@ -1,6 +1,7 @@
 import pandas
 #read from google drive
-data = pandas.read_csv("https://drive.google.com/uc?export=download&id=1E8aYgxZpYXO_HxLgQPAGMUS1_fbfTW5d")
+DATA_URL = "https://drive.google.com/uc?export=download&id=1E8aYgxZpYXO_HxLgQPAGMUS1_fbfTW5d"
+# data = pandas.read_csv(DATA_URL)
 # print(data.head())
 
 # output
@@ -26,9 +27,22 @@ data = pandas.read_csv("https://drive.google.com/uc?export=download&id=1E8aYgxZp
 
 # In practice, it would simply be something like this:
 
-from scipy import stats
+from ab_testing.dataset_cache import load_table
+from ab_testing.streaming_ttest import accumulate_batches, verdict
+
+# The CSV is downloaded and parsed only once, then kept in a local memory-mapped
+# columnar cache (see dataset_cache.py), so re-running the analysis is instant.
+table = load_table(DATA_URL, columns=["test", "conversion"])
+
+# Our logs can be far bigger than this table, so rather than loading everything
+# and building two filtered copies of the conversion column, we go through it
+# batch by batch and only keep n, sum and sum-of-squares per group.
+# The result is identical to stats.ttest_ind(test, control, equal_var=False).
+# (streaming_ttest.accumulate_csv does the same straight from a CSV, in chunks.)
+acc = accumulate_batches(table.to_batches(), group_col="test", metric_col="conversion")
+
 #check conversion rate for both groups
-print(data.groupby('test')['conversion'].mean())
+print(pandas.Series(acc.means(), name="conversion").rename_axis("test"))
 
 # output
 # test              Interpretation
@@ -40,11 +54,7 @@ print(data.groupby('test')['conversion'].mean())
 
 print("----- Test Result Summary -----")
 
-test_result = stats.ttest_ind(
-    data.loc[data['test'] == 1]['conversion'], 
-    data.loc[data['test'] == 0]['conversion'], 
-    equal_var=False
-    )
+test_result = acc.welch()
 #t statistics
 print("t-statistic n/", test_result.statistic)
 
@@ -52,12 +62,42 @@ print("t-statistic n/", test_result.statistic)
 print("p-value:", test_result.pvalue)
 
 #print test results
-if (test_result.pvalue > 0.05):
-    print("Non-significant results")
-elif (test_result.statistic > 0):
-    print("Statistically better results")
-else:
-    print("Statistically worse results")
+print(verdict(test_result))
+
+# Both columns are 0/1, yet they take a byte per user each even as the int8 flags
+# of the typed cache (8 as int64 from a plain read_csv). CompactTable (see
+# compact_table.py) keeps them as packed bits, 1 bit per user, and gets the
+# group counts and conversions, hence the same Welch test, from popcounts of
+# AND-ed bit masks. It is built batch by batch, so the full table never has to
+# be in memory at once.
+from ab_testing.compact_table import CompactTable
+
+compact = CompactTable.from_batches(table.to_batches(), id_col=None, covariates=[])
+print(f"{compact.nbytes:,} bytes packed vs {table.nbytes:,} in the table, "
+      f"p-value: {compact.welch().pvalue}")
+
+# The p-value says the difference is real, but not how big it could be.
+# A Poisson bootstrap gives confidence intervals on the absolute and relative lift.
+# For a 0/1 metric it collapses to per-group counts, so 10k replicates take milliseconds.
+from ab_testing.bootstrap import poisson_bootstrap
+
+lift = poisson_bootstrap(
+    table.column("conversion").to_numpy(),
+    group=table.column("test").to_numpy(),
+    n_replicates=10_000,
+    seed=0,
+)
+print(lift.summary)
+
+# Accumulators from different files or worker processes can be merged,
+# e.g. streaming_ttest.accumulate_csv_files([...]) or acc.merge(other_acc),
+# before calling .welch() on the combined statistics.
+
+# This p-value is only valid if you look at it once, after the planned sample size
+# is reached. To watch an experiment while traffic is still arriving, use
+# sequential_test.SequentialAnalyzer (or monitor_csv on a growing results file):
+# it folds in each new batch and reports an always-valid mSPRT p-value and
+# confidence sequence on the lift, which stay valid however often you refresh.
 
 # T-Test Results Summary
 # T-statistic: 7.71 (large non-zero value)=> big difference between the groups, 
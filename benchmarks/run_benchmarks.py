@@ -0,0 +1,238 @@
+# Time and memory of each analysis stage on synthetic data of growing size.
+#
+#   python -m benchmarks.run_benchmarks --sizes 1e5 1e6 1e7 --output bench.jsonl
+#   python -m benchmarks.run_benchmarks --sizes 1e5 1e6 --compare bench.jsonl
+#
+# Every stage is run on the same seeded table per size (see synthetic.py, with
+# the Argentina/Uruguay assignment bias). One JSON object per (stage, rows) is
+# appended to --output: wall and CPU seconds, process peak RSS during the stage
+# and how much it grew. With --compare, stages slower than --tolerance times
+# the previous results are reported as regressions (exit code 1).
+#
+# cli_sample_size is the cold start of `python -m ab_testing sample-size` in a
+# fresh interpreter; it fails the run on its own when it exceeds
+# --startup-budget seconds, since a slow start usually means a heavy import
+# crept into the CLI path.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from ab_testing.assignment import assign, assign_stratified
+from ab_testing.balance_check import balance_report
+from ab_testing.batch import run_batch
+from ab_testing.compact_table import CompactTable
+from ab_testing.dataset_cache import DatasetCache
+from ab_testing.ingest import read_frame
+from ab_testing.power_grid import sample_size_grid
+from ab_testing.profiling import PeakRSS
+from ab_testing.randomization_tree import fit_randomization_tree
+from ab_testing.raking import rake, weighted_welch
+from ab_testing.rebalance import rebalance_strata, weighted_ttest
+from ab_testing.srm_monitor import replay_csv
+from ab_testing.streaming_ttest import WelchAccumulator
+from benchmarks.synthetic import generate, write_csv
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_SIZE_COMMAND = [sys.executable, "-m", "ab_testing", "sample-size", "--p1", "0.1", "--p2", "0.11"]
+
+
+def measure(stage, rows, func, *args, **kwargs):
+    """Run func once and return (result, record)."""
+    with PeakRSS() as rss:
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = func(*args, **kwargs)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    record = {
+        "stage": stage,
+        "rows": rows,
+        "wall_s": round(wall, 6),
+        "cpu_s": round(cpu, 6),
+        "peak_rss_mb": round(rss.peak / 2 ** 20, 1),
+        "delta_rss_mb": round((rss.peak - rss.start) / 2 ** 20, 1),
+    }
+    return result, record
+
+
+# -- stages -------------------------------------------------------------------
+# imports happen at module level so they are not counted in the first stage
+
+def stage_load_csv(path):
+    return pd.read_csv(path)
+
+
+def stage_ingest(path, columns=None):
+    return read_frame(path, columns=columns)
+
+
+def stage_load_cached(path, cache_dir):
+    cache = DatasetCache(cache_dir=cache_dir)
+    cache.path(path)  # first call converts, the timed stage is the warm load
+    return cache
+
+
+def stage_srm_replay(path):
+    for _ in replay_csv(path, expected_share=0.5):
+        pass
+
+
+def stage_assign(data):
+    return assign(data["user_id"].to_numpy(), "benchmark", splits=(0.46, 0.54))
+
+
+def stage_assign_stratified(data):
+    return assign_stratified(data["user_id"].to_numpy(), data["country"], "benchmark", splits=(0.46, 0.54))
+
+
+def stage_batch(path, workdir, cache, n_experiments=8):
+    # n_experiments on the same source: one parse, then memory-mapped by every worker
+    output = os.path.join(workdir, "batch_results.parquet")
+    manifest = [{"experiment": f"experiment_{i}", "source": path, "seed": i} for i in range(n_experiments)]
+    result = run_batch(manifest, output, parts_dir=tempfile.mkdtemp(dir=workdir), cache=cache,
+                       progress=None)
+    os.remove(output)
+    return result
+
+
+def stage_balance(data):
+    return balance_report(data)
+
+
+def stage_tree(data, max_rows):
+    return fit_randomization_tree(data, max_rows=max_rows)
+
+
+def stage_correction(data):
+    rebalance = rebalance_strata(data, "country", ["Argentina", "Uruguay"], seed=0)
+    return weighted_ttest(data["conversion"], rebalance.multiplicity, equal_var=True)
+
+
+def stage_raking(data):
+    raked = rake(data, interactions=[("country", "device")])
+    return weighted_welch(data["conversion"], data["test"], raked.weights)
+
+
+def stage_ttest_streaming(data):
+    return WelchAccumulator().update(data["test"].to_numpy(), data["conversion"].to_numpy()).welch()
+
+
+def stage_compact_build(data):
+    return CompactTable.from_frame(data)
+
+
+def stage_compact_ttest(compact):
+    return compact.welch()
+
+
+def stage_ttest_scipy(data):
+    return stats.ttest_ind(data.loc[data["test"] == 1]["conversion"],
+                           data.loc[data["test"] == 0]["conversion"], equal_var=False)
+
+
+def stage_power_grid():
+    return sample_size_grid(np.linspace(0.01, 0.3, 20), np.linspace(0.005, 0.05, 50),
+                            np.linspace(0.7, 0.95, 10), [0.01, 0.05, 0.1, 0.2],
+                            np.linspace(0.5, 2, 25))
+
+
+def stage_cli_sample_size():
+    return subprocess.run(SAMPLE_SIZE_COMMAND, cwd=REPO_ROOT, check=True,
+                          stdout=subprocess.DEVNULL)
+
+
+def run(sizes, seed, tree_max_rows, max_csv_rows, workdir):
+    records = []
+
+    def record(stage, rows, func, *args, **kwargs):
+        result, rec = measure(stage, rows, func, *args, **kwargs)
+        print(f"{stage:>18} {rows:>12,} rows  {rec['wall_s']:9.3f}s wall  "
+              f"{rec['cpu_s']:9.3f}s cpu  {rec['peak_rss_mb']:9.1f} MB peak", flush=True)
+        records.append(rec)
+        return result
+
+    stage_cli_sample_size()  # warm the OS file cache and the .pyc files
+    record("cli_sample_size", 1, stage_cli_sample_size)
+    record("power_grid", 1_000_000, stage_power_grid)
+    for rows in sizes:
+        data = record("generate", rows, generate, rows, seed=seed)
+        if rows <= max_csv_rows:
+            path = os.path.join(workdir, f"synthetic_{rows}.csv")
+            write_csv(path, rows, seed=seed)
+            record("load_csv", rows, stage_load_csv, path)
+            record("ingest", rows, stage_ingest, path)
+            record("ingest_projected", rows, stage_ingest, path, ["test", "conversion"])
+            record("srm_replay", rows, stage_srm_replay, path)
+            cache = stage_load_cached(path, os.path.join(workdir, "cache"))
+            record("load_cached", rows, cache.load, path)
+            record("batch", rows, stage_batch, path, workdir, cache)
+            os.remove(path)
+        record("assign", rows, stage_assign, data)
+        record("assign_stratified", rows, stage_assign_stratified, data)
+        record("balance_check", rows, stage_balance, data)
+        record("tree_fit", rows, stage_tree, data, tree_max_rows)
+        record("correction", rows, stage_correction, data)
+        record("raking", rows, stage_raking, data)
+        record("ttest_streaming", rows, stage_ttest_streaming, data)
+        record("ttest_scipy", rows, stage_ttest_scipy, data)
+        compact = record("compact_build", rows, stage_compact_build, data)
+        record("compact_ttest", rows, stage_compact_ttest, compact)
+        del data, compact
+    return records
+
+
+def compare(records, previous_path, tolerance):
+    with open(previous_path) as f:
+        previous = {(r["stage"], r["rows"]): r for r in map(json.loads, f)}
+    regressions = []
+    for rec in records:
+        old = previous.get((rec["stage"], rec["rows"]))
+        if old and old["wall_s"] > 0 and rec["wall_s"] > tolerance * old["wall_s"]:
+            regressions.append((rec["stage"], rec["rows"], old["wall_s"], rec["wall_s"]))
+    for stage, rows, old, new in regressions:
+        print(f"REGRESSION {stage} at {rows:,} rows: {old:.3f}s -> {new:.3f}s")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the analysis stages on synthetic data.")
+    parser.add_argument("--sizes", nargs="+", type=float, default=[1e5, 1e6, 1e7],
+                        help="row counts to benchmark, e.g. 1e5 1e6 1e7 1e8")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tree-max-rows", type=int, default=1_000_000,
+                        help="stratified subsample size for the tree fit")
+    parser.add_argument("--max-csv-rows", type=float, default=1e7,
+                        help="skip the CSV load stages above this many rows")
+    parser.add_argument("--output", default="bench_results.jsonl")
+    parser.add_argument("--compare", help="previous results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    parser.add_argument("--startup-budget", type=float, default=0.5,
+                        help="maximum seconds for a cold `python -m ab_testing sample-size`")
+    args = parser.parse_args(argv)
+
+    meta = {"python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count(), "timestamp": time.time()}
+    with tempfile.TemporaryDirectory() as workdir:
+        records = run([int(s) for s in args.sizes], args.seed, args.tree_max_rows,
+                      args.max_csv_rows, workdir)
+    regressions = compare(records, args.compare, args.tolerance) if args.compare else []
+    startup = next(r["wall_s"] for r in records if r["stage"] == "cli_sample_size")
+    if startup > args.startup_budget:
+        print(f"OVER BUDGET cli_sample_size: {startup:.3f}s > {args.startup_budget:.3f}s")
+        regressions.append(("cli_sample_size", 1, args.startup_budget, startup))
+    with open(args.output, "a") as f:
+        for rec in records:
+            f.write(json.dumps({**rec, **meta}) + "\n")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
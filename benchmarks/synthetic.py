@@ -0,0 +1,85 @@
+# Seeded synthetic experiment tables with the randomization.csv schema.
+#
+# user_id, source, device, browser_language, browser, sex, age, country, test, conversion
+#
+# Covariates are drawn independently with roughly the marginals of the real
+# dataset. The assignment can be biased per country, like the Argentina/Uruguay
+# bug found in check_randomization.py, and conversion rates differ by country so
+# that this bias shows up in the naive t-test. Categorical columns are built
+# from small integer codes, so 100M+ rows fit in memory.
+
+import numpy as np
+import pandas as pd
+
+LEVELS = {
+    "source": (["Ads", "Direct", "SEO"], [0.40, 0.20, 0.40]),
+    "device": (["Mobile", "Web"], [0.44, 0.56]),
+    "browser_language": (["EN", "ES", "Other"], [0.14, 0.83, 0.03]),
+    "browser": (["Android_App", "Chrome", "FireFox", "IE", "Iphone_App", "Opera", "Safari"],
+                [0.34, 0.22, 0.09, 0.14, 0.10, 0.01, 0.10]),
+    "sex": (["F", "M"], [0.42, 0.58]),
+    "country": (["Argentina", "Bolivia", "Chile", "Colombia", "Costa Rica", "Ecuador",
+                 "El Salvador", "Guatemala", "Honduras", "Mexico", "Nicaragua", "Panama",
+                 "Paraguay", "Peru", "Spain", "Uruguay", "Venezuela"],
+                [0.11, 0.02, 0.04, 0.12, 0.01, 0.03, 0.02, 0.03, 0.02, 0.30, 0.01, 0.01,
+                 0.02, 0.07, 0.08, 0.01, 0.10]),
+}
+
+# P(test) per country in the buggy randomizer, read off randomization_tree.png
+ARGENTINA_URUGUAY_BIAS = {"Argentina": 0.73, "Uruguay": 0.89}
+
+# conversion rates: Argentina and Uruguay convert less than the rest
+BASE_CONVERSION = 0.05
+COUNTRY_CONVERSION = {"Argentina": 0.015, "Uruguay": 0.012}
+
+
+def _draw(rng, n, labels, probs):
+    probs = np.asarray(probs, dtype=np.float64)
+    codes = np.searchsorted(np.cumsum(probs / probs.sum()), rng.random(n), side="right")
+    return np.minimum(codes, len(labels) - 1).astype(np.int8)
+
+
+def generate(n_rows, seed=0, test_share=0.5, assignment_bias=ARGENTINA_URUGUAY_BIAS,
+             lift=0.0, shuffle_ids=True):
+    """Synthetic experiment table with n_rows users.
+
+    test_share: P(test) for users of countries not in assignment_bias.
+    assignment_bias: {country: P(test)} overrides, {} for a correct randomizer.
+    lift: true absolute effect of the test on conversion (0 = A/A).
+    """
+    rng = np.random.default_rng(seed)
+    columns = {}
+    user_id = np.arange(1, n_rows + 1, dtype=np.int64)
+    if shuffle_ids:
+        rng.shuffle(user_id)
+    columns["user_id"] = user_id
+
+    codes = {}
+    for name, (labels, probs) in LEVELS.items():
+        codes[name] = _draw(rng, n_rows, labels, probs)
+        columns[name] = pd.Categorical.from_codes(codes[name], categories=labels)
+    columns["age"] = np.clip(np.round(rng.gamma(4.0, 7.5, n_rows)) + 18, 18, 70).astype(np.int8)
+    # keep the schema's column order
+    ordered = ["user_id", "source", "device", "browser_language", "browser", "sex", "age", "country"]
+
+    countries = LEVELS["country"][0]
+    p_test = np.array([assignment_bias.get(c, test_share) for c in countries])
+    test = (rng.random(n_rows) < p_test[codes["country"]]).astype(np.int8)
+    p_conv = np.array([COUNTRY_CONVERSION.get(c, BASE_CONVERSION) for c in countries])
+    conversion = (rng.random(n_rows) < p_conv[codes["country"]] + lift * test).astype(np.int8)
+
+    frame = pd.DataFrame({name: columns[name] for name in ordered})
+    frame["test"] = test
+    frame["conversion"] = conversion
+    return frame
+
+
+def write_csv(path, n_rows, seed=0, chunk_rows=5_000_000, **kwargs):
+    """Write a synthetic table to CSV in chunks, so the file can exceed memory."""
+    header = True
+    for i, start in enumerate(range(0, n_rows, chunk_rows)):
+        chunk = generate(min(chunk_rows, n_rows - start), seed=(seed, i), shuffle_ids=False, **kwargs)
+        chunk["user_id"] += start
+        chunk.to_csv(path, mode="w" if header else "a", header=header, index=False)
+        header = False
+    return path
@@ -12,8 +12,9 @@
 import pandas as pd
 pd.set_option('display.max_columns', 20)
 pd.set_option('display.width', 350)
-#read from google drive
-data = pd.read_csv("https://drive.google.com/uc?export=download&id=1jYFe4qjaQ1ZZZrqJ2R8Nu-eRBjhAfsoL")
+from ab_testing.dataset_cache import load_dataset
+#read from google drive (cached locally after the first run, see dataset_cache.py)
+data = load_dataset("https://drive.google.com/uc?export=download&id=1jYFe4qjaQ1ZZZrqJ2R8Nu-eRBjhAfsoL")
 print(data.head())
 
 # output
@@ -79,6 +80,23 @@ print(data.head())
 # The proportions of users in control vs. test are nearly identical across traffic sources, 
 # so we can reasonably say that traffic source is not confounding the test results.
 
+# Doing this column by column is slow to write and, on big tables, slow to run
+# (every groupby rescans the data). balance_check.balance_report covers all the
+# covariates of the schema in one pass: each column becomes integer codes and a
+# single np.bincount gives its test/control counts per level. From those it reports
+# per-level proportions in control and test, the standardized mean difference (SMD),
+# a chi-square test, and Benjamini-Hochberg (FDR) corrected flags.
+
+from ab_testing.balance_check import balance_report
+
+balance = balance_report(data)
+
+# one row per covariate: chi-square test of independence with the assignment
+print(balance.covariates)
+
+# levels with q-value < 0.05 and |SMD| >= 0.1
+print(balance.levels[balance.levels["imbalanced"]])
+
 # To ensure that the test and control groups are comparable, 
 # we can analyze their distributions across all relavant columns, which can be tedious and time-consuming, 
 # so we approach this as a machine learning problem.
@@ -92,65 +110,77 @@ print(data.head())
 # This approach helps pinpoint where randomization may not have worked as intended.
 
 
-import graphviz
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.tree import export_graphviz
-from graphviz import Source
-  
-#drop user_id, not needed
+from ab_testing.randomization_tree import fit_randomization_tree
+
+#drop user_id, not needed for the checks (kept aside to re-assign users at the end)
+user_ids = data['user_id']
 data = data.drop(['user_id'], axis=1)
 
 #make dummy vars. Don't drop one level here, keep them all. You don't want 
-# to risk dropping the one level that actually creates problems with the randomization
-data_dummy = pd.get_dummies(data)
-
-#model features, test is the label and conversion is not needed here
-train_cols = data_dummy.drop(['test', 'conversion'], axis=1)
-  
-tree=DecisionTreeClassifier(
-    #change weights. Our data set is now perfectly balanced. It makes easier to look at tree output
-    class_weight="balanced",
+# to risk dropping the one level that actually creates problems with the randomization.
+# pd.get_dummies would build a dense rows x levels matrix, which blows up with
+# high-cardinality columns like country and browser. fit_randomization_tree builds the
+# same one-hot encoding as a sparse matrix instead (one non-zero per column per row),
+# with the same "country_Argentina"-style feature names.
+# test is the label and conversion is not needed here.
+# On very large tables pass max_rows=... to fit on a stratified subsample,
+# randomization_tree.detection_bound tells how small an imbalance that sample still detects.
+check = fit_randomization_tree(
+    data,
+    group_col="test",
+    #change weights (class_weight="balanced" inside). Our data set is now perfectly balanced. It makes easier to look at tree output
     #only split if if it's worthwhile. The default value of 0 means always split no matter what if you can increase overall performance, which creates tons of noisy and irrelevant splits
     min_impurity_decrease = 0.001
     )
-tree.fit(train_cols,data_dummy['test'])
+tree = check.tree
+
+# which levels separate test from control, strongest split first
+print(check.splits)
   
-# export_graphviz(tree, out_file="tree_test.dot", feature_names=train_cols.columns, proportion=True, rotate=True)
+# (needs the graphviz package, which is no longer a requirement)
+# from sklearn.tree import export_graphviz
+# from graphviz import Source
+# export_graphviz(tree, out_file="tree_test.dot", feature_names=check.feature_names, proportion=True, rotate=True)
 # s = Source.from_file("tree_test.dot")
 # s.view()
 
 # --- Replace old export and s.view() with this ---
-from sklearn.tree import plot_tree
-
-import matplotlib.pyplot as plt
-
-# Make a figure
-plt.figure(figsize=(20, 20))
-
-# Plot the tree using sklearn's plot_tree (better integration with matplotlib)
-plot_tree(
-    tree,
-    feature_names=train_cols.columns,
-    class_names=["Control", "Test"],
-    filled=True,
-    proportion=True,
-    rounded=True,
-    max_depth=3  # Limit depth to keep it readable; adjust as needed
+# Rendering a 20x20 plot_tree is not free, and its output only depends on the data
+# and the plot settings. reports.ArtifactStore keys the figure by a hash of both:
+# when neither changed since the last run, the cached PNG is copied instead of
+# fitting and plotting again. Rendering uses the headless Agg backend.
+from ab_testing.reports import ArtifactStore, Figure, render_randomization_tree
+
+ArtifactStore().figures(
+    [Figure("randomization_tree.png", render_randomization_tree, (data,),
+            # plot_tree with filled=True, proportion=True, rounded=True; max_depth keeps it readable
+            {"max_depth": 3, "figsize": (20, 20)})],
+    output_dir=".",
 )
 
-# Save to file
-plt.savefig("randomization_tree.png", bbox_inches='tight')
-plt.close()
-
 # We can see that the test and control are not the same. 
 # Users from Argentina and Uruguay are way more likely to be in the test than the control. 
 # When country_Argentina is 1, the tree shows that users in control are ~23% and 
 # in test 73% instead of 50/50. For Uruguay, the proportions are even more extreme: 
 # 11% in control and 89% in test! Not good!
 
+# Reading the plot by eye does not tell us whether this separation is more than noise.
+# permutation_test refits the same tree on randomly shuffled test labels (what a truly
+# random assignment would look like) and reports p-values for the observed AUC, the
+# total impurity decrease and each splitting feature. Work is spread over a process
+# pool, so keep it under the __main__ guard.
+
+from ab_testing.randomization_tree import permutation_test
+
+if __name__ == "__main__":
+    calibration = permutation_test(data, n_permutations=200, group_col="test", seed=0)
+    print(calibration.summary)
+    print(calibration.features)
+
 # Let’s double check this manually in our dataset.
 
-print(data_dummy.groupby("test")[["country_Argentina", "country_Uruguay"]].mean())
+print(pd.DataFrame({"country_Argentina": data['country'] == 'Argentina',
+                    "country_Uruguay": data['country'] == 'Uruguay'}).groupby(data['test']).mean())
 
 #         country_Argentina  country_Uruguay
 # test
@@ -162,23 +192,42 @@ print(data_dummy.groupby("test")[["country_Argentina", "country_Uruguay"]].mean(
 # Uruguay is even more extreme: 
 # test has 1.7% of users from Uruguay and control has just 0.2% of Uruguayan users
 
+# We only found this after the experiment was over. srm_monitor.SRMMonitor watches the
+# assignment events as they arrive instead: it keeps test/control counters per level of
+# every covariate and runs sample-ratio-mismatch checks (always-valid, so they can be
+# re-run after every batch) overall and per stratum. Replaying our table in arrival
+# order, 1,000 events at a time, shows how early it would have raised the alarm.
+# For a file, srm_monitor.replay_csv does the same at millions of events per second.
+from ab_testing.srm_monitor import SRMMonitor
+
+monitor = SRMMonitor(group_col="test")
+for start in range(0, len(data), 1_000):
+    for covariate, level in monitor.update(data.iloc[start:start + 1_000]):
+        if covariate == "country":
+            print(f"SRM alert on {covariate}={level} after {monitor.alerts[(covariate, level)][0]:,} events")
+
 # And this is a big problem because that means we are not comparing anymore 
 # apples to apples in our A/B test. The difference we might see in conversion rate might 
 # very well depend on the fact that users between the two groups are different.
 
 # Let’s check it in practice:
 
-from scipy import stats
-  
+# Instead of one boolean mask (and one full scan) per slice, segment_tests aggregates
+# n, sum and sum-of-squares of conversion per test group and country once, and every
+# slice is derived from those few numbers: "Full" is the sum over all countries and
+# "Removed_Argentina_Uruguay" the sum over the other countries.
+from ab_testing.segment_tests import aggregate_segments, pooled, segment_tests
+from ab_testing.streaming_ttest import welch_from_stats
+
+by_country = aggregate_segments(data, [("country",)], group_col="test", metric_col="conversion")
+country_stats = by_country[("country",)]
+AR_UR = country_stats.levels["country"].isin(["Argentina", "Uruguay"]).to_numpy()
+
 #this is the test results using the orginal dataset
-original_data = stats.ttest_ind(data_dummy.loc[data['test'] == 1]['conversion'], 
-                                data_dummy.loc[data['test'] == 0]['conversion'], 
-                                equal_var=False)
+original_data = welch_from_stats(*pooled(country_stats))
   
 #this is after removing Argentina and Uruguay
-data_no_AR_UR = stats.ttest_ind(data_dummy.loc[(data['test'] == 1) & (data_dummy['country_Argentina'] ==  0) & (data_dummy['country_Uruguay'] ==  0)]['conversion'], 
-                                data_dummy.loc[(data['test'] == 0) & (data_dummy['country_Argentina'] ==  0) & (data_dummy['country_Uruguay'] ==  0)]['conversion'], 
-                                equal_var=False)
+data_no_AR_UR = welch_from_stats(*pooled(country_stats, ~AR_UR))
   
 print(pd.DataFrame( {"data_type" : ["Full", "Removed_Argentina_Uruguay"], 
                          "p_value" : [original_data.pvalue, data_no_AR_UR.pvalue],
@@ -190,6 +239,12 @@ print(pd.DataFrame( {"data_type" : ["Full", "Removed_Argentina_Uruguay"],
 # 0                       Full  1.928918e-13    -7.353895
 # 1  Removed_Argentina_Uruguay  7.200849e-01     0.358346
 
+# The same pass gives Welch tests for every level of every covariate, plus the
+# leave-one-level-out slices ("without"), with Benjamini-Hochberg correction.
+# Crossed segments like ("country", "device", "source") work the same way.
+segments = segment_tests(data, group_col="test", metric_col="conversion", leave_one_out=True)
+print(segments[segments["significant"]])
+
 # There's a significant discrepancy observed in the test results where certain countries 
 # were either overrepresented or underrepresented, leading to a statistically significant 
 # negative t-statistic indicating that the test performed worse than the control. 
@@ -200,6 +255,25 @@ print(pd.DataFrame( {"data_type" : ["Full", "Removed_Argentina_Uruguay"],
 # for the randomization process. Investigate the root cause of the issue, rectify it, 
 # and then rerun the test. It's essential to delve deeper into the bug's discovery, 
 # as it may hint at broader underlying issues beyond just the identified issue.
+#
+# A fix is an assignment that only depends on the user id and the experiment
+# (see ab_testing/assignment.py): the arm comes from a salted hash of the id, so
+# it is reproducible everywhere and cannot depend on the country. Re-assigning
+# the same users with the planned 46/54 split, balanced exactly within each
+# country, passes the same checks that caught the bug:
+from ab_testing.assignment import assign_stratified, verify_assignment
+
+reassigned = data.assign(test=assign_stratified(user_ids, data['country'], "new-site", splits=(0.46, 0.54)))
+check = verify_assignment(reassigned, splits=(0.46, 0.54))
+print(check.split)
+print(f"SRM p-value: {check.srm_pvalue:.3f}, imbalanced levels: {int(check.levels['imbalanced'].sum())}, "
+      f"passed: {check.passed}")
+
+# output
+#    arm  observed  expected     share  planned_share
+# 0    0    137999  138000.0  0.459997           0.46
+# 1    1    162001  162000.0  0.540003           0.54
+# SRM p-value: 0.997, imbalanced levels: 0, passed: True
 
 # 2. If investigation reveals that everything else was functioning correctly except for 
 # the disparity in those two countries, you could consider adjusting the weights or distribution 
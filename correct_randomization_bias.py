@@ -19,10 +19,10 @@
 
 # 1. Load dataset
 
-import pandas as pd
-from scipy.stats import ttest_ind
+from ab_testing.dataset_cache import load_dataset
 
-df = pd.read_csv("randomization.csv")
+# parsed once into the local columnar cache, later runs memory-map it (see dataset_cache.py)
+df = load_dataset("randomization.csv")
 print(df.head())
 
 #    user_id source  device browser_language      browser sex  age    country  test  conversion
@@ -66,61 +66,47 @@ print("\nUruguay (UY) proportions:\n", country_props[['Uruguay']])
 
 # 3. Calculate how many additional rows we need to sample
 
-# Separate into test and control
-test_df = df[df['test'] == 1]
-control_df = df[df['test'] == 0]
-
-# Desired proportions from test group
-target_AR_prop = (test_df['country'] == 'Argentina').mean()
-target_UY_prop = (test_df['country'] == 'Uruguay').mean()
-
-# Current size of control
-control_size = len(control_df)
-
-# Required number of rows to match test group proportions
-desired_AR = int(target_AR_prop * control_size)
-desired_UY = int(target_UY_prop * control_size)
-
-# Current counts in control
-current_AR = (control_df['country'] == 'Argentina').sum()
-current_UY = (control_df['country'] == 'Uruguay').sum()
-
-# How many more we need
-extra_AR = desired_AR - current_AR
-extra_UY = desired_UY - current_UY
-
+# Rather than copying test_df/control_df and concatenating sampled rows, we only
+# compute *which* rows to add: rebalance_strata returns the positions of the
+# oversampled rows in df plus a multiplicity vector (how many times each original
+# row counts in control and in test). Nothing gets duplicated in memory, and the
+# same call works for any list of strata, not only these two countries.
+
+from ab_testing.rebalance import rebalance_strata, weighted_proportions, weighted_ttest
+
+# For each country: desired = int(test group proportion * control size), extra = desired - current
+rebalance = rebalance_strata(
+    df,
+    column='country',
+    strata=['Argentina', 'Uruguay'],
+    group_col='test',
+    target_group=1,  # match the proportions of the test group
+    donor_group=1,   # draw from the test group only, as below
+    seed=42,         # reproducible draws
+)
+print(rebalance.plan)
+
+extra_AR, extra_UY = rebalance.plan.set_index('country')['extra'][['Argentina', 'Uruguay']]
 print(f"Need to oversample {extra_AR} AR and {extra_UY} UY users into control.")
 
 # Need to oversample 22744 AR and 2778 UY users into control.
 
 # 4. Sample and append users from AR and UY to control group
 
-# Get source pool from test group only to avoid duplication
-source_AR = test_df[test_df['country'] == 'Argentina']
-source_UY = test_df[test_df['country'] == 'Uruguay']
-
-# Sample with replacement in case we don’t have enough rows
-oversampled_AR = source_AR.sample(n=extra_AR, replace=True)
-oversampled_UY = source_UY.sample(n=extra_UY, replace=True)
-
-# Set these to be in control group
-oversampled_AR['test'] = 0
-oversampled_UY['test'] = 0
-
-# Append to control
-control_balanced = pd.concat([control_df, oversampled_AR, oversampled_UY], ignore_index=True)
-
-# Combine back with original test group
-df_corrected = pd.concat([control_balanced, test_df], ignore_index=True)
+# Source pool is the test group only (donor_group=1) and rows are drawn with
+# replacement in case we don’t have enough of them. The drawn rows are counted as
+# control: rebalance.extra_rows holds their positions in df, and
+# rebalance.multiplicity[0] / [1] how many times each row of df counts in control / test.
+# If you really need the corrected table, it is
+# pd.concat([df[df['test'] == 0], df.iloc[rebalance.extra_rows].assign(test=0), df[df['test'] == 1]])
 
 # C. Verify that the proportions of users from Argentina and Uruguay 
 # are now equal in both test and control groups.
 
 # 5. Validate the new proportions
 
-# Check proportions again
-props_corrected = df_corrected.groupby(['test', 'country']).size().unstack().fillna(0)
-props_corrected = props_corrected.div(props_corrected.sum(axis=1), axis=0)
+# Check proportions again, weighting every row by its multiplicity
+props_corrected = weighted_proportions(df['country'], rebalance.multiplicity)
 
 print("Argentina and Uruguay proportions after balancing:")
 print(props_corrected[['Argentina', 'Uruguay']])
@@ -139,17 +125,36 @@ print(props_corrected[['Argentina', 'Uruguay']])
 
 # 6. Conduct a t-test on conversion rates
 
-# Compare conversion between test and control
-conversion_test = df_corrected[df_corrected['test'] == 1]['conversion']
-conversion_control = df_corrected[df_corrected['test'] == 0]['conversion']
-
-t_stat, p_val = ttest_ind(conversion_test, conversion_control)
+# Compare conversion between test and control, on the weighted representation.
+# equal_var=True is the same (Student) test as ttest_ind's default on the concatenated frame.
+t_stat, p_val = weighted_ttest(df['conversion'], rebalance.multiplicity, equal_var=True)[:2]
 
 print(f"\nT-test Results:\nT-statistic: {t_stat:.4f}, P-value: {p_val:.4f}")
 
 # T-test Results:
 # T-statistic: -1.1395, P-value: 0.2545
 
+# Confidence intervals on the lift of the rebalanced data, bootstrapping the
+# multiplicity vector directly (each row counted m times gets a Poisson(m) weight),
+# so the oversampled rows are never materialized here either.
+from ab_testing.bootstrap import poisson_bootstrap
+
+lift_corrected = poisson_bootstrap(df['conversion'], multiplicity=rebalance.multiplicity,
+                                   n_replicates=10_000, seed=0)
+print(lift_corrected.summary)
+
+# Raking: instead of oversampling two countries, reweight the control group so
+# that every covariate (and the country x device crossing) matches the test
+# group's distribution at once, then compare with a weighted Welch test whose
+# variance accounts for the uneven weights.
+from ab_testing.raking import rake, weighted_welch
+
+raked = rake(df, interactions=[("country", "device")])
+print(f"Raking: {raked.iterations} iterations, max margin error {raked.max_error:.2g}, "
+      f"effective control size {raked.effective_n:,.0f}")
+raked_result = weighted_welch(df['conversion'], df['test'], raked.weights)
+print(f"Raked T-statistic: {raked_result.statistic:.4f}, P-value: {raked_result.pvalue:.4f}")
+
 # T-test Interpretation (After Bias Correction)
 
 # A p-value of 0.2545 is much greater than the typical significance level of 0.05.
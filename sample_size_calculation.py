@@ -52,7 +52,6 @@ print("The required sample size per group is ~", round(sample_size))
 # A/B testing objectives closely with business priorities and resource allocation decisions.
 
 import numpy as np
-import matplotlib.pyplot as plt
 
 #Possible p2 values. We choose from 10.5% to 15% with 0.5% increments
 
@@ -61,14 +60,42 @@ possible_p2 = np.arange(.105, .155, .005)
 print(possible_p2)
 # [0.105 0.11  0.115 0.12  0.125 0.13  0.135 0.14  0.145 0.15 ]
 
-#now let's estimate sample size for all those values and plot them
-sample_size = []
-for i in possible_p2:
-   p1_and_p2 = sms.proportion_effectsize(0.1, i)
-   sample_size.append(sms.NormalIndPower().solve_power(p1_and_p2, power=0.8, alpha=0.05))
-plt.plot(sample_size, possible_p2)
-plt.title("Sample size vs Minimum Effect size")
-plt.xlabel("Sample Size")
-plt.ylabel("Minimum Test Conversion rate")
-plt.savefig("sample_size_vs_conversion_rate.png", dpi=300, bbox_inches='tight')
-# plt.show()
+#now let's estimate sample size for all those values and plot them.
+# Calling solve_power in a loop runs a numerical root finder per point. power_grid
+# solves the same normal approximation in closed form over whole NumPy arrays
+# (results match statsmodels to ~1e-6, the tolerance of its root finder), so we
+# pass all p2 values at once.
+# power_grid.sample_size_grid does the same over full grids of
+# baseline x MDE x power x alpha x allocation ratio, and
+# power_grid.required_sample_size memoizes single queries.
+from ab_testing.power_grid import proportion_effectsize, sample_size as solve_sample_size
+
+sample_size = solve_sample_size(proportion_effectsize(0.1, possible_p2), power=0.8, alpha=0.05)
+print(np.round(sample_size))
+
+# All of the above is the normal approximation, and it is the z-test's power, not
+# that of the Welch t-test we actually run in ab_testing_analysis.py. At low
+# baselines (1-2%) or with unequal splits (46/54 in check_randomization.py) it
+# can be off, so we check it by simulation: power_simulation draws thousands of
+# experiments at once as binomial counts, runs the same Welch test on all of them,
+# and keeps simulating each point until its power estimate is within +-0.5%.
+# The work is spread over a process pool, so keep it under the __main__ guard.
+# The simulation takes a while, so its table is cached by its inputs (see reports.py),
+# like the chart: re-running the script with the same p1, p2, power and alpha reads
+# both back instead of simulating and plotting again.
+from ab_testing.power_simulation import simulate_power, simulated_sample_size
+from ab_testing.reports import ArtifactStore, Figure, render_sample_size_curve
+
+if __name__ == "__main__":
+    store = ArtifactStore()
+    simulated = store.table(simulated_sample_size, 0.1, possible_p2, power=0.8, alpha=0.05, seed=0)
+    print(simulated)
+
+    # e.g. a 1% baseline, 46% of users in control and 54% in test, sized by the formula
+    low_baseline = store.table(simulate_power, 0.01, [0.0125, 0.015], 10_000, ratio=54 / 46, seed=0)
+    print(low_baseline[["p2", "nobs_control", "nobs_test", "power", "ci_low", "ci_high", "analytic_power"]])
+
+    store.figures([Figure("sample_size_vs_conversion_rate.png", render_sample_size_curve, (0.1, possible_p2),
+                          {"power": 0.8, "alpha": 0.05, "simulated": simulated["nobs_control"].to_numpy(),
+                           "dpi": 300})],
+                  output_dir=".")